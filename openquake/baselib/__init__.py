@@ -107,8 +107,10 @@ def boolean(flag):
     raise ValueError('Unknown flag %r' % s)
 
 
-config.read(soft_mem_limit=int, hard_mem_limit=int, port=int,
-            multi_user=boolean,
+config.read(soft_mem_limit=int, hard_mem_limit=int, task_mem_limit=int,
+            read_cache=int, cache_size=int, port=int, tasks_per_core=int,
+            compress_outputs=int, prefetch_outputs=int, profile_interval=float,
+            multi_user=boolean, keep_alive=boolean,
             serialize_jobs=boolean, strict=boolean, code=exec)
 
 if config.directory.custom_tmp:
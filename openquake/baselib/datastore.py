@@ -20,6 +20,7 @@ import io
 import os
 import re
 import gzip
+import pickle
 import getpass
 import itertools
 import collections
@@ -163,6 +164,300 @@ def dset2df(dset, index):
     return pandas.DataFrame.from_records(numpy.array(out, dtlist), index)
 
 
+def _nbytes(obj):
+    # approximate memory footprint of an object stored in the ReadCache
+    if isinstance(obj, numpy.ndarray):
+        return obj.nbytes
+    elif isinstance(obj, pandas.DataFrame):
+        return int(obj.memory_usage().sum())
+    return len(pickle.dumps(obj, pickle.HIGHEST_PROTOCOL))
+
+
+def _read(dstore, key, read):
+    if read:
+        return read(dstore)
+    val = dstore[key]
+    return val[()] if isinstance(val, h5py.Dataset) else val
+
+
+class ReadCache(object):
+    """
+    Least recently used cache of the objects read from the datastores,
+    with a cap on the total memory. An object is identified by the
+    calculation ID and by its key, which is the path of an HDF5 object or
+    the name of an object built by a `read` function. The entries are
+    invalidated explicitly by the DataStore methods writing on a key, so
+    the master can keep extending other datasets in SWMR mode without
+    affecting the cache. In the worker processes, which do not see the
+    writes of the master, an entry is read again if the address or the
+    shape of the HDF5 object changed. It is meant for static objects
+    (exposure, risk model, weights...): the arrays are returned read-only
+    and the DataFrames are copied, since the entries are shared by all
+    the tasks of the process.
+    """
+    def __init__(self, maxbytes):
+        self.maxbytes = maxbytes
+        # (calc_id, key) -> (obj, nbytes, stamp)
+        self.objects = collections.OrderedDict()
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, dstore, key, read=None):
+        """
+        :param dstore: a DataStore instance
+        :param key: the key of an HDF5 object or the name of the object
+        :param read: a module-level function dstore -> object or None
+        :returns: the cached object or read(dstore) or dstore[key]
+        """
+        if self.maxbytes <= 0:
+            return _read(dstore, key, read)
+        ident = (dstore.calc_id, key)
+        stamp = _stamp(dstore, key)
+        try:
+            val, _, oldstamp = self.objects[ident]
+        except KeyError:
+            pass
+        else:
+            if oldstamp == stamp:
+                self.objects.move_to_end(ident)
+                self.hits += 1
+                return _copy(val)
+            self._pop(ident)  # stored again by another process
+        self.misses += 1
+        val = _read(dstore, key, read)
+        if isinstance(val, numpy.ndarray):
+            val.flags.writeable = False  # shared by the tasks
+        nbytes = _nbytes(val)
+        if nbytes <= self.maxbytes:
+            self.objects[ident] = val, nbytes, stamp
+            self.nbytes += nbytes
+            while self.nbytes > self.maxbytes:  # evict the oldest
+                self._pop(next(iter(self.objects)))
+        return _copy(val)
+
+    def _pop(self, ident):
+        _, nbytes, _ = self.objects.pop(ident)
+        self.nbytes -= nbytes
+
+    def invalidate(self, calc_id, key):
+        """
+        Remove the entries of the given calculation depending on the key,
+        i.e. the objects stored in the key or in its parents or children,
+        and the objects not associated to an HDF5 object (like the loss
+        builder of post_ebrisk), since they can depend on any key
+        """
+        for ident in list(self.objects):
+            cid, k = ident
+            if cid == calc_id and (
+                    self.objects[ident][2] is None or k == key or
+                    k.startswith(key + '/') or key.startswith(k + '/')):
+                self._pop(ident)
+
+    def clear(self):
+        """
+        Remove all the cached objects
+        """
+        self.objects.clear()
+        self.nbytes = 0
+
+
+def _stamp(dstore, key):
+    # address and shape of the HDF5 object, or None if the key is the name
+    # of an object built by a read function
+    try:
+        obj = dstore._getdset(key)
+    except KeyError:
+        return
+    return h5py.h5o.get_info(obj.id).addr, getattr(obj, 'shape', ())
+
+
+def _copy(val):
+    # the cached DataFrames cannot be made read-only, so a copy is returned
+    return val.copy() if isinstance(val, pandas.DataFrame) else val
+
+
+read_cache = ReadCache(int(config.memory.get('read_cache', 0)) * 1024 ** 2)
+
+
+def _is_private(st):
+    # True if the file belongs to the current user and it is not writable
+    # by the group and the others; always True on Windows
+    if not hasattr(os, 'getuid'):
+        return True
+    return st.st_uid == os.getuid() and not st.st_mode & 0o022
+
+
+class ProductCache(object):
+    """
+    Content-addressed cache of intermediate products (composite source
+    model, ruptures...) pickled in a directory which can be shared between
+    the machines of a cluster. The keys are hex digests of the inputs of
+    the product, so that an entry never becomes stale; when the total size
+    exceeds `maxbytes` the least recently used files are removed.
+
+    Since unpickling a file can execute arbitrary code, the directory
+    must belong to the current user and must not be writable by others;
+    entries not satisfying the same condition are ignored.
+    """
+    def __init__(self, dirname, maxbytes):
+        self.dirname = dirname
+        self.maxbytes = maxbytes
+        os.makedirs(dirname, mode=0o700, exist_ok=True)
+        if not _is_private(os.stat(dirname)):
+            raise PermissionError(
+                'The cache_dir %s must belong to %s and must not be '
+                'writable by other users' % (dirname, getpass.getuser()))
+
+    def path(self, key):
+        """
+        :returns: the path of the file associated to the key
+        """
+        return os.path.join(self.dirname, key + '.pik')
+
+    def get(self, key):
+        """
+        :param key: a hex digest
+        :returns: the cached object or None
+        """
+        path = self.path(key)
+        try:
+            with open(path, 'rb') as f:
+                if not _is_private(os.fstat(f.fileno())):
+                    return  # not written by us, do not unpickle it
+                obj = pickle.load(f)
+            os.utime(path)  # mark the file as recently used
+        except FileNotFoundError:  # not cached or just evicted
+            return
+        except (EOFError, pickle.UnpicklingError):  # corrupted file
+            os.remove(path)
+            return
+        return obj
+
+    def put(self, key, obj):
+        """
+        Pickle the object in the cache, then remove the least recently used
+        files if the cache is too big.
+
+        :param key: a hex digest
+        :param obj: a pickleable object
+        :returns: the number of bytes written
+        """
+        data = pickle.dumps(obj, pickle.HIGHEST_PROTOCOL)
+        if len(data) > self.maxbytes:
+            return 0
+        # write on a temporary file first, so that concurrent readers
+        # never see a partially written entry
+        tmp = '%s.%d.tmp' % (self.path(key), os.getpid())
+        with open(os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_TRUNC,
+                          0o600), 'wb') as f:
+            f.write(data)
+        os.replace(tmp, self.path(key))
+        self.evict()
+        return len(data)
+
+    def put_iter(self, key, objs):
+        """
+        Yield the given objects, pickling them in the cache one after the
+        other, so that they are never kept all in memory. The entry is
+        stored only if the iteration completes and its size does not
+        exceed `maxbytes`; it can be read with :meth:`get_iter`.
+
+        :param key: a hex digest
+        :param objs: an iterable over pickleable objects
+        """
+        tmp = '%s.%d.tmp' % (self.path(key), os.getpid())
+        f = open(os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600),
+                 'wb')
+        nbytes = 0
+        try:
+            for obj in objs:
+                if f:
+                    data = pickle.dumps(obj, pickle.HIGHEST_PROTOCOL)
+                    nbytes += len(data)
+                    if nbytes > self.maxbytes:  # too big, give up caching
+                        f.close()
+                        os.remove(tmp)
+                        f = None
+                    else:
+                        f.write(data)
+                yield obj
+        except BaseException:  # including an interrupted iteration
+            if f:
+                f.close()
+                os.remove(tmp)
+            raise
+        if f:
+            f.close()
+            os.replace(tmp, self.path(key))
+            self.evict()
+
+    def get_iter(self, key):
+        """
+        :param key: a hex digest
+        :returns: an iterator over the objects stored by :meth:`put_iter`
+                  or None
+        """
+        path = self.path(key)
+        try:
+            f = open(path, 'rb')
+        except FileNotFoundError:  # not cached or just evicted
+            return
+        if not _is_private(os.fstat(f.fileno())):
+            f.close()
+            return  # not written by us, do not unpickle it
+        os.utime(path)  # mark the file as recently used
+        return _load_all(f)
+
+    def evict(self):
+        """
+        Remove the least recently used files until the total size
+        is below `maxbytes`
+        """
+        stats = []
+        for fname in os.listdir(self.dirname):
+            if fname.endswith('.pik'):
+                path = os.path.join(self.dirname, fname)
+                try:
+                    stats.append((os.stat(path), path))
+                except FileNotFoundError:  # removed by another process
+                    pass
+        stats.sort(key=lambda sp: sp[0].st_mtime)
+        nbytes = sum(st.st_size for st, _ in stats)
+        for st, path in stats:
+            if nbytes <= self.maxbytes:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            nbytes -= st.st_size
+
+    def __len__(self):
+        return sum(1 for f in os.listdir(self.dirname) if f.endswith('.pik'))
+
+
+def _load_all(f):
+    # yield the objects pickled one after the other in the file
+    with f:
+        while True:
+            try:
+                yield pickle.load(f)
+            except EOFError:
+                return
+
+
+def get_product_cache():
+    """
+    :returns: a ProductCache if `cache_dir` is set in openquake.cfg, else None
+    """
+    dirname = config.directory.get('cache_dir')
+    if dirname:
+        return ProductCache(os.path.expanduser(dirname),
+                            int(config.directory.get('cache_size', 0))
+                            * 1024 ** 2)
+
+
 class DataStore(collections.abc.MutableMapping):
     """
     DataStore class to store the inputs/outputs of a calculation on the
@@ -219,6 +514,8 @@ class DataStore(collections.abc.MutableMapping):
         if self.mode == 'r' and not os.path.exists(self.filename):
             raise IOError('File not found: %s' % self.filename)
         self.hdf5 = ()  # so that `key in self.hdf5` is valid
+        self.appenders = {}  # populated by .appender
+        self.sidecars = {}  # populated by .sidecar
         self.open(self.mode)
 
     def open(self, mode):
@@ -254,19 +551,72 @@ class DataStore(collections.abc.MutableMapping):
 
     def swmr_on(self):
         """
-        Enable the SWMR mode on the underlying HDF5 file
+        Enable the SWMR mode on the underlying HDF5 file and sidecars
         """
         self.close()  # flush everything
         self.open('a')
-        try:
-            self.hdf5.swmr_mode = True
-        except ValueError:  # already set
-            pass
+        for name in self.sidecar_names():
+            if name in self.hdf5:
+                self.sidecar(name)
+        for h5 in [self.hdf5] + list(self.sidecars.values()):
+            try:
+                h5.swmr_mode = True
+            except ValueError:  # already set
+                pass
+
+    def sidecar_names(self):
+        """
+        :returns: the names of the top level datasets or groups stored
+                  in sidecar files, from the sidecars configuration
+        """
+        return config.directory.get('sidecars', '').split()
+
+    def sidecar(self, key):
+        """
+        :param key: a key in the datastore
+        :returns: the sidecar file where the key is stored, or None
+
+        The sidecar file is created the first time and linked in the
+        main file with an external link, so that readers see no difference.
+        """
+        name = key.lstrip('/').split('/')[0]
+        if name in self.sidecars:
+            return self.sidecars[name]
+        elif name not in self.sidecar_names():
+            return
+        link = self.hdf5.get(name, getlink=True)
+        if link is not None and not isinstance(link, h5py.ExternalLink):
+            return  # stored in the main file by a previous version
+        fname = '%s_%s.hdf5' % (self.filename[:-5], name)
+        h5 = self.sidecars[name] = hdf5.File(fname, 'a')
+        if link is None:
+            h5.require_group(name)
+            # the path is relative, so the files can be moved together
+            self.hdf5[name] = h5py.ExternalLink(
+                os.path.basename(fname), '/' + name)
+        return h5
+
+    def sidecar_files(self):
+        """
+        :returns: the paths of the existing sidecar files
+        """
+        if not self.hdf5:
+            return []
+        dirname = os.path.dirname(self.filename)
+        fnames = []
+        for name in self.hdf5:
+            link = self.hdf5.get(name, getlink=True)
+            if isinstance(link, h5py.ExternalLink):
+                fname = os.path.join(dirname, link.filename)
+                if os.path.exists(fname):
+                    fnames.append(fname)
+        return fnames
 
     def set_attrs(self, key, **kw):
         """
         Set the HDF5 attributes of the given key
         """
+        read_cache.invalidate(self.calc_id, key)
         self.hdf5.save_attrs(key, kw)
 
     def get_attr(self, key, name, default=None):
@@ -304,7 +654,7 @@ class DataStore(collections.abc.MutableMapping):
         return dict(dset.attrs)
 
     def create_dset(self, key, dtype, shape=(None,), compression=None,
-                    fillvalue=0, attrs=None):
+                    fillvalue=0, attrs=None, chunks=True):
         """
         Create a one-dimensional HDF5 dataset.
 
@@ -313,10 +663,24 @@ class DataStore(collections.abc.MutableMapping):
         :param shape: shape of the dataset, possibly extendable
         :param compression: the kind of HDF5 compression to use
         :param attrs: dictionary of attributes of the dataset
+        :param chunks: chunk shape of an extendable dataset
         :returns: a HDF5 dataset
         """
-        return hdf5.create(
-            self.hdf5, key, dtype, shape, compression, fillvalue, attrs)
+        read_cache.invalidate(self.calc_id, key)
+        return hdf5.create(self.sidecar(key) or self.hdf5, key, dtype, shape,
+                           compression, fillvalue, attrs, chunks)
+
+    def appender(self, key, nbytes=hdf5.BUFFER_BYTES):
+        """
+        :param key: name of an extendable dataset
+        :param nbytes: size of the buffer in bytes
+        :returns:
+            a :class:`openquake.baselib.hdf5.Appender` for the dataset,
+            flushed when the datastore is flushed or closed
+        """
+        if key not in self.appenders:
+            self.appenders[key] = hdf5.Appender(self.getitem(key), nbytes)
+        return self.appenders[key]
 
     def save(self, key, kw):
         """
@@ -363,9 +727,13 @@ class DataStore(collections.abc.MutableMapping):
         return self.export_path(fname, export_dir)
 
     def flush(self):
-        """Flush the underlying hdf5 file"""
+        """Flush the appenders and the underlying hdf5 file"""
         if self.parent != ():
             self.parent.flush()
+        for app in self.appenders.values():
+            app.flush()
+        for h5 in self.sidecars.values():
+            h5.flush()
         if self.hdf5:  # is open
             self.hdf5.flush()
 
@@ -374,15 +742,24 @@ class DataStore(collections.abc.MutableMapping):
         if self.parent != ():
             self.parent.flush()
             self.parent.close()
+        for app in self.appenders.values():
+            app.flush()
+        self.appenders.clear()  # the datasets will be invalid
+        for h5 in self.sidecars.values():
+            h5.close()
+        self.sidecars.clear()
         if self.hdf5:  # is open
             self.hdf5.flush()
             self.hdf5.close()
             self.hdf5 = ()
 
     def clear(self):
-        """Remove the datastore from the file system"""
+        """Remove the datastore and its sidecars from the file system"""
+        self.open('r')
+        fnames = [self.filename] + self.sidecar_files()
         self.close()
-        os.remove(self.filename)
+        for fname in fnames:
+            os.remove(fname)
 
     def getsize(self, key=None):
         """
@@ -390,7 +767,8 @@ class DataStore(collections.abc.MutableMapping):
         If no key is given, returns the total size of all files.
         """
         if key is None:
-            return os.path.getsize(self.filename)
+            return sum(os.path.getsize(fname) for fname in
+                       [self.filename] + self.sidecar_files())
         return hdf5.ByteCounter.get_nbytes(
             h5py.File.__getitem__(self.hdf5, key))
 
@@ -430,43 +808,90 @@ class DataStore(collections.abc.MutableMapping):
         data = bytes(numpy.asarray(self[key][()]))
         return io.BytesIO(gzip.decompress(data))
 
-    def read_df(self, key, index=None):
-        """
-        :param key: name of the structured dataset
-        :param index: if given, name of the "primary key" field
-        :returns: pandas DataFrame associated to the dataset
-        """
+    def _getdset(self, key):
+        # get the dataset from the datastore or from its parent
         try:
-            dset = self.getitem(key)
+            return self.getitem(key)
         except KeyError:
             if self.parent:
-                dset = self.parent.getitem(key)
+                return self.parent.getitem(key)
+            raise
+
+    def cached(self, key, read=None):
+        """
+        :param key: the key of a dataset or group, or the name of the
+                    object returned by `read`
+        :param read: a module-level function dstore -> object or None
+        :returns: read(dstore) or the object/array stored in key, taken
+                  from the read cache of the current process if already
+                  read; it must not be modified (the arrays are
+                  read-only, the DataFrames are copies)
+        """
+        return read_cache.get(self, key, read)
+
+    def read_columns(self, key, columns=None, sel=slice(None)):
+        """
+        Read the fields of a structured dataset as separate arrays, without
+        building an intermediate record array. Contiguous and uncompressed
+        datasets are memory-mapped, so that the arrays are views on the
+        file; otherwise h5py reads only the requested fields and rows.
+        Vector fields are split in scalar columns `name_0, name_1, ...`.
+
+        :param key: name of the structured dataset
+        :param columns: names of the fields to read (default all)
+        :param sel: a slice or a boolean mask to select the rows
+        :returns: a dictionary column name -> array
+        """
+        dset = self._getdset(key)
+        mask = None
+        if isinstance(sel, numpy.ndarray) and sel.dtype == bool:
+            # read only the rows between the first and the last selected
+            idxs, = sel.nonzero()
+            if len(idxs):
+                start, stop = idxs[0], idxs[-1] + 1
             else:
-                raise
-        if len(dset) == 0:
-            raise self.EmptyDataset('Dataset %s is empty' % key)
-        if 'shape_descr' in dset.attrs:
-            return dset2df(dset, index)
-        dtlist = []
-        for name in dset.dtype.names:
-            dt = dset.dtype[name]
-            if dt.shape:  # vector field
-                templ = name + '_%d' * len(dt.shape)
-                for i, _ in numpy.ndenumerate(numpy.zeros(dt.shape)):
-                    dtlist.append((templ % i, dt.base))
-            else:  # scalar field
-                dtlist.append((name, dt))
-        data = numpy.zeros(len(dset), dtlist)
-        for name in dset.dtype.names:
-            arr = dset[name]
+                start = stop = 0
+            mask = sel[start:stop]
+            sel = slice(start, stop)
+        mmap = hdf5.memmap(dset)
+        dic = {}
+        for name in columns or dset.dtype.names:
+            if mmap is None:
+                arr = dset[sel, name]
+            else:
+                arr = mmap[name][sel]
+            if mask is not None:
+                arr = arr[mask]
             dt = dset.dtype[name]
             if dt.shape:  # vector field
                 templ = name + '_%d' * len(dt.shape)
                 for i, _ in numpy.ndenumerate(numpy.zeros(dt.shape)):
-                    data[templ % i] = arr[(slice(None),) + i]
+                    dic[templ % i] = arr[(slice(None),) + i]
             else:  # scalar field
-                data[name] = arr
-        return pandas.DataFrame.from_records(data, index=index)
+                dic[name] = arr
+        return dic
+
+    def read_df(self, key, index=None, columns=None, sel=slice(None)):
+        """
+        :param key: name of the structured dataset
+        :param index: if given, name of the "primary key" field
+        :param columns: if given, names of the fields to read
+        :param sel: a slice or a boolean mask to select the rows
+        :returns: pandas DataFrame associated to the dataset
+        """
+        dset = self._getdset(key)
+        if len(dset) == 0:
+            raise self.EmptyDataset('Dataset %s is empty' % key)
+        if 'shape_descr' in dset.attrs:
+            return dset2df(dset, index)
+        if columns and index:  # make sure the index is read
+            idx = [index] if isinstance(index, str) else index
+            columns = [col for col in idx if col not in columns] + list(
+                columns)
+        df = pandas.DataFrame(self.read_columns(key, columns, sel))
+        if index is not None:
+            df.set_index(index, inplace=True)
+        return df
 
     @property
     def metadata(self):
@@ -500,13 +925,15 @@ class DataStore(collections.abc.MutableMapping):
             # arrays: is impossible to save twice the same key; so we remove
             # the key first, then it is possible to save it again
             del self[key]
+        read_cache.invalidate(self.calc_id, key)
         try:
-            self.hdf5[key] = val
+            (self.sidecar(key) or self.hdf5)[key] = val
         except RuntimeError as exc:
             raise RuntimeError('Could not save %s: %s in %s' %
                                (key, exc, self.filename))
 
     def __delitem__(self, key):
+        read_cache.invalidate(self.calc_id, key)
         del self.hdf5[key]
 
     def __enter__(self):
@@ -526,6 +953,8 @@ class DataStore(collections.abc.MutableMapping):
                     parent=self.parent,
                     calc_id=self.calc_id,
                     hdf5=(),
+                    appenders={},
+                    sidecars={},
                     filename=self.filename)
 
     def __iter__(self):
@@ -160,6 +160,22 @@ class WeightedSequence(MutableSequence):
         """
         return all(x == y for x, y in zip(self, other))
 
+    def split(self, n):
+        """
+        Split the sequence in (at most) n contiguous WeightedSequences;
+        the weight is divided proportionally to the number of items.
+
+        >>> ws = WeightedSequence([('a', 2), ('b', 2), ('c', 2)])
+        >>> for block in ws.split(2):
+        ...     print(block)
+        <WeightedSequence ['a', 'b'], weight=4.0>
+        <WeightedSequence ['c'], weight=2.0>
+        """
+        blocks = list(block_splitter(self._seq, math.ceil(len(self) / n)))
+        for block in blocks:
+            block.weight = self.weight * len(block) / len(self)
+        return blocks
+
     def __repr__(self):
         """
         String representation of the sequence, including the weight
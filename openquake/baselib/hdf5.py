@@ -52,8 +52,29 @@ def maybe_encode(value):
     return value
 
 
+CHUNK_BYTES = 256 * 1024  # target size of the chunks from get_chunks
+BUFFER_BYTES = 16 * 1024 ** 2  # default buffer size of the Appender
+READ_BYTES = 16 * 1024  # bytes costing as much as the overhead of a read
+
+
+def get_chunks(dtype, shape=(None,), nbytes=CHUNK_BYTES):
+    """
+    :param dtype: dtype of an extensible dataset
+    :param shape: shape of the dataset
+    :param nbytes: target size of a chunk in bytes
+    :returns: a chunk shape containing approximately nbytes per chunk
+
+    >>> get_chunks(numpy.float32)
+    (65536,)
+    >>> get_chunks(numpy.float32, (None, 4))
+    (16384, 4)
+    """
+    rowsize = numpy.dtype(dtype).itemsize * int(numpy.prod(shape[1:]))
+    return (max(nbytes // rowsize, 1),) + tuple(shape[1:])
+
+
 def create(hdf5, name, dtype, shape=(None,), compression=None,
-           fillvalue=0, attrs=None):
+           fillvalue=0, attrs=None, chunks=True):
     """
     :param hdf5: a h5py.File object
     :param name: an hdf5 key string
@@ -61,11 +82,14 @@ def create(hdf5, name, dtype, shape=(None,), compression=None,
     :param shape: shape of the dataset (can be extendable)
     :param compression: None or 'gzip' are recommended
     :param attrs: dictionary of attributes of the dataset
+    :param chunks:
+        chunk shape of an extendable dataset; by default it is guessed
+        by h5py, for big datasets use :func:`get_chunks`
     :returns: a HDF5 dataset
     """
     if shape[0] is None:  # extendable dataset
         dset = hdf5.create_dataset(
-            name, (0,) + shape[1:], dtype, chunks=True, maxshape=shape,
+            name, (0,) + shape[1:], dtype, chunks=chunks, maxshape=shape,
             compression=compression)
     else:  # fixed-shape dataset
         dset = hdf5.create_dataset(name, shape, dtype, fillvalue=fillvalue,
@@ -85,6 +109,24 @@ def preshape(obj):
     return ()
 
 
+def memmap(dset):
+    """
+    :param dset: an h5py dataset
+    :returns:
+        a read-only numpy.memmap on the data of the dataset if it is
+        contiguous and uncompressed, otherwise None
+    """
+    if (dset.chunks or dset.dtype.hasobject or not dset.shape or
+            dset.file.driver != 'sec2'):
+        return
+    dset.file.flush()  # make sure the data are on the disk
+    offset = dset.id.get_offset()
+    if offset is None:  # the storage is not allocated
+        return
+    return numpy.memmap(dset.file.filename, dset.dtype, 'r', offset,
+                        dset.shape)
+
+
 def extend(dset, array, **attrs):
     """
     Extend an extensible dataset with an array of a compatible dtype.
@@ -108,6 +150,79 @@ def extend(dset, array, **attrs):
     return newlength
 
 
+class Appender(object):
+    """
+    Buffered writer for an extensible dataset. The arrays passed to
+    .append are kept in memory and written when they exceed `nbytes`,
+    in blocks with a length multiple of the chunk length, so that the
+    dataset is resized only a few times and the chunks are written
+    entirely. The remaining rows are written by .flush, which is called
+    automatically when the Appender is used as a context manager.
+
+    >>> with File.temporary() as f:
+    ...     dset = create(f, 'data', numpy.float32, chunks=(4,))
+    ...     with Appender(dset, nbytes=32) as app:
+    ...         for i in range(5):
+    ...             n = app.append(numpy.arange(3, dtype=numpy.float32))
+    ...             print(len(dset), n)
+    ...     print(len(dset))
+    0 3
+    0 6
+    8 9
+    8 12
+    8 15
+    15
+    >>> os.remove(f.path)
+
+    :param dset: an extensible h5py dataset
+    :param nbytes: size of the buffer in bytes
+    """
+    def __init__(self, dset, nbytes=BUFFER_BYTES):
+        self.dset = dset
+        self.chunklen = dset.chunks[0] if dset.chunks else 1
+        rowsize = dset.dtype.itemsize * int(numpy.prod(dset.shape[1:]))
+        self.maxlen = max(nbytes // (rowsize * self.chunklen), 1) * (
+            self.chunklen)
+        self.arrays = []
+        self.buflen = 0
+
+    def append(self, array):
+        """
+        Add an array to the buffer and possibly write the buffer
+
+        :returns: the total length, i.e. dataset length + buffer length
+        """
+        if len(array):
+            self.arrays.append(array)
+            self.buflen += len(array)
+            if self.buflen >= self.maxlen:
+                self._write(self.buflen // self.chunklen * self.chunklen)
+        return len(self)
+
+    def _write(self, size):
+        data = numpy.concatenate(self.arrays)
+        extend(self.dset, data[:size])
+        rest = data[size:]
+        self.arrays = [rest] if len(rest) else []
+        self.buflen = len(rest)
+
+    def flush(self):
+        """
+        Write all the rows in the buffer
+        """
+        if self.buflen:
+            self._write(self.buflen)
+
+    def __len__(self):
+        return len(self.dset) + self.buflen
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, etype, exc, tb):
+        self.flush()
+
+
 class LiteralAttrs(object):
     """
     A class to serialize a set of parameters in HDF5 format. The goal is to
@@ -567,6 +682,33 @@ def decode_array(values):
     return out
 
 
+def _plan(idxs, gap):
+    """
+    :param idxs: indices along an axis, possibly unsorted and repeated
+    :param gap: gaps up to this size are read instead of being skipped
+    :returns: (runs, pos) where runs are the slices to read and pos are
+              the positions of the indices in the concatenated runs
+
+    >>> runs, pos = _plan([7, 1, 2, 7, 10], 1)
+    >>> runs
+    [slice(1, 3, None), slice(7, 8, None), slice(10, 11, None)]
+    >>> pos
+    array([2, 0, 1, 2, 3])
+    >>> _plan([7, 1, 2, 7, 10], 4)
+    ([slice(1, 3, None), slice(7, 11, None)], array([2, 0, 1, 2, 5]))
+    """
+    if len(idxs) == 0:
+        return [], numpy.zeros(0, int)
+    uniq, inv = numpy.unique(idxs, return_inverse=True)
+    brk = numpy.where(numpy.diff(uniq) > gap)[0] + 1
+    starts = uniq[numpy.r_[0, brk]]
+    stops = uniq[numpy.r_[brk - 1, len(uniq) - 1]] + 1
+    offsets = numpy.cumsum(stops - starts) - (stops - starts)
+    run = numpy.searchsorted(starts, uniq, 'right') - 1
+    pos = (uniq - starts[run] + offsets[run])[inv]
+    return [slice(a, b) for a, b in zip(starts.tolist(), stops.tolist())], pos
+
+
 def extract(dset, *d_slices):
     """
     :param dset: a D-dimensional dataset or array
@@ -580,38 +722,66 @@ def extract(dset, *d_slices):
     >>> extract(a, [0, 1], slice(1, 3))
     array([[2, 3],
            [5, 6]])
-    """
-    shp = list(dset.shape)
+    >>> extract(a, [1, 0, 1], [2, 0])
+    array([[6, 4],
+           [3, 1],
+           [6, 4]])
+
+    Contiguous datasets are memory-mapped and indexed like arrays.
+    For chunked datasets the lists of indices are coalesced into
+    contiguous runs, filling the gaps cheaper than a read and, for
+    compressed datasets, the gaps inside a chunk, so that each chunk
+    is decompressed once per combination of the runs on the other axes.
+    """
+    shp = dset.shape
     if len(shp) != len(d_slices):
         raise ValueError('Array with %d dimensions but %d slices' %
                          (len(shp), len(d_slices)))
-    sizes = []
-    slices = []
-    for i, slc in enumerate(d_slices):
-        if slc == slice(None):
-            size = shp[i]
-            slices.append([slice(None)])
-        elif hasattr(slc, 'start'):
-            size = slc.stop - slc.start
-            slices.append([slice(slc.start, slc.stop, 0)])
-        elif isinstance(slc, list):
-            size = len(slc)
-            slices.append([slice(s, s + 1, j) for j, s in enumerate(slc)])
+    idxs = []
+    for n, slc in zip(shp, d_slices):
+        if isinstance(slc, slice):
+            start, stop, _ = slc.indices(n)
+            idxs.append(numpy.arange(start, stop))
+        elif isinstance(slc, (list, numpy.ndarray)):
+            idxs.append(numpy.array(slc, int))
         elif isinstance(slc, Number):
-            size = 1
-            slices.append([slice(slc, slc + 1, 0)])
+            idxs.append(numpy.array([slc]))
         else:
-            size = shp[i]
-            slices.append([slc])
-        sizes.append(size)
-    array = numpy.zeros(sizes, dset.dtype)
-    for tup in itertools.product(*slices):
-        aidx = tuple(s if s.step is None
-                     else slice(s.step, s.step + s.stop - s.start)
-                     for s in tup)
-        sel = tuple(s if s.step is None else slice(s.start, s.stop)
-                    for s in tup)
-        array[aidx] = dset[sel]
+            idxs.append(numpy.arange(n))
+    if isinstance(dset, h5py.Dataset):
+        arr = memmap(dset)
+        if arr is not None:
+            dset = arr
+    if isinstance(dset, numpy.ndarray):
+        return numpy.asarray(dset[numpy.ix_(*idxs)])
+    nbytes = dset.dtype.itemsize * numpy.prod([len(i) for i in idxs])
+    plans = []  # (runs, pos) for each axis
+    for i, (slc, idx) in enumerate(zip(d_slices, idxs)):
+        if isinstance(slc, (list, numpy.ndarray)):
+            gap = READ_BYTES * len(idx) // max(nbytes, 1)
+            if dset.compression:
+                gap = max(gap, dset.chunks[i])
+            plans.append(_plan(idx, max(gap, 1)))
+        elif len(idx):
+            plans.append(([slice(idx[0], idx[-1] + 1)], None))
+        else:  # empty slice
+            plans.append(([], None))
+    srcdst = []  # pairs (what to read, where to store it) for each axis
+    for runs, pos in plans:
+        pairs, n = [], 0
+        for r in runs:
+            pairs.append((r, slice(n, n + r.stop - r.start)))
+            n += r.stop - r.start
+        srcdst.append(pairs)
+    array = numpy.zeros([sum(r.stop - r.start for r in runs)
+                         for runs, pos in plans], dset.dtype)
+    for tup in itertools.product(*srcdst):
+        array[tuple(dst for src, dst in tup)] = dset[
+            tuple(src for src, dst in tup)]
+    for i, (runs, pos) in enumerate(plans):
+        if pos is not None and not numpy.array_equal(
+                pos, numpy.arange(array.shape[i])):
+            array = array.take(pos, axis=i)
     return array
 
 
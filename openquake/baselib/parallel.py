@@ -145,12 +145,19 @@ import sys
 import time
 import socket
 import signal
+import zlib
+import queue
+import mmap
 import pickle
 import inspect
+import heapq
+import bisect
 import logging
 import operator
 import itertools
+import threading
 import traceback
+import uuid
 import collections
 import multiprocessing.dummy
 import psutil
@@ -164,14 +171,15 @@ except ImportError:
 from openquake.baselib import config, hdf5, workerpool, __version__
 from openquake.baselib.zeromq import zmq, Socket
 from openquake.baselib.performance import (
-    Monitor, memory_rss, init_performance)
+    Monitor, Sampler, memory_rss, init_performance, save_profile)
 from openquake.baselib.general import (
     split_in_blocks, block_splitter, AccumDict, humansize, CallableDict,
-    gettemp)
+    gettemp, WeightedSequence)
 
 sys.setrecursionlimit(1200)  # raised a bit to make pickle happier
 # see https://github.com/gem/oq-engine/issues/5230
 submit = CallableDict()
+MB = 1024 ** 2
 GB = 1024 ** 3
 # use only the "visible" cores, not the total system cores
 # if the underlying OS supports it (macOS does not)
@@ -179,6 +187,8 @@ try:
     CT = len(psutil.Process().cpu_affinity()) * 2
 except AttributeError:
     CT = psutil.cpu_count() * 2
+# task arguments bigger than that are shared in processpool mode
+SHARED_MIN_BYTES = 1024 ** 2
 
 
 @submit.add('no')
@@ -210,7 +220,12 @@ def zmq_submit(self, func, args, monitor):
         task_input_url = 'tcp://127.0.0.1:%d' % port
         self.sender = Socket(
             task_input_url, zmq.PUSH, 'connect').__enter__()
-    return self.sender.send((func, args, self.task_no, monitor))
+    # the tasks with the same locality are sent preferably to the same hosts
+    key = next((arg.locality for arg in args
+                if getattr(arg, 'locality', None)), '')
+    payload = pickle.dumps((func, args, self.task_no, monitor),
+                           pickle.HIGHEST_PROTOCOL)
+    return self.sender.zsocket.send_multipart([key.encode('utf8'), payload])
 
 
 @submit.add('dask')
@@ -238,14 +253,28 @@ class Pickled(object):
     of the pickled bytestring.
 
     :param obj: the object to pickle
+    :param compress_above:
+        if positive, compress with zlib the pickles larger than that
+        (in bytes), if the compression is effective
     """
-    def __init__(self, obj):
+    compressed = False
+
+    def __init__(self, obj, compress_above=0):
         self.clsname = obj.__class__.__name__
         self.calc_id = str(getattr(obj, 'calc_id', ''))  # for monitors
+        self.weight = getattr(obj, 'weight', 1)  # used by the scheduler
+        # used by the zmq dispatcher, see workerpool.Dispatcher
+        self.locality = getattr(obj, 'locality', None)
         try:
             self.pik = pickle.dumps(obj, pickle.HIGHEST_PROTOCOL)
         except TypeError as exc:  # can't pickle, show the obj in the message
             raise TypeError('%s: %s' % (exc, obj))
+        self.size = len(self.pik)  # uncompressed size
+        if compress_above > 0 and self.size > compress_above:
+            pik = zlib.compress(self.pik, 1)  # the fastest level
+            if len(pik) < self.size:
+                self.pik = pik
+                self.compressed = True
 
     def __repr__(self):
         """String representation of the pickled object"""
@@ -258,9 +287,77 @@ class Pickled(object):
 
     def unpickle(self):
         """Unpickle the underlying object"""
+        if self.compressed:
+            return pickle.loads(zlib.decompress(self.pik))
         return pickle.loads(self.pik)
 
 
+class SharedPickled(Pickled):
+    """
+    A reference to a pickled object stored in a :class:`SharedStore`.
+    Only the reference is sent to the workers, which read the pickled
+    bytes directly from the shared memory.
+
+    :param pickled: a :class:`Pickled` instance
+    :param fname: the path of the file containing the pickled bytes
+    :param offset: the position of the pickled bytes in the file
+    """
+    def __init__(self, pickled, fname, offset):
+        self.clsname = pickled.clsname
+        self.calc_id = pickled.calc_id
+        self.weight = pickled.weight
+        self.fname = fname
+        self.offset = offset
+        self.size = len(pickled)
+
+    def __repr__(self):
+        """String representation of the shared object"""
+        return '<SharedPickled %s #%s %s>' % (
+            self.clsname, self.calc_id, humansize(len(self)))
+
+    def __len__(self):
+        """Length of the pickled bytestring"""
+        return self.size
+
+    def unpickle(self):
+        """Unpickle the underlying object without copying the bytes"""
+        with open(self.fname, 'rb') as f, mmap.mmap(
+                f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            with memoryview(mm) as view:
+                return pickle.loads(view[self.offset:self.offset + self.size])
+
+
+class SharedStore(object):
+    """
+    An append-only store of pickled objects, living in /dev/shm if
+    available, otherwise in the temporary directory. It is used in
+    processpool mode to serialize only once the large arguments shared
+    by many tasks.
+    """
+    def __init__(self):
+        shm = '/dev/shm' if os.path.isdir('/dev/shm') else None
+        self.fname = gettemp(dir=shm, prefix='oq-', suffix='.pik')
+        self.file = open(self.fname, 'wb')
+        self.offset = 0
+
+    def add(self, pickled):
+        """
+        :param pickled: a :class:`Pickled` instance
+        :returns: a :class:`SharedPickled` instance
+        """
+        self.file.write(pickled.pik)
+        self.file.flush()
+        shared = SharedPickled(pickled, self.fname, self.offset)
+        self.offset += len(pickled)
+        return shared
+
+    def close(self):
+        """Close and remove the underlying file"""
+        self.file.close()
+        if os.path.exists(self.fname):
+            os.remove(self.fname)
+
+
 def get_pickled_sizes(obj):
     """
     Return the pickled sizes of an object and its direct attributes,
@@ -326,16 +423,20 @@ class Result(object):
     func = None
 
     def __init__(self, val, mon, tb_str='', msg=''):
+        t0 = time.time()
+        # big outputs are compressed if the master asked for it
+        compress = getattr(mon, 'compress_above', 0)
         if isinstance(val, dict):
-            self.pik = Pickled(val)
+            self.pik = Pickled(val, compress)
             self.nbytes = {k: len(Pickled(v)) for k, v in val.items()}
         elif isinstance(val, tuple) and callable(val[0]):
             self.func = val[0]
             self.pik = pickle_sequence(val[1:])
             self.nbytes = {'tot': sum(len(p) for p in self.pik)}
         else:
-            self.pik = Pickled(val)
-            self.nbytes = {'tot': len(self.pik)}
+            self.pik = Pickled(val, compress)
+            self.nbytes = {'tot': self.pik.size}
+        self.pik_sec = time.time() - t0
         self.mon = mon
         self.tb_str = tb_str
         self.msg = msg
@@ -344,7 +445,7 @@ class Result(object):
         """
         Returns the underlying value or raise the underlying exception
         """
-        val = self.pik.unpickle()
+        val = self.unpickle()
         if self.tb_str:
             etype = val.__class__
             msg = '\n%s%s: %s' % (self.tb_str, etype.__name__, val)
@@ -354,6 +455,16 @@ class Result(object):
                 raise etype(msg)
         return val
 
+    def unpickle(self):
+        """
+        Unpickle the underlying value, only once
+        """
+        if not hasattr(self, 'val'):
+            t0 = time.time()
+            self.val = self.pik.unpickle()
+            self.unpik_sec = time.time() - t0
+        return self.val
+
     def __repr__(self):
         nbytes = ['%s: %s' % (k, humansize(v)) for k, v in self.nbytes.items()]
         return '<%s %s>' % (self.__class__.__name__, ' '.join(nbytes))
@@ -399,6 +510,72 @@ def check_mem_usage(soft_percent=None, hard_percent=None):
         return msg % (used_mem_percent, socket.gethostname())
 
 
+class TaskMemoryError(MemoryError):
+    """
+    Raised when a task allocates more memory than task_mem_limit
+    """
+
+
+class MemoryBudget(object):
+    """
+    Context manager keeping track of the peak memory allocated by the
+    current process (in bytes) since it was entered. If a positive budget
+    is given, the memory is sampled every `interval` seconds with a
+    SIGALRM timer (only in the main thread on POSIX systems) and a
+    TaskMemoryError is raised when the budget is exceeded while the
+    flag .active is True.
+
+    :param budget: maximum memory that can be allocated (in bytes)
+    :param interval: sampling interval (in seconds)
+    """
+    def __init__(self, budget=0, interval=.1):
+        self.budget = budget
+        self.interval = interval
+        self.peak = 0
+        self.active = False
+        self.exceeded = False
+
+    def check(self, *args):
+        """
+        Update the peak memory and raise a TaskMemoryError if needed
+        """
+        mem = memory_rss(os.getpid()) - self.start
+        self.peak = max(self.peak, mem)
+        if self.active and self.budget and mem > self.budget:
+            self.active = False
+            self.exceeded = True
+            raise TaskMemoryError(
+                'The task allocated %s, more than task_mem_limit=%s' %
+                (humansize(mem), humansize(self.budget)))
+
+    def __enter__(self):
+        self.start = memory_rss(os.getpid())
+        self.timer = (self.budget > 0 and hasattr(signal, 'setitimer') and
+                      threading.current_thread() is threading.main_thread())
+        if self.timer:
+            self.handler = signal.signal(signal.SIGALRM, self.check)
+            signal.setitimer(signal.ITIMER_REAL, self.interval, self.interval)
+        return self
+
+    def __exit__(self, etype, exc, tb):
+        if self.timer:
+            signal.setitimer(signal.ITIMER_REAL, 0)
+            signal.signal(signal.SIGALRM, self.handler)
+
+
+def splittable(arg):
+    """
+    :param arg: the first argument of a task
+    :returns:
+        True if the argument has more than one element and implements the
+        protocol .split(n) returning up to n objects of the same kind, like
+        WeightedSequence (the blocks returned by block_splitter and
+        split_in_blocks) and the RuptureGetters of the calculators
+    """
+    return (callable(getattr(arg, 'split', None)) and
+            not isinstance(arg, (str, bytes)) and len(arg) > 1)
+
+
 dummy_mon = Monitor()
 dummy_mon.version = __version__
 dummy_mon.backurl = None
@@ -427,31 +604,92 @@ def safely_call(func, args, task_no=0, mon=dummy_mon):
     mon = mon.new(operation='total ' + func.__name__, measuremem=True)
     mon.weight = getattr(args[0], 'weight', 1.)  # used in task_info
     mon.task_no = task_no
+    # telemetry saved in task_info
+    mon.start = time.time()
+    mon.queued = mon.start - getattr(mon, 'sent_time', mon.start)
+    mon.first_res = numpy.nan
+    mon.pik_sec = 0
+    mon.pid = os.getpid()
+    mon.host = socket.gethostname()
+    mon.costs = CostModel()  # populated by split_task, if used
+    taskargs = tuple(args)  # without the monitor
     if mon.inject:
         args += (mon,)
-    sentbytes = 0
-    with Socket(mon.backurl, zmq.PUSH, 'connect') as zsocket:
-        msg = check_mem_usage()  # warn if too much memory is used
-        if msg:
-            zsocket.send(Result(None, mon, msg=msg))
+    # measure the time spent blocked waiting for the master to be ready
+    send_mon = mon('sending outputs')
+    budget = MemoryBudget(getattr(mon, 'task_mem_limit', 0))
+    sampler = Sampler(getattr(mon, 'profile_interval', 0))
+    with Socket(mon.backurl, zmq.PUSH, 'connect',
+                hwm=getattr(mon, 'hwm', None),
+                send_timeout=getattr(mon, 'send_timeout', None)
+                ) as zsocket, budget, sampler:
         if inspect.isgeneratorfunction(func):
             it = func(*args)
         else:
             def gen(*args):
                 yield func(*args)
             it = gen(*args)
-        while True:
-            # StopIteration -> TASK_ENDED
-            res = Result.new(next, (it,), mon, sentbytes)
-            try:
+        try:
+            _send_outputs(zsocket, func, it, taskargs, mon, send_mon,
+                          budget, sampler)
+        except zmq.Again:
+            # the master did not receive for send_timeout ms, it is
+            # assumed dead or no more interested in the outputs
+            it.close()
+            logging.warning('Task %s #%d aborted, since the master is not '
+                            'receiving its outputs', func.__name__, task_no)
+
+
+def _send_outputs(zsocket, func, it, taskargs, mon, send_mon, budget,
+                  sampler):
+    # send the outputs of the task to the master; raise zmq.Again if
+    # the master is not receiving anymore
+    sentbytes = 0
+    msg = check_mem_usage()  # warn if too much memory is used
+    if msg:
+        zsocket.send(Result(None, mon, msg=msg))
+    # the task can be aborted only if its first argument can be split
+    abortable = splittable(taskargs[0])
+
+    def next_output(it):
+        # the task can be aborted only if no outputs were sent yet
+        budget.active = abortable and sentbytes == 0
+        try:
+            return next(it)
+        finally:
+            budget.active = False
+    while True:
+        # StopIteration -> TASK_ENDED
+        res = Result.new(next_output, (it,), mon, sentbytes)
+        mon.pik_sec += res.pik_sec
+        if not res.msg and numpy.isnan(mon.first_res):
+            mon.first_res = time.time() - mon.start
+        budget.check()
+        mon.peak_mem = budget.peak
+        if budget.exceeded:
+            # resubmit the task in two halves and end it
+            it.close()
+            blocks = taskargs[0].split(2)
+            for block in blocks:
+                zsocket.send(Result((func, block) + taskargs[1:], mon))
+            mon.split = len(blocks)
+            res = Result(None, mon, msg='TASK_ENDED')
+            res.pik = FakePickle(sentbytes)
+        if res.msg == 'TASK_ENDED' and sampler.stacks:
+            mon.stacks = sampler.stacks  # sent only at the end
+        res.sent_time = time.time()  # used to measure the queue depth
+        try:
+            with send_mon:
                 zsocket.send(res)
-            except Exception:  # like OverflowError
-                _etype, exc, tb = sys.exc_info()
-                err = Result(exc, mon, ''.join(traceback.format_tb(tb)))
-                zsocket.send(err)
-            sentbytes += len(res.pik)
-            if res.msg == 'TASK_ENDED':
-                break
+        except zmq.Again:
+            raise
+        except Exception:  # like OverflowError
+            _etype, exc, tb = sys.exc_info()
+            err = Result(exc, mon, ''.join(traceback.format_tb(tb)))
+            zsocket.send(err)
+        sentbytes += len(res.pik)
+        if res.msg == 'TASK_ENDED':
+            break
 
 
 if oq_distribute().startswith('celery'):
@@ -466,6 +704,134 @@ elif oq_distribute() == 'dask':
     from dask.distributed import Client
 
 
+def _items(arg):
+    # the keys and the values of a dict or list argument, used to detect
+    # the changes; None for the other arguments
+    if isinstance(arg, dict):
+        return list(arg), list(arg.values())
+    elif isinstance(arg, list):
+        return None, list(arg)
+
+
+def _same_items(items1, items2):
+    # True if the keys are equal and the values are the same objects
+    if items1 is None or items2 is None:
+        return items1 is items2
+    (keys1, vals1), (keys2, vals2) = items1, items2
+    return (keys1 == keys2 and len(vals1) == len(vals2) and
+            all(v1 is v2 for v1, v2 in zip(vals1, vals2)))
+
+
+class QueueDepth(object):
+    """
+    Measure how many outputs were queued ahead of each output received by
+    the master, i.e. the number of outputs received between the moment it
+    was sent and the moment it was received. The clocks of the workers
+    and of the master are assumed to be in sync, as for the `queued`
+    field of task_info.
+    """
+    def __init__(self):
+        self.recv_times = []  # sorted, since they are taken by the master
+        self.sent_times = {}  # task_no -> submission time
+        self.max_queued = {}  # task_no -> max number of outputs ahead
+        self.maximum = 0
+
+    def submitted(self, task_no, sent_time):
+        """
+        Register the submission time of a task
+        """
+        self.sent_times[task_no] = sent_time
+
+    def received(self, res):
+        """
+        Register the reception of an output and return the number of
+        outputs that were queued ahead of it
+        """
+        now = time.time()
+        sent = getattr(res, 'sent_time', now)
+        n = len(self.recv_times) - bisect.bisect_right(self.recv_times, sent)
+        self.recv_times.append(now)
+        task_no = res.mon.task_no
+        self.max_queued[task_no] = max(self.max_queued.get(task_no, 0), n)
+        self.maximum = max(self.maximum, n)
+        return n
+
+    def ended(self, task_no):
+        """
+        Forget about the given task and return the maximum number of
+        outputs that were queued ahead of its outputs
+        """
+        self.sent_times.pop(task_no, None)
+        if self.sent_times:  # the older receptions cannot matter anymore
+            t = min(self.sent_times.values())
+            del self.recv_times[:bisect.bisect_left(self.recv_times, t)]
+        return self.max_queued.pop(task_no, 0)
+
+
+class Prefetcher(threading.Thread):
+    """
+    Receive the Result objects from a PULL socket in a separate thread,
+    unpickling the outputs in advance, and yield them in the same order.
+    In this way the receiving and unpickling of the next outputs overlaps
+    with the processing of the previous ones (typically the aggregation
+    function writing on the datastore). While the thread is running it is
+    the only one reading from the socket; the submission of the tasks and
+    the writes on the datastore stay in the main thread. The exceptions
+    raised in the thread are re-raised in the main thread.
+
+    :param socket: a :class:`Socket` instance, already entered
+    :param maxsize: the maximum number of outputs unpickled in advance
+    :param poll_ms: how often (in milliseconds) the stop flag is checked
+    """
+    def __init__(self, socket, maxsize, poll_ms=100):
+        super().__init__(daemon=True)
+        self.socket = socket
+        self.queue = queue.Queue(maxsize)
+        self.stopped = threading.Event()
+        self.poll_ms = poll_ms
+
+    def _put(self, obj):
+        # wait for a free slot in the queue, unless the thread is stopped
+        while not self.stopped.is_set():
+            try:
+                self.queue.put(obj, timeout=self.poll_ms / 1000)
+                return
+            except queue.Full:
+                pass
+
+    def run(self):
+        zsocket = self.socket.zsocket
+        try:
+            while not self.stopped.is_set():
+                if not zsocket.poll(self.poll_ms):
+                    continue
+                res = zsocket.recv_pyobj()
+                if not res.func:
+                    try:
+                        res.unpickle()
+                    except Exception:
+                        pass  # raised again in the main thread by .get
+                self._put(res)
+        except BaseException as exc:
+            self._put(exc)
+
+    def __iter__(self):
+        self.start()
+        while True:
+            res = self.queue.get()
+            if isinstance(res, BaseException):
+                raise res
+            yield res
+
+    def stop(self):
+        """
+        Stop the thread and wait for its termination
+        """
+        self.stopped.set()
+        if self.is_alive():
+            self.join()
+
+
 class IterResult(object):
     """
     :param iresults:
@@ -490,6 +856,13 @@ class IterResult(object):
         self.h5 = h5
 
     def _iter(self):
+        try:
+            yield from self._gen_values()
+        finally:  # release the resources of the underlying loop
+            if hasattr(self.iresults, 'close'):
+                self.iresults.close()
+
+    def _gen_values(self):
         first_time = True
         for result in self.iresults:
             msg = check_mem_usage()
@@ -505,7 +878,11 @@ class IterResult(object):
                     self.received.append(sum(len(p) for p in result.pik))
                 else:
                     val = result.get()
+                    self.unpik_sec[result.mon.task_no] += getattr(
+                        result, 'unpik_sec', 0)
                     self.received.append(len(result.pik))
+                    if getattr(result.pik, 'compressed', False):
+                        self.saved += result.pik.size - len(result.pik)
                     if hasattr(result, 'nbytes'):
                         self.nbytes += result.nbytes
             else:  # this should never happen
@@ -524,6 +901,8 @@ class IterResult(object):
                 del self.h5['task_sent']
                 self.h5['task_sent'] = str(task_sent)
                 name = result.mon.operation[6:]  # strip 'total '
+                result.mon.unpik_sec = self.unpik_sec.pop(
+                    result.mon.task_no, 0)
                 result.mon.save_task_info(self.h5, result, name, mem_gb)
                 result.mon.flush(self.h5)
                 self.h5.flush()
@@ -535,7 +914,9 @@ class IterResult(object):
             return ()
         t0 = time.time()
         self.received = []
+        self.saved = 0  # bytes saved by compressing the outputs
         self.nbytes = AccumDict()
+        self.unpik_sec = AccumDict(accum=0)  # task_no -> unpickling time
         try:
             yield from self._iter()
         finally:
@@ -545,6 +926,10 @@ class IterResult(object):
                 'Received %s in %d seconds, biggest '
                 'output=%s', humansize(tot), time.time() - t0,
                 humansize(max_per_output))
+            if self.saved:
+                logging.info('Compression saved %s, i.e. %d%%',
+                             humansize(self.saved),
+                             self.saved / (self.saved + tot) * 100)
             if self.nbytes:
                 nb = {k: humansize(v) for k, v in self.nbytes.items()}
                 if len(nb) < 10:
@@ -553,8 +938,12 @@ class IterResult(object):
     def reduce(self, agg=operator.add, acc=None):
         if acc is None:
             acc = AccumDict()
-        for result in self:
-            acc = agg(acc, result)
+        it = iter(self)
+        try:
+            for result in it:
+                acc = agg(acc, result)
+        finally:  # make sure the underlying loop is closed
+            it.close()
         return acc
 
     @classmethod
@@ -590,6 +979,151 @@ def init_workers():
         prctl.set_pdeathsig(signal.SIGKILL)
 
 
+class CostModel(object):
+    """
+    A model estimating the duration of a computation from its weight,
+    by fitting online the time per unit of weight for each key (i.e.
+    the name of a task function or a kind of source).
+
+    :param dic: a dictionary key -> (weight, time), as returned by .to_dict
+    """
+    def __init__(self, dic=()):
+        self.weight = AccumDict(accum=0.)  # key -> total weight
+        self.time = AccumDict(accum=0.)  # key -> total duration
+        for key, (weight, duration) in dict(dic).items():
+            self.update(key, weight, duration)
+
+    def update(self, key, weight, duration):
+        """
+        Add a measurement to the model
+
+        :param key: the name of the task function or the kind of source
+        :param weight: the weight of the computation
+        :param duration: the duration of the computation in seconds
+        """
+        self.weight[key] += weight
+        self.time[key] += duration
+
+    def merge(self, other):
+        """
+        Add the measurements of another CostModel
+        """
+        for key in other.weight:
+            self.update(key, other.weight[key], other.time[key])
+
+    def dt(self, key):
+        """
+        :returns:
+            the time per unit of weight for the given key, or the average
+            on the other keys if the key is unknown, or None
+        """
+        if self.weight.get(key):
+            return self.time[key] / self.weight[key]
+        tot = sum(self.weight.values())
+        if tot:
+            return sum(self.time.values()) / tot
+
+    def predict(self, key, weight):
+        """
+        :returns: the expected duration of a computation, or NaN
+        """
+        dt = self.dt(key)
+        return numpy.nan if dt is None else weight * dt
+
+    def to_dict(self):
+        """
+        :returns: a dictionary key -> (weight, time)
+        """
+        return {key: (self.weight[key], self.time[key]) for key in self.weight}
+
+    def __repr__(self):
+        return '<%s %s>' % (self.__class__.__name__, ', '.join(
+            '%s=%.2g' % (key, self.dt(key)) for key in sorted(self.weight)))
+
+
+class TaskQueue(object):
+    """
+    A queue of pairs (func, args) returning the tasks in FIFO order.
+    Subclasses can override the scheduling policy by overriding the
+    methods `append` and `pop`.
+
+    :param pairs: an iterable of pairs (func, args)
+    :param cost_model: a :class:`CostModel` instance (or None)
+    """
+    def __init__(self, pairs=(), cost_model=None):
+        self.cost_model = cost_model or CostModel()
+        self.deque = collections.deque()
+        self.weight = AccumDict(accum=0)  # taskname -> weight in the queue
+        for pair in pairs:
+            self.append(pair)
+
+    def append(self, pair):
+        """Add a pair (func, args) to the queue"""
+        self.weight[pair[0].__name__] += get_weight(pair[1])
+        self.deque.append(pair)
+
+    def pop(self):
+        """Extract the next pair (func, args) to submit"""
+        pair = self.deque.popleft()
+        self.weight[pair[0].__name__] -= get_weight(pair[1])
+        return pair
+
+    def expected_time(self):
+        """
+        :returns: the expected time to run the tasks in the queue
+        """
+        return sum(self.cost_model.predict(name, weight)
+                   for name, weight in self.weight.items() if weight)
+
+    def __len__(self):
+        return len(self.deque)
+
+
+def get_weight(args):
+    """
+    :returns: the weight of the first argument of a task (default 1)
+    """
+    return getattr(args[0], 'weight', 1) if args else 1
+
+
+class LPTQueue(TaskQueue):
+    """
+    A queue returning the tasks in "Longest Processing Time first" order.
+    The expected duration of a task is computed as the weight of its first
+    argument times the time per unit of weight of the task function;
+    the latter is corrected online from the durations of the tasks already
+    finished (i.e. the same numbers stored in `task_info`).
+    """
+    def __init__(self, pairs=(), cost_model=None):
+        self.heaps = collections.defaultdict(list)  # taskname -> heap
+        self.counter = itertools.count()  # to break ties in FIFO order
+        self.length = 0
+        super().__init__(pairs, cost_model)
+
+    def append(self, pair):
+        name = pair[0].__name__
+        weight = get_weight(pair[1])
+        self.weight[name] += weight
+        heapq.heappush(self.heaps[name], (-weight, next(self.counter), pair))
+        self.length += 1
+
+    def pop(self):
+        expected, name = max(
+            (-heap[0][0] * (self.cost_model.dt(name) or 1.), name)
+            for name, heap in self.heaps.items() if heap)
+        self.length -= 1
+        weight, _, pair = heapq.heappop(self.heaps[name])
+        self.weight[name] += weight  # weight is negative
+        return pair
+
+    def __len__(self):
+        return self.length
+
+
+# scheduling policies for the Starmap
+scheduler = {'fifo': TaskQueue, 'lpt': LPTQueue}
+
+
 def getargnames(task_func):
     # a task can be a function, a class or an instance with a __call__
     if inspect.isfunction(task_func):
@@ -681,7 +1215,8 @@ class Starmap(object):
         ).submit_all()
 
     def __init__(self, task_func, task_args=(), distribute=None,
-                 progress=logging.info, h5=None, num_cores=None):
+                 progress=logging.info, h5=None, num_cores=None,
+                 scheduler='fifo'):
         self.__class__.init(distribute=distribute)
         self.task_func = task_func
         if h5:
@@ -698,6 +1233,8 @@ class Starmap(object):
         self.progress = progress
         self.h5 = h5
         self.num_cores = num_cores
+        self.scheduler = scheduler
+        self.tasks_per_core = config.distribution.get('tasks_per_core') or 4
         self.task_queue = []
         try:
             self.num_tasks = len(self.task_args)
@@ -710,8 +1247,18 @@ class Starmap(object):
         self.receiver = 'tcp://%s:%s' % (
             config.dbserver.listen, config.dbserver.receiver_ports)
         self.monitor.backurl = None  # overridden later
+        # used to discard the outputs of the tasks of another Starmap that
+        # was interrupted while its tasks were running on the same port
+        self.smap_id = uuid.uuid4().hex
         self.tasks = []  # populated by .submit
         self.task_no = 0
+        self.cache = {}  # id(arg) -> (arg, items of arg, pickled arg)
+        self.cost_model = CostModel()  # fitted on the finished tasks
+        self.profile = collections.Counter()  # stack -> number of samples
+        self.done_time = 0  # total duration of the finished tasks
+        self.shared = None  # SharedStore instance, used in processpool
+        self.prefetcher = None  # Prefetcher instance, if prefetch_outputs
+        self.queue_depth = QueueDepth()
         if self.distribute == 'zmq':  # add a check
             err = workerpool.check_status()
             if err:
@@ -740,13 +1287,37 @@ class Starmap(object):
 
     def submit(self, args, func=None, monitor=None):
         """
-        Submit the given arguments to the underlying task
+        Submit the given arguments to the underlying task. The arguments
+        after the first one are pickled only once per Starmap, so they
+        must not be mutated in place between two submits.
         """
         monitor = monitor or self.monitor
         func = func or self.task_func
         if not hasattr(self, 'socket'):  # first time
             self.__class__.running_tasks = self.tasks
-            self.socket = Socket(self.receiver, zmq.PULL, 'bind').__enter__()
+            # when the master is slower than the workers, the outputs
+            # are queued up to max_queued_outputs, then the workers block;
+            # NB: not when the tasks run in the master, it would deadlock
+            hwm = int(config.distribution.get('max_queued_outputs', 0))
+            inmaster = (self.num_tasks == 1 or self.distribute == 'no' or
+                        os.environ.get('OQ_TASK_NO'))
+            monitor.hwm = None if inmaster else hwm or None
+            # the tasks give up if the master does not receive their
+            # outputs for send_timeout seconds, i.e. if it has gone away
+            timeout = int(config.distribution.get('send_timeout', 0))
+            monitor.send_timeout = None if inmaster else (
+                timeout * 1000 or None)
+            # compress the outputs bigger than compress_outputs bytes
+            monitor.compress_above = 0 if inmaster else int(
+                config.distribution.get('compress_outputs', 0))
+            # sample the stacks of the tasks every profile_interval ms
+            monitor.profile_interval = float(
+                config.distribution.get('profile_interval', 0)) / 1000
+            # abort and resplit the tasks using more than task_mem_limit MB
+            monitor.task_mem_limit = 0 if inmaster else int(
+                config.memory.get('task_mem_limit', 0)) * MB
+            self.socket = Socket(self.receiver, zmq.PULL, 'bind',
+                                 hwm=monitor.hwm).__enter__()
             monitor.backurl = 'tcp://%s:%s' % (
                 config.dbserver.host, self.socket.port)
             monitor.version = __version__
@@ -759,18 +1330,58 @@ class Starmap(object):
             pickled = isinstance(args[0], Pickled)
             if not pickled:
                 assert not isinstance(args[-1], Monitor)  # sanity check
-                args = pickle_sequence(args)
+                args = self._pickle(args, dist)
             if func is None:
                 fname = self.task_func.__name__
                 argnames = self.argnames[:-1]
             else:
                 fname = func.__name__
                 argnames = getargnames(func)[:-1]
-            self.sent[fname] += {a: len(p) for a, p in zip(argnames, args)}
+            # shared arguments are not sent, only a reference to them is
+            self.sent[fname] += {a: 0 if isinstance(p, SharedPickled)
+                                 else len(p) for a, p in zip(argnames, args)}
+        # information used by split_task to split the task in subtasks
+        monitor.task_duration = self.get_task_duration()
+        monitor.cost_model = self.cost_model.to_dict()
+        # a copy, since the monitor may be pickled after the next submit
+        monitor = monitor.new(monitor.operation, sent_time=time.time(),
+                              smap_id=self.smap_id)
+        self.queue_depth.submitted(self.task_no, monitor.sent_time)
         res = submit[dist](self, func, args, monitor)
         self.task_no += 1
         self.tasks.append(res)
 
+    def _pickle(self, args, dist):
+        # the arguments after the first one are usually shared by many
+        # tasks, so they are pickled only once; in processpool mode the
+        # big ones are also stored in shared memory and sent by reference.
+        # NB: the cache is keyed by the identity of the arguments, so they
+        # must not be mutated in place between two submits; for dicts and
+        # lists the items are compared, so that rebinding a key is detected
+        out = [Pickled(args[0])]
+        for arg in args[1:]:
+            items = _items(arg)
+            try:
+                cached, olditems, pik = self.cache[id(arg)]
+            except KeyError:
+                pik = None
+            else:
+                if not _same_items(olditems, items):
+                    logging.debug('%s argument changed, pickling it again',
+                                  type(arg).__name__)
+                    pik = None
+            if pik is None:
+                pik = Pickled(arg)
+                if dist == 'processpool' and len(pik) >= SHARED_MIN_BYTES:
+                    if self.shared is None:
+                        self.shared = SharedStore()
+                    pik = self.shared.add(pik)
+                # keep a reference to arg (and to its items), so that its
+                # id cannot be reused while it is in the cache
+                self.cache[id(arg)] = arg, items, pik
+            out.append(pik)
+        return out
+
     def submit_all(self):
         """
         :returns: an IterResult object
@@ -799,34 +1410,108 @@ class Starmap(object):
     def __iter__(self):
         return iter(self.submit_all())
 
+    def _update_cost_model(self, mon):
+        name = mon.operation[6:]  # strip 'total '
+        # the prediction is stored in task_info, to be compared with
+        # the real duration
+        mon.predicted = self.cost_model.predict(name, mon.weight)
+        if getattr(mon, 'split', 0):  # aborted, the duration is meaningless
+            logging.warning('Task %s #%d allocated more than task_mem_limit, '
+                            'resubmitted in %d parts', name, mon.task_no,
+                            mon.split)
+            return
+        self.cost_model.update(name, mon.weight, mon.duration)
+        if hasattr(mon, 'costs'):  # measured by split_task
+            self.cost_model.merge(mon.costs)
+        self.done_time += mon.duration
+
+    def get_task_duration(self):
+        """
+        :returns:
+            the suggested duration of the tasks, so that the calculation
+            is split in `tasks_per_core` tasks per core, or None
+        """
+        if not isinstance(self.task_queue, TaskQueue):  # not started yet
+            return
+        expected = self.done_time + self.task_queue.expected_time()
+        if expected > 0:  # can be NaN if the cost model is empty
+            num_cores = self.num_cores or CT // 2
+            return expected / (num_cores * self.tasks_per_core)
+
+    def save_cost_model(self):
+        """
+        Save the cost model fitted on the tasks in the performance file
+        """
+        if 'cost_model' in self.h5:
+            dic = ast.literal_eval(self.h5['cost_model'][()])
+            del self.h5['cost_model']
+        else:
+            dic = {}
+        model = CostModel(dic)
+        model.merge(self.cost_model)
+        self.h5['cost_model'] = str(model.to_dict())
+
     def _submit_many(self, howmany):
         for _ in range(howmany):
             if self.task_queue:
-                # remove in LIFO order
-                func, args = self.task_queue[0]
-                del self.task_queue[0]
+                # remove in the order specified by the scheduler
+                func, args = self.task_queue.pop()
                 self.submit(args, func=func)
                 self.todo += 1
 
     def _loop(self):
+        try:
+            yield from self._iter_results()
+        finally:
+            # always run, even if the iteration was abandoned or the
+            # aggregation raised an error
+            if self.prefetcher:
+                self.prefetcher.stop()
+                self.prefetcher = None
+            if hasattr(self, 'socket'):
+                self.socket.__exit__(None, None, None)
+            self.tasks.clear()
+            self.cache.clear()
+            if self.shared:
+                logging.info('Shared %s of task arguments',
+                             humansize(self.shared.offset))
+                self.shared.close()
+                self.shared = None
+
+    def _iter_results(self):
         num_cores = self.num_cores or CT // 2
-        if self.task_queue:
-            first_args = self.task_queue[:num_cores]
-            self.task_queue[:] = self.task_queue[num_cores:]
-            for func, args in first_args:
-                self.submit(args, func=func)
+        if not isinstance(self.task_queue, TaskQueue):
+            self.task_queue = scheduler[self.scheduler](
+                self.task_queue, self.cost_model)
+        for _ in range(num_cores):
+            if not self.task_queue:
+                break
+            func, args = self.task_queue.pop()
+            self.submit(args, func=func)
         if not hasattr(self, 'socket'):  # no submit was ever made
-            return ()
+            return
 
-        isocket = iter(self.socket)
+        prefetch = int(config.distribution.get('prefetch_outputs', 0))
+        if prefetch:  # receive and unpickle in a separate thread
+            self.prefetcher = Prefetcher(self.socket, prefetch)
+            isocket = iter(self.prefetcher)
+        else:
+            isocket = iter(self.socket)
         self.todo = len(self.tasks)
         while self.todo:
             res = next(isocket)
             if self.calc_id != res.mon.calc_id:
                 logging.warning('Discarding a result from job %s, since this '
                                 'is job %d', res.mon.calc_id, self.calc_id)
+            elif getattr(res.mon, 'smap_id', None) != self.smap_id:
+                logging.debug('Discarding a result of an interrupted '
+                              '%s', res.mon.operation)
             elif res.msg == 'TASK_ENDED':
                 self.todo -= 1
+                self.queue_depth.received(res)
+                res.mon.max_queued = self.queue_depth.ended(res.mon.task_no)
+                self._update_cost_model(res.mon)
+                self.profile.update(getattr(res.mon, 'stacks', {}))
                 self._submit_many(1)
                 logging.debug('%d tasks todo, %d in queue',
                               self.todo, len(self.task_queue))
@@ -839,10 +1524,13 @@ class Starmap(object):
                 elif self.todo < self.num_cores:
                     self._submit_many(self.num_cores - self.todo)
             else:
+                self.queue_depth.received(res)
                 yield res
         self.log_percent()
-        self.socket.__exit__(None, None, None)
-        self.tasks.clear()
+        logging.debug('At most %d outputs were queued on the master',
+                      self.queue_depth.maximum)
+        self.save_cost_model()
+        save_profile(self.h5, self.profile)
 
 
 def sequential_apply(task, args, concurrent_tasks=CT,
@@ -862,29 +1550,77 @@ def count(word, mon):
     return collections.Counter(word)
 
 
-def split_task(func, *args, duration=1000,
-               weight=operator.attrgetter('weight')):
+def split_task(func, *args, duration=None,
+               weight=operator.attrgetter('weight'), key=lambda el: ''):
     """
     :param func: a task function with a monitor as last argument
     :param args: arguments of the task function
-    :param duration: split the task if it exceeds the duration
+    :param duration:
+        split the task in subtasks of the given duration; if not given,
+        use the duration suggested by the master (monitor.task_duration)
+        or 1000 seconds
     :param weight: weight function for the elements in args[0]
-    :yields: a partial result, 0 or more task objects, 0 or 1 partial result
+    :param key: function returning the kind of the elements in args[0]
+    :yields: partial results and 0 or more task objects
+
+    The time per unit of weight is estimated for each kind of element,
+    starting from the cost model of the master (monitor.cost_model) and
+    updating it with the elements computed by the current task; the
+    elements of a kind without an estimate are computed first, one at
+    the time. The measurements are sent back to the master in
+    monitor.costs. The task function can also be a generator function:
+    then all of its outputs are yielded.
     """
-    elements = numpy.array(sorted(args[0], key=weight, reverse=True))
+    mon = args[-1]
+    elements = sorted(args[0], key=weight, reverse=True)
     n = len(elements)
-    # print('task_no=%d, num_elements=%d' % (args[-1].task_no, n))
     assert n > 0, 'Passed an empty sequence!'
+    isgen = inspect.isgeneratorfunction(func)
     if n == 1:
-        yield func(*args)
+        if isgen:
+            yield from func(*args)
+        else:
+            yield func(*args)
         return
-    first, *other = elements
-    first_weight = weight(first)
-    t0 = time.time()
-    res = func(*([first],) + args[1:])
-    dt = (time.time() - t0) / first_weight  # time per unit of weight
-    yield res
-    blocks = list(block_splitter(other, duration, lambda el: weight(el) * dt))
+    duration = duration or getattr(mon, 'task_duration', None) or 1000
+    model = CostModel(getattr(mon, 'cost_model', {}))
+    costs = getattr(mon, 'costs', CostModel())  # measured here
+
+    def kind(el):
+        return '%s:%s' % (func.__name__, key(el))
+
+    def run(elements):
+        # yield the outputs of func on the given elements and return the
+        # time spent in func, excluding the time spent by the consumer
+        dt = 0
+        t0 = time.time()
+        outputs = func(*(elements,) + args[1:])
+        for res in (outputs if isgen else [outputs]):
+            dt += time.time() - t0
+            yield res
+            t0 = time.time()
+        return dt + time.time() - t0
+
+    other = []
+    for el in elements:
+        if model.weight.get(kind(el)):
+            other.append(el)
+        else:  # measure the time per unit of weight
+            dt = yield from run([el])
+            costs.update(kind(el), weight(el), dt)
+            model.update(kind(el), weight(el), dt)
+    if not other:
+        return
+
+    def cost(el):
+        return weight(el) * model.dt(kind(el))
+    blocks = list(block_splitter(other, duration, cost))
     for block in blocks[:-1]:
-        yield (func, block) + args[1:-1]
-    yield func(*(blocks[-1],) + args[1:])
+        # the subtasks have the weight in the original units
+        blk = WeightedSequence((el, weight(el)) for el in block)
+        yield (func, blk) + args[1:-1]
+    dt = yield from run(blocks[-1])
+    totcost = blocks[-1].weight
+    for el in blocks[-1]:
+        if totcost:  # split the time proportionally to the expected cost
+            costs.update(kind(el), weight(el), dt * cost(el) / totcost)
@@ -17,13 +17,18 @@
 # along with OpenQuake.  If not, see <http://www.gnu.org/licenses/>.
 
 import os
+import sys
 import time
+import signal
 import getpass
+import threading
+import collections
 from datetime import datetime
 import psutil
 import numpy
 
 from openquake.baselib.general import humansize
+from openquake.baselib.python3compat import decode
 from openquake.baselib import hdf5
 
 # NB: one can use vstr fields in extensible datasets, but then reading
@@ -32,11 +37,24 @@ from openquake.baselib import hdf5
 # this is why below I am using '<S50' byte strings
 perf_dt = numpy.dtype([('operation', '<S50'), ('time_sec', float),
                        ('memory_mb', float), ('counts', int),
-                       ('task_no', numpy.int16)])
+                       ('task_no', numpy.int16), ('cpu_sec', float),
+                       ('read_mb', float), ('written_mb', float)])
+# cpu_sec, read_mb and written_mb are measured by the task while running,
+# pik_sec is the time spent by the task pickling the outputs, unpik_sec
+# the time spent by the master unpickling them, queued the time between
+# the submission and the start, first_res the time to the first output,
+# max_queued the maximum number of outputs queued ahead of the task outputs
 task_info_dt = numpy.dtype(
     [('taskname', '<S50'), ('task_no', numpy.uint32),
      ('weight', numpy.float32), ('duration', numpy.float32),
-     ('received', numpy.int64), ('mem_gb', numpy.float32)])
+     ('received', numpy.int64), ('mem_gb', numpy.float32),
+     ('predicted', numpy.float32), ('peak_mb', numpy.float32),
+     ('cpu_sec', numpy.float32), ('read_mb', numpy.float32),
+     ('written_mb', numpy.float32), ('pik_sec', numpy.float32),
+     ('unpik_sec', numpy.float32), ('queued', numpy.float32),
+     ('first_res', numpy.float32), ('start', numpy.float64),
+     ('pid', numpy.uint32), ('host', '<S32'),
+     ('max_queued', numpy.uint32)])
 
 
 def init_performance(hdf5file, swmr=False):
@@ -51,6 +69,8 @@ def init_performance(hdf5file, swmr=False):
         hdf5.create(h5, 'task_info', task_info_dt)
     if 'task_sent' not in h5:
         h5['task_sent'] = '{}'
+    if 'cost_model' not in h5:
+        h5['cost_model'] = '{}'
     if swmr:
         try:
             h5.swmr_mode = True
@@ -78,6 +98,108 @@ def memory_rss(pid):
     return psutil.Process(pid).memory_info().rss
 
 
+def io_counters(pid):
+    """
+    :returns: the bytes read and written by a process, including the
+              ones served by the page cache, or (0, 0) if not available
+    """
+    try:
+        io = psutil.Process(pid).io_counters()
+    except (AttributeError, psutil.AccessDenied):  # i.e. on macOS
+        return 0, 0
+    return (getattr(io, 'read_chars', io.read_bytes),
+            getattr(io, 'write_chars', io.write_bytes))
+
+
+class Sampler(object):
+    """
+    Statistical profiler sampling the stack of the current thread every
+    `interval` seconds of CPU time (via SIGPROF, so it works only in the
+    main thread on POSIX systems, otherwise it does nothing). Should be
+    used as a context manager; the frames above the one entering the
+    context are ignored. The sampled stacks are stored in the Counter
+    .stacks in folded format, i.e. as strings 'module:func;module:func'.
+
+    :param interval: sampling interval in seconds (0 means no sampling)
+    """
+    def __init__(self, interval=.01):
+        self.interval = interval
+        self.stacks = collections.Counter()
+
+    def _sample(self, signum, frame):
+        names = []
+        while frame is not None and frame is not self.root:
+            names.append('%s:%s' % (frame.f_globals.get('__name__'),
+                                    frame.f_code.co_name))
+            frame = frame.f_back
+        self.stacks[';'.join(reversed(names))] += 1
+
+    def __enter__(self):
+        self.enabled = (self.interval > 0 and hasattr(signal, 'setitimer') and
+                        threading.current_thread() is threading.main_thread())
+        if self.enabled:
+            self.root = sys._getframe(1)
+            self.handler = signal.signal(signal.SIGPROF, self._sample)
+            signal.setitimer(signal.ITIMER_PROF, self.interval, self.interval)
+        return self
+
+    def __exit__(self, etype, exc, tb):
+        if self.enabled:
+            signal.setitimer(signal.ITIMER_PROF, 0)
+            signal.signal(signal.SIGPROF, self.handler)
+
+
+def save_profile(h5, stacks):
+    """
+    Merge the given stacks with the ones stored in h5['profile'], an array
+    of lines 'stack count' in the folded format understood by flamegraph.pl
+
+    :param h5: an open hdf5.File
+    :param stacks: a Counter stack -> number of samples
+    """
+    if not stacks:
+        return
+    stacks = collections.Counter(stacks)
+    if 'profile' in h5:
+        for line in h5['profile'][()]:
+            stack, count = decode(line).rsplit(' ', 1)
+            stacks[stack] += int(count)
+        del h5['profile']
+    h5['profile'] = numpy.array(['%s %d' % item for item in
+                                 sorted(stacks.items())])
+
+
+def chrome_trace(task_info):
+    """
+    Convert the task information into the Chrome trace event format,
+    which can be visualized with chrome://tracing or ui.perfetto.dev:
+    each host is displayed as a process and each worker as a thread.
+
+    :param task_info: an array of dtype task_info_dt
+    :returns: a JSON-serializable dictionary
+    """
+    hosts = sorted(set(task_info['host']))
+    events = [dict(name='process_name', ph='M', pid=h, args=dict(
+        name=decode(host) or 'localhost')) for h, host in enumerate(hosts)]
+    t0 = task_info['start'].min() if len(task_info) else 0
+    for rec in task_info:
+        pid = hosts.index(rec['host'])
+        tid = int(rec['pid'])
+        ts = (rec['start'] - t0) * 1E6  # in microseconds
+        args = {name: rec[name].item() for name in (
+            'task_no', 'weight', 'received', 'peak_mb', 'cpu_sec', 'read_mb',
+            'written_mb', 'pik_sec', 'unpik_sec', 'queued', 'max_queued')
+            if name in task_info.dtype.names}  # old datastores
+        events.append(dict(name=decode(rec['taskname']), cat='task', ph='X',
+                           ts=ts, dur=rec['duration'].item() * 1E6,
+                           pid=pid, tid=tid, args=args))
+        if not numpy.isnan(rec['first_res']):
+            events.append(dict(name='first output', cat='task', ph='i',
+                               s='t', ts=ts + rec['first_res'].item() * 1E6,
+                               pid=pid, tid=tid))
+    return dict(traceEvents=events, displayTimeUnit='ms')
+
+
 # this is not thread-safe
 class Monitor(object):
     """
@@ -96,6 +218,8 @@ class Monitor(object):
     .duration: time elapsed between start and stop (in seconds)
     .exc: usually None; otherwise the exception happened in the `with` block
     .mem: the memory delta in bytes
+    .cpu: the CPU time of the process in seconds
+    .read, .written: the I/O in bytes, measured only if measuremem is set
 
     The behaviour of the Monitor can be customized by subclassing it
     and by overriding the method on_exit(), called at end and used to display
@@ -117,6 +241,8 @@ class Monitor(object):
         self.h5 = h5
         self.mem = 0
         self.duration = 0
+        self.cpu = 0
+        self.read = self.written = 0
         self._start_time = self._stop_time = time.time()
         self.children = []
         self.counts = 0
@@ -156,14 +282,17 @@ class Monitor(object):
             time_sec = self.duration
             memory_mb = self.mem / 1024. / 1024. if self.measuremem else 0
             data.append((self.operation, time_sec, memory_mb, self.counts,
-                         self.task_no))
+                         self.task_no, self.cpu, self.read / 1024. / 1024.,
+                         self.written / 1024. / 1024.))
         return numpy.array(data, perf_dt)
 
     def __enter__(self):
         self.exc = None  # exception
         self._start_time = time.time()
+        self._start_cpu = time.process_time()
         if self.measuremem:
             self.start_mem = self.measure_mem()
+            self.start_io = io_counters(os.getpid())
         return self
 
     def __exit__(self, etype, exc, tb):
@@ -171,8 +300,12 @@ class Monitor(object):
         if self.measuremem:
             self.stop_mem = self.measure_mem()
             self.mem += self.stop_mem - self.start_mem
+            read, written = io_counters(os.getpid())
+            self.read += read - self.start_io[0]
+            self.written += written - self.start_io[1]
         self._stop_time = time.time()
         self.duration += self._stop_time - self._start_time
+        self.cpu += time.process_time() - self._start_cpu
         self.counts += 1
         if self.h5:
             self.flush(self.h5)
@@ -186,19 +319,29 @@ class Monitor(object):
         :param name: name of the task function
         :param mem_gb: memory consumption at the saving time (optional)
         """
+        predicted = getattr(self, 'predicted', numpy.nan)
+        peak_mb = getattr(self, 'peak_mem', 0) / 1024. / 1024.
         t = (name, self.task_no, self.weight, self.duration, len(res.pik),
-             mem_gb)
+             mem_gb, predicted, peak_mb, self.cpu, self.read / 1024. / 1024.,
+             self.written / 1024. / 1024., getattr(self, 'pik_sec', 0),
+             getattr(self, 'unpik_sec', 0), getattr(self, 'queued', 0),
+             getattr(self, 'first_res', numpy.nan),
+             getattr(self, 'start', self._start_time),
+             getattr(self, 'pid', 0), getattr(self, 'host', ''),
+             getattr(self, 'max_queued', 0))
         data = numpy.array([t], task_info_dt)
         hdf5.extend(h5['task_info'], data)
         h5['task_info'].flush()  # notify the reader
 
     def reset(self):
         """
-        Reset duration, mem, counts
+        Reset duration, mem, counts, cpu, read, written
         """
         self.duration = 0
         self.mem = 0
         self.counts = 0
+        self.cpu = 0
+        self.read = self.written = 0
 
     def flush(self, h5):
         """
@@ -233,7 +376,8 @@ class Monitor(object):
         """
         new = object.__new__(self.__class__)
         vars(new).update(vars(self), operation=operation, children=[],
-                         counts=0, mem=0, duration=0)
+                         counts=0, mem=0, duration=0, cpu=0, read=0,
+                         written=0)
         vars(new).update(kw)
         return new
 
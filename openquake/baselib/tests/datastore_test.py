@@ -21,8 +21,20 @@ import os
 import sys
 import unittest
 import tempfile
+from unittest import mock
 import numpy
-from openquake.baselib.datastore import DataStore, read
+import pandas
+from openquake.baselib import hdf5, config
+from openquake.baselib.datastore import (
+    DataStore, ReadCache, ProductCache, read)
+
+
+def first(dstore):
+    return int(dstore['a'][0])
+
+
+def read_df(dstore):
+    return pandas.DataFrame(dict(a=dstore['a'][()]))
 
 
 class DataStoreTestCase(unittest.TestCase):
@@ -32,6 +44,185 @@ class DataStoreTestCase(unittest.TestCase):
     def tearDown(self):
         self.dstore.clear()
 
+    def test_read_df(self):
+        dt = numpy.dtype([('id', numpy.uint32), ('xy', (numpy.float32, 2)),
+                          ('value', numpy.float64)])
+        arr = numpy.zeros(10, dt)
+        arr['id'] = numpy.arange(10)
+        arr['xy'][:, 1] = 1.
+        arr['value'] = numpy.arange(10) / 10
+        self.dstore['contiguous'] = arr
+        self.dstore.create_dset('chunked', dt)
+        hdf5.extend(self.dstore['chunked'], arr)
+        for key in ['contiguous', 'chunked']:
+            df = self.dstore.read_df(key, 'id')
+            self.assertEqual(list(df.columns), ['xy_0', 'xy_1', 'value'])
+            self.assertEqual(df.loc[3, 'value'], .3)
+            df = self.dstore.read_df(key, 'id', columns=['value'],
+                                     sel=arr['value'] > .65)
+            self.assertEqual(list(df.index), [7, 8, 9])
+            dic = self.dstore.read_columns(key, ['xy'], slice(2, 4))
+            self.assertEqual(dic['xy_1'].tolist(), [1., 1.])
+        # the contiguous dataset is memory-mapped
+        dic = self.dstore.read_columns('contiguous')
+        self.assertIsInstance(dic['id'], numpy.memmap)
+
+    def test_appender(self):
+        dt = numpy.dtype([('eid', numpy.uint32), ('gmv', numpy.float32)])
+        self.dstore.create_dset('gmfs', dt, chunks=hdf5.get_chunks(dt))
+        app = self.dstore.appender('gmfs')
+        self.assertIs(self.dstore.appender('gmfs'), app)
+        for i in range(10):
+            app.append(numpy.array([(i, .1)] * 1000, dt))
+        self.assertEqual(len(app), 10000)
+        self.assertEqual(len(self.dstore['gmfs']), 0)  # still buffered
+        self.dstore.flush()
+        self.assertEqual(len(self.dstore['gmfs']), 10000)
+        app = self.dstore.appender('gmfs')
+        app.append(numpy.array([(10, .2)], dt))
+        self.dstore.close()  # flush the appenders
+        self.dstore.open('r')
+        self.assertEqual(self.dstore['gmfs']['eid'][-2:].tolist(), [9, 10])
+
+    def test_extract(self):
+        arr = numpy.arange(2000 * 3 * 8.).reshape(2000, 3, 8)
+        self.dstore['contiguous'] = arr
+        self.dstore.hdf5.create_dataset(
+            'chunked', data=arr, chunks=(100, 1, 8))
+        self.dstore.hdf5.create_dataset(
+            'compressed', data=arr, chunks=(100, 1, 8), compression='gzip')
+        sids = [1500, 3, 4, 5, 250, 3, 1999]
+        for key in ['contiguous', 'chunked', 'compressed']:
+            dset = self.dstore[key]
+            numpy.testing.assert_equal(
+                hdf5.extract(dset, sids, 1, [7, 0, 2, 3]),
+                arr[sids][:, [1]][:, :, [7, 0, 2, 3]])
+            numpy.testing.assert_equal(
+                hdf5.extract(dset, slice(10, 20), [2, 0], slice(None)),
+                arr[10:20, [2, 0]])
+            self.assertEqual(hdf5.extract(dset, [], 1, 2).shape, (0, 1, 1))
+
+    def test_read_cache(self):
+        cache = ReadCache(maxbytes=800)
+        self.dstore['a'] = numpy.arange(50)  # 400 bytes
+        self.dstore['b'] = numpy.arange(60)  # 480 bytes
+        self.dstore['big'] = numpy.arange(200)  # too big to be cached
+        self.dstore.flush()
+        calc_id = self.dstore.calc_id
+        dstore = DataStore(self.dstore.filename, mode='r')
+        a = cache.get(dstore, 'a')
+        self.assertEqual(cache.get(dstore, 'first', first), 0)
+        dstore.close()
+        dstore.open('r')  # the cache survives reopening the file
+        self.assertIs(cache.get(dstore, 'a'), a)
+        self.assertFalse(a.flags.writeable)
+        cache.get(dstore, 'big')
+        self.assertEqual(list(cache.objects),
+                         [(calc_id, 'first'), (calc_id, 'a')])
+        cache.get(dstore, 'b')  # evicts the least recently used objects
+        self.assertEqual(list(cache.objects), [(calc_id, 'b')])
+        self.assertEqual((cache.hits, cache.misses, cache.nbytes),
+                         (1, 4, 480))
+        dstore.close()
+
+        # writing another dataset does not invalidate the entry
+        with mock.patch('openquake.baselib.datastore.read_cache', cache):
+            self.dstore['c'] = numpy.arange(3)
+            self.assertEqual(list(cache.objects), [(calc_id, 'b')])
+            # writing the same key invalidates it explicitly
+            self.dstore['b'] = numpy.arange(60) * 2  # same shape
+            self.assertEqual(list(cache.objects), [])
+        self.dstore.flush()
+        dstore.open('r')
+        self.assertEqual(cache.get(dstore, 'b')[1], 2)  # read again
+        dstore.close()
+
+        # a write from another process changing the shape is detected
+        self.dstore['b'] = numpy.arange(70)
+        self.dstore.flush()
+        dstore.open('r')
+        self.assertEqual(len(cache.get(dstore, 'b')), 70)
+
+        # the DataFrames are copied, since they cannot be read-only
+        df = cache.get(dstore, 'df', read_df)
+        df['a'] = 0
+        self.assertEqual(cache.get(dstore, 'df', read_df)['a'].sum(), 1225)
+        dstore.close()
+
+    def test_product_cache(self):
+        cache = ProductCache(tempfile.mkdtemp(), maxbytes=2000)
+        self.assertIsNone(cache.get('a' * 64))
+        cache.put('a' * 64, numpy.arange(100))  # ~950 bytes pickled
+        cache.put('b' * 64, numpy.arange(100))
+        self.assertEqual(len(cache), 2)
+        os.utime(cache.path('b' * 64), (0, 0))  # make b older than a
+        numpy.testing.assert_equal(cache.get('a' * 64), numpy.arange(100))
+        cache.put('c' * 64, numpy.arange(100))  # evicts b
+        self.assertIsNone(cache.get('b' * 64))
+        self.assertEqual(len(cache), 2)
+        self.assertEqual(cache.put('d' * 64, numpy.arange(1000)), 0)  # big
+        open(cache.path('c' * 64), 'wb').close()  # corrupted entry
+        self.assertIsNone(cache.get('c' * 64))
+        self.assertEqual(len(cache), 1)
+
+    def test_product_cache_iter(self):
+        cache = ProductCache(tempfile.mkdtemp(), maxbytes=2000)
+        self.assertIsNone(cache.get_iter('a' * 64))
+        arrays = (numpy.arange(10) * i for i in range(3))
+        it = cache.put_iter('a' * 64, arrays)
+        self.assertEqual(len(cache), 0)  # nothing stored until the end
+        self.assertEqual([arr[1] for arr in it], [0, 1, 2])
+        self.assertEqual([arr[1] for arr in cache.get_iter('a' * 64)],
+                         [0, 1, 2])
+        # an interrupted iteration does not store anything
+        it = cache.put_iter('b' * 64, (numpy.arange(10) for i in range(3)))
+        next(it)
+        it.close()
+        self.assertIsNone(cache.get_iter('b' * 64))
+        # too big for the cache, but all the objects are yielded
+        it = cache.put_iter('c' * 64, (numpy.arange(100) for i in range(3)))
+        self.assertEqual(len(list(it)), 3)
+        self.assertIsNone(cache.get_iter('c' * 64))
+        self.assertEqual(os.listdir(cache.dirname), ['a' * 64 + '.pik'])
+
+    def test_product_cache_permissions(self):
+        dirname = tempfile.mkdtemp()
+        cache = ProductCache(os.path.join(dirname, 'cache'), maxbytes=2000)
+        self.assertEqual(os.stat(cache.dirname).st_mode & 0o777, 0o700)
+        cache.put('a' * 64, numpy.arange(10))
+        self.assertEqual(os.stat(cache.path('a' * 64)).st_mode & 0o777,
+                         0o600)
+        os.chmod(cache.path('a' * 64), 0o666)  # writable by anybody
+        self.assertIsNone(cache.get('a' * 64))
+        os.chmod(cache.dirname, 0o777)
+        with self.assertRaises(PermissionError):
+            ProductCache(cache.dirname, maxbytes=2000)
+
+    def test_sidecars(self):
+        dt = numpy.dtype([('eid', numpy.uint32), ('gmv', numpy.float32)])
+        with mock.patch.dict(config.directory, sidecars='gmf_data poes'):
+            self.dstore.create_dset('gmf_data/data', dt, compression='gzip')
+            self.dstore['poes/grp-00'] = numpy.ones(3)
+            self.dstore['weights'] = numpy.ones(2)
+            self.dstore.swmr_on()
+            hdf5.extend(self.dstore['gmf_data/data'],
+                        numpy.array([(1, .1), (2, .2)], dt))
+            self.dstore.flush()
+        fnames = self.dstore.sidecar_files()
+        self.assertEqual([os.path.basename(f) for f in fnames], [
+            'calc_%d_gmf_data.hdf5' % self.dstore.calc_id,
+            'calc_%d_poes.hdf5' % self.dstore.calc_id])
+        with read(self.dstore.filename) as ds:  # reading via the links
+            self.assertEqual(ds['gmf_data/data']['eid'].tolist(), [1, 2])
+            self.assertEqual(ds['poes/grp-00'][()].tolist(), [1, 1, 1])
+            self.assertEqual(ds['weights'].file.filename, ds.filename)
+        self.assertEqual(self.dstore.getsize(), sum(
+            os.path.getsize(f) for f in [self.dstore.filename] + fnames))
+        self.dstore.clear()
+        for fname in fnames:
+            self.assertFalse(os.path.exists(fname))
+        self.dstore = DataStore()  # to be removed in tearDown
+
     def test_hdf5(self):
         # store numpy arrays as hdf5 files
         self.assertEqual(len(self.dstore), 0)
@@ -24,7 +24,9 @@ import unittest
 import itertools
 import tempfile
 import numpy
-from openquake.baselib import parallel, general, hdf5, workerpool, performance
+from openquake.baselib import (
+    parallel, general, hdf5, workerpool, performance, config)
+from openquake.baselib.python3compat import decode
 
 try:
     import celery
@@ -58,6 +60,52 @@ def supertask(text, monitor):
             yield get_length, k * v
 
 
+def get_item(i, array, monitor):
+    return {'n': array[i]}
+
+
+def ones(n, monitor):
+    return {'ones': numpy.ones(n)}
+
+
+def many_ones(n, monitor):
+    # n outputs of 1 MB each
+    for _ in range(n):
+        yield {'ones': numpy.ones(parallel.MB // 8)}
+
+
+def allocate(items, monitor):
+    # allocate 10 MB per item
+    arr = numpy.ones(len(items) * 10 * parallel.MB // 8)
+    time.sleep(.5)
+    return {'n': len(arr) * 8 // (10 * parallel.MB)}
+
+
+class FakeGetter(object):
+    # an object like the RuptureGetters of ebrisk, implementing .split
+    def __init__(self, proxies):
+        self.proxies = proxies
+        self.weight = len(proxies)
+
+    def split(self, n):
+        return [FakeGetter(block.copy()) for block in numpy.array_split(
+            self.proxies, n)]
+
+    def __len__(self):
+        return len(self.proxies)
+
+
+def allocate_getter(getter, monitor):
+    return allocate(getter.proxies, monitor)
+
+
+def busy(seconds, monitor):
+    t0 = time.process_time()
+    while time.process_time() - t0 < seconds:
+        sum(range(1000))
+    return {}
+
+
 def countletters(text1, text2, monitor):
     for block in general.block_splitter(text1 + text2, 5):
         yield get_length, ''.join(block)
@@ -149,11 +197,345 @@ class StarmapTestCase(unittest.TestCase):
         smap = parallel.Starmap(countletters, data)
         self.assertEqual(smap.reduce(), {'n': 19})
 
+    def test_shared_args(self):
+        # an argument of 8 MB shared by all the tasks
+        array = numpy.ones(1024 ** 2)
+        smap = parallel.Starmap(get_item, [(i, array) for i in range(5)])
+        self.assertEqual(smap.reduce(), {'n': 5})
+        if smap.distribute == 'processpool':
+            # the array was sent by reference
+            self.assertEqual(smap.sent['get_item']['array'], 0)
+        self.assertIsNone(smap.shared)  # the shared store was closed
+
+    def test_changed_args(self):
+        # a dict argument changed between two submits is pickled again
+        param = {0: 1, 1: 1}
+        smap = parallel.Starmap(get_item)
+        smap.submit((0, param))
+        param[1] = 10
+        smap.submit((1, param))
+        self.assertEqual(smap.reduce(), {'n': 11})
+
+    def test_shared_args_cleanup(self):
+        # the shared store is removed even if the aggregation fails
+        stores = []
+
+        class Store(parallel.SharedStore):
+            def __init__(self):
+                super().__init__()
+                stores.append(self)
+
+        def agg(acc, res):
+            raise RuntimeError('aggregation failed')
+        array = numpy.ones(1024 ** 2)
+        with mock.patch.object(parallel, 'SharedStore', Store):
+            smap = parallel.Starmap(get_item, [(i, array) for i in range(5)])
+            with self.assertRaises(RuntimeError):
+                smap.reduce(agg)
+        if smap.distribute == 'processpool':
+            self.assertEqual(len(stores), 1)
+        for store in stores:
+            self.assertFalse(os.path.exists(store.fname))
+        self.assertIsNone(smap.shared)
+        # the outputs of the interrupted tasks are discarded by the next
+        # Starmap, even if it receives on the same port
+        smap = parallel.Starmap(get_item, [(i, array) for i in range(5)])
+        self.assertEqual(smap.reduce(), {'n': 5})
+
+    def test_backpressure(self):
+        # many outputs per task, more than the high water mark
+        def slow_agg(acc, res):
+            time.sleep(.01)
+            return acc + [res]
+        with mock.patch.dict(config.distribution, max_queued_outputs='2',
+                             send_timeout='5'):
+            smap = parallel.Starmap(gfunc, [('x' * 50,), ('y' * 50,)])
+            self.assertEqual(len(smap.reduce(slow_agg, [])), 100)
+            # the outputs piled up while the master was sleeping
+            self.assertGreater(smap.h5['task_info']['max_queued'].max(), 0)
+            # no deadlock when the tasks run in the master
+            res = list(parallel.Starmap(gfunc, [('x' * 50,)]))
+            self.assertEqual(len(res), 50)
+
+    def test_backpressure_interrupted(self):
+        # the tasks blocked in sending to a master which stopped receiving
+        # are aborted after send_timeout, so their workers are freed
+        def agg(acc, res):
+            raise RuntimeError('aggregation failed')
+        with mock.patch.dict(config.distribution, max_queued_outputs='2',
+                             send_timeout='1'):
+            smap = parallel.Starmap(many_ones, [(20,), (20,)])
+            with self.assertRaises(RuntimeError):
+                smap.reduce(agg)
+            t0 = time.time()
+            res = parallel.Starmap(ones, [(10,), (10,)]).reduce()
+            numpy.testing.assert_equal(res['ones'], numpy.ones(10) * 2)
+            self.assertLess(time.time() - t0, 30)
+
+    def test_compress_outputs(self):
+        # the outputs are arrays of 80 KB, very compressible
+        with mock.patch.dict(config.distribution, compress_outputs='1000'):
+            res = parallel.Starmap(ones, [(10000,), (10000,)]).reduce()
+        numpy.testing.assert_equal(res['ones'], numpy.ones(10000) * 2)
+
+    def test_prefetch_outputs(self):
+        with mock.patch.dict(config.distribution, prefetch_outputs='3'):
+            res = list(parallel.Starmap(gfunc, [('x' * 50,), ('y' * 50,)]))
+            self.assertEqual(sorted(res), ['xxx'] * 50 + ['yyy'] * 50)
+            # the errors in the tasks are raised in the main thread
+            smap = parallel.Starmap(get_length, [(None,), (None,)])
+            with self.assertRaises(TypeError):
+                smap.reduce()
+
+    def test_prefetch_agg_error(self):
+        # the receiving thread terminates if the aggregation fails
+        threads = []
+
+        class Pref(parallel.Prefetcher):
+            def __init__(self, *args):
+                super().__init__(*args)
+                threads.append(self)
+
+        def agg(acc, res):
+            raise RuntimeError('aggregation failed')
+        with mock.patch.dict(config.distribution, prefetch_outputs='1'), \
+                mock.patch.object(parallel, 'Prefetcher', Pref):
+            # tasks run in-process, so no worker is left sending outputs
+            smap = parallel.Starmap(gfunc, [('x' * 50,), ('y' * 50,)],
+                                    distribute='no')
+            with self.assertRaises(RuntimeError):
+                smap.reduce(agg)
+        self.assertEqual(len(threads), 1)
+        self.assertFalse(threads[0].is_alive())
+        self.assertIsNone(smap.prefetcher)
+
+    def test_task_mem_limit(self):
+        if parallel.oq_distribute() not in ('processpool', 'zmq'):
+            raise unittest.SkipTest('tasks are not run in processes')
+        # the task with 8 items allocates 80 MB and is resubmitted
+        blocks = [general.WeightedSequence((i, 1) for i in range(n))
+                  for n in (8, 2)]
+        with mock.patch.dict(config.memory, task_mem_limit='50'):
+            smap = parallel.Starmap(allocate, [(blk,) for blk in blocks])
+            self.assertEqual(smap.reduce(), {'n': 10})
+        info = smap.h5['task_info'][()]
+        self.assertEqual(len(info), 4)  # 2 tasks + 2 subtasks
+        self.assertGreater(info['peak_mb'].max(), 30)
+
+        # the same with getters like the ones of ebrisk
+        getters = [FakeGetter(numpy.arange(n)) for n in (8, 2)]
+        with mock.patch.dict(config.memory, task_mem_limit='50'):
+            smap = parallel.Starmap(allocate_getter, [(g,) for g in getters])
+            self.assertEqual(smap.reduce(), {'n': 10})
+        self.assertEqual(len(smap.h5['task_info']), 4)
+
+        # a list is not split, since the task may not accept its parts
+        with mock.patch.dict(config.memory, task_mem_limit='50'):
+            smap = parallel.Starmap(allocate, [(list(range(8)),),
+                                               (list(range(2)),)])
+            self.assertEqual(smap.reduce(), {'n': 10})
+        self.assertEqual(len(smap.h5['task_info']), 2)
+
+    def test_profile(self):
+        with mock.patch.dict(config.distribution, profile_interval='5'):
+            smap = parallel.Starmap(busy, [(.2,), (.2,)])
+            smap.reduce()
+        lines = decode(smap.h5['profile'][()])
+        self.assertTrue(any(':busy' in line for line in lines), lines)
+
+    def test_telemetry(self):
+        smap = parallel.Starmap(gfunc, [('ab',), ('cde',)])
+        self.assertEqual(sorted(smap), ['aaa', 'bbb', 'ccc', 'ddd', 'eee'])
+        info = smap.h5['task_info'][()]
+        self.assertEqual(len(info), 2)
+        for rec in info:
+            self.assertGreaterEqual(rec['cpu_sec'], 0)
+            self.assertGreater(rec['pik_sec'], 0)
+            self.assertGreater(rec['unpik_sec'], 0)
+            self.assertGreaterEqual(rec['queued'], 0)
+            self.assertLess(rec['first_res'], 1)
+            self.assertLessEqual(rec['start'], time.time())
+            self.assertGreater(rec['pid'], 0)
+            self.assertTrue(rec['host'])
+        trace = performance.chrome_trace(info)
+        kinds = [ev['ph'] for ev in trace['traceEvents']]
+        self.assertEqual(sorted(kinds), ['M', 'X', 'X', 'i', 'i'])
+
     @classmethod
     def tearDownClass(cls):
         parallel.Starmap.shutdown()
 
 
+class MemoryBudgetTestCase(unittest.TestCase):
+    def test(self):
+        with parallel.MemoryBudget() as budget:
+            arr = numpy.ones(10 * parallel.MB)  # 80 MB
+            budget.check()
+        self.assertGreater(budget.peak, 50 * parallel.MB)
+        del arr
+        budget = parallel.MemoryBudget(10 * parallel.MB, interval=.01)
+        with self.assertRaises(parallel.TaskMemoryError), budget:
+            budget.active = True
+            arr = numpy.ones(5 * parallel.MB)  # 40 MB
+            time.sleep(.1)  # interrupted by the timer calling budget.check
+            self.fail('%d bytes allocated without errors' % arr.nbytes)
+        self.assertTrue(budget.exceeded)
+
+    def test_split(self):
+        seq = general.WeightedSequence.merge(
+            [general.WeightedSequence([(c, 2)]) for c in 'abcde'])
+        self.assertTrue(parallel.splittable(seq))
+        halves = seq.split(2)
+        self.assertEqual([list(h) for h in halves],
+                         [list('abc'), list('de')])
+        self.assertEqual([h.weight for h in halves], [6, 4])
+        self.assertTrue(parallel.splittable(FakeGetter(numpy.arange(2))))
+        self.assertFalse(parallel.splittable(FakeGetter(numpy.arange(1))))
+        self.assertFalse(parallel.splittable([1, 2]))
+        self.assertFalse(parallel.splittable('ab'))
+
+
+class PickledTestCase(unittest.TestCase):
+    def test_compress(self):
+        array = numpy.zeros(10000)
+        pik = parallel.Pickled(array, compress_above=1000)
+        self.assertTrue(pik.compressed)
+        self.assertLess(len(pik), pik.size)
+        numpy.testing.assert_equal(pik.unpickle(), array)
+
+    def test_small(self):
+        pik = parallel.Pickled('hello', compress_above=1000)
+        self.assertFalse(pik.compressed)
+        self.assertEqual(pik.unpickle(), 'hello')
+
+
+class SharedStoreTestCase(unittest.TestCase):
+    def test(self):
+        store = parallel.SharedStore()
+        objs = [numpy.arange(10), {'a': 1}, 'hello']
+        refs = [store.add(parallel.Pickled(obj)) for obj in objs]
+        numpy.testing.assert_equal(refs[0].unpickle(), objs[0])
+        self.assertEqual(refs[1].unpickle(), objs[1])
+        self.assertEqual(refs[2].unpickle(), objs[2])
+        self.assertEqual(store.offset, sum(len(ref) for ref in refs))
+        store.close()
+        self.assertFalse(os.path.exists(store.fname))
+
+
+class SchedulerTestCase(unittest.TestCase):
+    def test_fifo(self):
+        blocks = [general.WeightedSequence([(c, w)])
+                  for c, w in zip('abc', [1, 3, 2])]
+        queue = parallel.TaskQueue((get_length, (b,)) for b in blocks)
+        self.assertEqual([queue.pop()[1][0][0] for _ in blocks],
+                         ['a', 'b', 'c'])
+
+    def test_lpt(self):
+        blocks = [general.WeightedSequence([(c, w)])
+                  for c, w in zip('abcd', [1, 3, 2, 2])]
+        cost_model = parallel.CostModel()
+        queue = parallel.LPTQueue([(get_length, (blocks[0],)),
+                                   (get_length, (blocks[1],)),
+                                   (gfunc, (blocks[2],)),
+                                   (gfunc, (blocks[3],))], cost_model)
+        self.assertEqual(len(queue), 4)
+        self.assertEqual(queue.pop()[1][0][0], 'b')  # heaviest first
+        # gfunc turns out to be 10 times slower than get_length
+        cost_model.update('get_length', 3, 3.)
+        cost_model.update('gfunc', 1, 10.)
+        self.assertEqual(queue.expected_time(), 41.)
+        self.assertEqual(queue.pop()[1][0][0], 'c')  # expected 20s
+        self.assertEqual(queue.pop()[1][0][0], 'd')  # expected 20s
+        self.assertEqual(queue.pop()[1][0][0], 'a')  # expected 1s
+        self.assertEqual(len(queue), 0)
+
+    def test_starmap_lpt(self):
+        data = [('hello', 'world'), ('ciao', 'mondo')]
+        smap = parallel.Starmap(countletters, data, scheduler='lpt')
+        self.assertEqual(smap.reduce(), {'n': 19})
+
+
+class CostModelTestCase(unittest.TestCase):
+    def test(self):
+        model = parallel.CostModel()
+        self.assertIsNone(model.dt('a'))
+        self.assertTrue(numpy.isnan(model.predict('a', 10)))
+        model.update('a', 10, 1.)
+        model.update('a', 10, 3.)
+        model.update('b', 1, 1.)
+        self.assertEqual(model.dt('a'), .2)
+        self.assertEqual(model.predict('b', 3), 3.)
+        self.assertEqual(model.dt('c'), 5 / 21)  # average
+        model2 = parallel.CostModel(model.to_dict())
+        model2.merge(model)
+        self.assertEqual(model2.to_dict(), {'a': (40, 8.), 'b': (2, 2.)})
+
+
+def square_sum(items, monitor):
+    return sum(item ** 2 for item in items)
+
+
+class SplitTaskTestCase(unittest.TestCase):
+    def test(self):
+        mon = parallel.Monitor()
+        mon.costs = parallel.CostModel()
+        mon.cost_model = {'square_sum:odd': (1, 1.), 'square_sum:even': (
+            1, 2.)}  # even numbers are twice as expensive
+        items = list(range(1, 11))
+        res = list(parallel.split_task(
+            square_sum, items, mon, duration=20, weight=lambda x: 1,
+            key=lambda x: 'odd' if x % 2 else 'even'))
+        subtasks = [r for r in res if isinstance(r, tuple)]
+        outputs = [r for r in res if not isinstance(r, tuple)]
+        # the total cost is 5 * 1 + 5 * 2 = 15, so there are no subtasks
+        self.assertEqual(subtasks, [])
+        self.assertEqual(sum(outputs), 385)
+
+        # now with a smaller duration; there are subtasks
+        res = list(parallel.split_task(
+            square_sum, items, mon, duration=4, weight=lambda x: 1,
+            key=lambda x: 'odd' if x % 2 else 'even'))
+        tot = 0
+        for r in res:
+            if isinstance(r, tuple):  # subtask
+                tot += r[0](*r[1:] + (mon,))
+                self.assertLessEqual(r[1].weight, 4)
+            else:
+                tot += r
+        self.assertEqual(tot, 385)
+        # the costs measured in the task
+        self.assertEqual(sorted(mon.costs.weight), ['square_sum:even',
+                                                    'square_sum:odd'])
+
+    def test_unknown_kind(self):
+        # without a cost model the first element is measured locally
+        mon = parallel.Monitor()
+        mon.costs = parallel.CostModel()
+        res = list(parallel.split_task(
+            square_sum, [1, 2, 3], mon, duration=1000, weight=lambda x: 1))
+        self.assertEqual(res, [1, 13])
+        self.assertEqual(mon.costs.weight, {'square_sum:': 3})
+
+    def test_generator(self):
+        # the outputs of a generator function are all yielded
+        mon = parallel.Monitor()
+        mon.costs = parallel.CostModel()
+        mon.cost_model = {'gen_squares:': (1, 1.)}
+        res = list(parallel.split_task(
+            gen_squares, [1, 2, 3, 4], mon, duration=2, weight=lambda x: 1))
+        subtasks = [r for r in res if isinstance(r, tuple)]
+        outputs = [r for r in res if not isinstance(r, tuple)]
+        self.assertEqual(len(subtasks), 1)
+        self.assertEqual(outputs, [9, 16])  # the last block
+        self.assertEqual(list(subtasks[0][0](*subtasks[0][1:] + (mon,))),
+                         [1, 4])
+
+
+def gen_squares(items, monitor):
+    for item in items:
+        yield item ** 2
+
+
 class ThreadPoolTestCase(unittest.TestCase):
     def test(self):
         monitor = parallel.Monitor()
@@ -177,7 +559,7 @@ def pool_starmap(func, allargs, h5):
     import multiprocessing
     with multiprocessing.get_context('spawn').Pool() as pool:
         for i, res in enumerate(pool.starmap(func, allargs)):
-            perf = numpy.array([(func.__name__, 0, 0, i, i)],
+            perf = numpy.array([(func.__name__, 0, 0, i, i, 0, 0, 0)],
                                performance.perf_dt)
             hdf5.extend(h5['performance_data'], perf)
             yield res
@@ -19,7 +19,9 @@ import time
 import unittest
 import pickle
 import numpy
-from openquake.baselib.performance import Monitor
+from openquake.baselib import hdf5, general
+from openquake.baselib.python3compat import decode
+from openquake.baselib.performance import Monitor, Sampler, save_profile
 
 
 class MonitorTestCase(unittest.TestCase):
@@ -58,5 +60,41 @@ class MonitorTestCase(unittest.TestCase):
         total_time = data['time_sec'].sum()
         self.assertGreaterEqual(total_time, 0.3)
 
+    def test_cpu_io(self):
+        mon = self.mon('test_cpu_io', measuremem=True)
+        fname = general.gettemp('x' * 100000)
+        with mon:
+            with open(fname) as f:
+                f.read()
+            time.sleep(0.1)  # does not count as CPU time
+        self.assertLess(mon.cpu, mon.duration)
+        if mon.read:  # not measured on macOS
+            self.assertGreaterEqual(mon.read, 100000)
+        [rec] = mon.get_data()
+        self.assertEqual(rec['read_mb'], mon.read / 1024 / 1024)
+
     def test_pickleable(self):
         pickle.loads(pickle.dumps(self.mon))
+
+
+def busy_loop(seconds):
+    t0 = time.process_time()
+    while time.process_time() - t0 < seconds:
+        sum(range(1000))
+
+
+class SamplerTestCase(unittest.TestCase):
+    def test(self):
+        with Sampler(interval=.005) as sampler:
+            busy_loop(.2)
+        self.assertGreater(sum(sampler.stacks.values()), 10)
+        # the frames above the sampler are not included
+        for stack in sampler.stacks:
+            self.assertTrue(stack.startswith(__name__ + ':busy_loop'), stack)
+
+    def test_save_profile(self):
+        with hdf5.File(general.gettemp(suffix='.hdf5'), 'w') as h5:
+            save_profile(h5, {'a:f;a:g': 2, 'a:f': 1})
+            save_profile(h5, {'a:f;a:g': 3})
+            lines = decode(h5['profile'][()])
+        self.assertEqual(lines, ['a:f 1', 'a:f;a:g 5'])
@@ -16,10 +16,15 @@
 # You should have received a copy of the GNU Affero General Public License
 # along with OpenQuake.  If not, see <http://www.gnu.org/licenses/>.
 
+import sys
 import time
+import types
 import unittest
-from openquake.baselib import config
-from openquake.baselib.workerpool import WorkerMaster
+import functools
+from unittest import mock
+from openquake.baselib import config, datastore
+from openquake.baselib.workerpool import (
+    WorkerMaster, Dispatcher, clear_caches)
 from openquake.baselib.parallel import Starmap
 from openquake.baselib.general import socket_ready
 
@@ -28,6 +33,51 @@ def double(x):
     return 2 * x
 
 
+class DispatcherTestCase(unittest.TestCase):
+    def test(self):
+        disp = Dispatcher()
+        for key, payload in [(b'f1', b'a'), (b'f2', b'b'), (b'', b'c'),
+                             (b'f1', b'd'), (b'f2', b'e')]:
+            disp.add(key, payload)
+        self.assertEqual(disp.pop(b'host1')[1], b'a')  # oldest
+        self.assertEqual(disp.pop(b'host2')[1], b'b')  # oldest
+        self.assertEqual(disp.pop(b'host2')[1], b'e')  # f2 is on host2
+        key, payload, seq = disp.pop(b'host1')
+        self.assertEqual(payload, b'd')  # f1 is on host1
+        disp.add(key, payload, seq)  # requeue
+        self.assertEqual(disp.pop(b'host2')[1], b'c')  # oldest
+        self.assertEqual(disp.pop(b'host2')[1], b'd')
+        self.assertEqual(disp.tasks, {})
+
+
+class ClearCachesTestCase(unittest.TestCase):
+    # the caches of a module must not survive across calculations
+    def test(self):
+        mod = types.ModuleType('openquake.fake')
+
+        @functools.lru_cache()
+        def square(x):
+            return x * x
+
+        class Obj(object):
+            @functools.lru_cache()
+            def double(self, x):
+                return 2 * x
+        square.__module__ = Obj.__module__ = mod.__name__
+        mod.square, mod.Obj, mod.gsim_cache = square, Obj, {'a': 1}
+        square(2)
+        Obj().double(3)
+        read_cache = datastore.ReadCache(maxbytes=100)
+        read_cache.objects[1, 'a'] = None, 0, None
+        with mock.patch.dict(sys.modules, {mod.__name__: mod}), \
+                mock.patch.object(datastore, 'read_cache', read_cache):
+            clear_caches()
+        self.assertEqual(square.cache_info().currsize, 0)
+        self.assertEqual(Obj.double.cache_info().currsize, 0)
+        self.assertEqual(mod.gsim_cache, {})
+        self.assertEqual(len(read_cache.objects), 0)
+
+
 class WorkerPoolTestCase(unittest.TestCase):
     @classmethod
     def setUpClass(cls):
@@ -49,6 +99,10 @@ class WorkerPoolTestCase(unittest.TestCase):
         time.sleep(1)  # wait a bit for the workerpool to start
         self.assertEqual(self.master.status(), [('127.0.0.1', 'running')])
 
+    def test_check(self):
+        time.sleep(1)  # wait a bit for the workerpool to start
+        self.assertEqual(self.master.check(), [('127.0.0.1', 0)])
+
     @classmethod
     def tearDownClass(cls):
         cls.master.stop()
@@ -1,13 +1,19 @@
 import os
+import gc
 import sys
 import time
+import pickle
 import signal
+import socket
+import collections
+import importlib
 import shutil
 import tempfile
 import subprocess
 import multiprocessing
 import psutil
-from openquake.baselib import zeromq as z, general, parallel, config, sap
+from openquake.baselib import (
+    zeromq as z, general, parallel, config, sap, datastore)
 try:
     from setproctitle import setproctitle
 except ImportError:
@@ -19,14 +25,87 @@ class TimeoutError(RuntimeError):
     pass
 
 
+class Dispatcher(object):
+    """
+    Locality-aware dispatcher of tasks. The tasks are queued together with
+    a locality key (a bytestring, usually the name of the file containing
+    the data needed by the task, or the empty string) and sent to the
+    workers when they ask for them. A worker on the host H receives the
+    oldest task with a key already dispatched to H, if any, otherwise the
+    oldest task; in this way the data cached on H (for instance in the
+    page cache of the OS) is reused and the reads from the shared_dir
+    are reduced.
+    """
+    def __init__(self):
+        self.tasks = {}  # seq -> (key, payload)
+        self.seqs = collections.defaultdict(collections.deque)  # by key
+        self.keys = collections.defaultdict(set)  # host -> keys
+        self.idle = collections.deque()  # pairs (worker ident, host)
+        self.seq = 0
+
+    def add(self, key, payload, seq=None):
+        """
+        Add a task to the queue; if `seq` is given, requeue it
+        """
+        if seq is None:
+            seq = self.seq
+            self.seq += 1
+            self.seqs[key].append(seq)
+        else:  # put the task back in front
+            self.seqs[key].appendleft(seq)
+        self.tasks[seq] = key, payload
+
+    def pop(self, host):
+        """
+        :returns: a triple (key, payload, seq) for the given host
+        """
+        mine = [self.seqs[key][0] for key in self.keys[host]
+                if key in self.seqs]
+        seq = min(mine) if mine else min(q[0] for q in self.seqs.values())
+        key, payload = self.tasks.pop(seq)
+        self.seqs[key].popleft()
+        if not self.seqs[key]:
+            del self.seqs[key]
+        if key:
+            self.keys[host].add(key)
+        return key, payload, seq
+
+    def run(self, task_input, task_output):
+        """
+        Dispatch the tasks coming from the PULL socket `task_input` to
+        the workers connected to the ROUTER socket `task_output`
+        """
+        # raise an error when sending to a worker which is dead
+        task_output.setsockopt(z.zmq.ROUTER_MANDATORY, 1)
+        poller = z.zmq.Poller()
+        poller.register(task_input, z.zmq.POLLIN)
+        poller.register(task_output, z.zmq.POLLIN)
+        while True:
+            events = dict(poller.poll())
+            if task_input in events:
+                self.add(*task_input.recv_multipart())
+            if task_output in events:
+                ident, _empty, host = task_output.recv_multipart()
+                self.idle.append((ident, host))
+            while self.idle and self.tasks:
+                ident, host = self.idle.popleft()
+                key, payload, seq = self.pop(host)
+                try:
+                    task_output.send_multipart([ident, b'', payload])
+                except z.zmq.ZMQError as exc:
+                    if exc.errno != z.zmq.EHOSTUNREACH:
+                        raise
+                    self.add(key, payload, seq)
+
+
 def _streamer():
     # streamer for zmq workers running on the master node
     port = int(config.zworkers.ctrl_port)
     task_input_url = 'tcp://127.0.0.1:%d' % (port + 2)
     task_output_url = 'tcp://%s:%s' % (config.dbserver.listen, port + 1)
     try:
-        z.zmq.proxy(z.bind(task_input_url, z.zmq.PULL),
-                    z.bind(task_output_url, z.zmq.PUSH))
+        Dispatcher().run(z.bind(task_input_url, z.zmq.PULL),
+                         z.bind(task_output_url, z.zmq.ROUTER))
     except (KeyboardInterrupt, z.zmq.ContextTerminated):
         pass  # killed cleanly by SIGINT/SIGTERM
 
@@ -52,14 +131,19 @@ class WorkerMaster(object):
     :param ctrl_port: port on which the worker pools listen
     :param host_cores: names of the remote hosts and number of cores to use
     :param remote_python: path of the Python executable on the remote hosts
+    :param keep_alive: if true, the workerpools survive the calculations
+                       and their dead workers are restarted by .start
     """
     def __init__(self, ctrl_port, host_cores=None,
-                 remote_python=None, receiver_ports=None):
-        # NB: receiver_ports is not used but needed for compliance
+                 remote_python=None, receiver_ports=None,
+                 keep_alive=False, preload=None):
+        # NB: receiver_ports and preload are not used but needed
+        # for compliance with the zworkers section of openquake.cfg
         self.ctrl_port = int(ctrl_port)
         self.host_cores = ([hc.split() for hc in host_cores.split(',')]
                            if host_cores else [])
         self.remote_python = remote_python or sys.executable
+        self.keep_alive = keep_alive
         self.popens = []
 
     def wait(self, seconds=30):
@@ -92,12 +176,16 @@ class WorkerMaster(object):
     def start(self):
         """
         Start multiple workerpools, possibly on remote servers via ssh,
-        assuming there is an active streamer.
+        assuming there is an active streamer. In keep_alive mode the
+        workerpools already running are checked, so that their dead
+        workers are restarted.
         """
         starting = []
         for host, cores in self.host_cores:
             if self.status(host)[0][1] == 'running':
                 print('%s:%s already running' % (host, self.ctrl_port))
+                if self.keep_alive:
+                    self.check(host)
                 continue
             ctrl_url = 'tcp://%s:%s' % (host, self.ctrl_port)
             if host == '127.0.0.1':  # localhost
@@ -163,6 +251,27 @@ class WorkerMaster(object):
                 executing.append((host, tasks))
         return executing
 
+    def check(self, host=None):
+        """
+        Send a "check" command to the worker pools (all of them if host
+        is None), so that the dead workers are restarted
+
+        :returns: a list of pairs (host, number of restarted workers)
+        """
+        if host is None:
+            host_cores = self.host_cores
+        else:
+            host_cores = [hc for hc in self.host_cores if hc[0] == host]
+        checked = []
+        for host, _ in host_cores:
+            if self.status(host)[0][1] == 'not-running':
+                print('%s not running' % host)
+                continue
+            ctrl_url = 'tcp://%s:%s' % (host, self.ctrl_port)
+            with z.Socket(ctrl_url, z.zmq.REQ, 'connect') as sock:
+                checked.append((host, sock.send('check')))
+        return checked
+
     def restart(self):
         """
         Stop and start again
@@ -172,14 +281,75 @@ class WorkerMaster(object):
         return 'restarted'
 
 
+def preload(modules):
+    """
+    Import the given modules, so that the workers forked later on
+    do not need to import them for each calculation.
+
+    :param modules: a space-separated string of module names
+    """
+    for module in modules.split():
+        try:
+            importlib.import_module(module)
+        except Exception as exc:  # the workers will fail later, if ever
+            print('Could not preload %s: %s' % (module, exc),
+                  file=sys.stderr)
+
+
+def _cache_clear(obj):
+    # clear the functools.lru_cache of a function or of the methods of a
+    # class; return the number of cleared caches
+    if hasattr(obj, 'cache_clear'):
+        obj.cache_clear()
+        return 1
+    elif isinstance(obj, type):
+        return sum(_cache_clear(attr) for attr in list(vars(obj).values())
+                   if hasattr(attr, 'cache_clear'))
+    return 0
+
+
+def clear_caches():
+    """
+    Clear the caches of the openquake modules which would otherwise
+    survive across calculations in a persistent worker, i.e. the
+    read cache of the datastore, the MeanStdCaches of the ContextMakers,
+    the module-level dictionaries with a name ending in "_cache" and the
+    lru_caches of the functions and methods (also in the preloaded
+    modules), then run the garbage collector.
+    """
+    datastore.read_cache.clear()
+    contexts = sys.modules.get('openquake.hazardlib.contexts')
+    if contexts:
+        contexts.MeanStdCache.clear_all()
+    for name, module in list(sys.modules.items()):
+        if not name.startswith('openquake.') or module is None:
+            continue
+        for var, obj in list(vars(module).items()):
+            if var.endswith('_cache') and type(obj) is dict:
+                obj.clear()
+            elif getattr(obj, '__module__', None) == name:
+                _cache_clear(obj)
+    gc.collect()
+
+
 def worker(sock, executing):
     """
-    :param sock: a zeromq.Socket of kind PULL
+    :param sock: a zeromq.Socket of kind REQ
     :param executing: a path inside /tmp/calc_XXX
     """
     setproctitle('oq-zworker')
+    host = socket.gethostname().encode('utf8')
+    calc_id = None
     with sock:
-        for cmd, args, taskno, mon in sock:
+        while True:
+            # ask the dispatcher for a task, telling on which host we are
+            sock.zsocket.send(host)
+            cmd, args, taskno, mon = pickle.loads(sock.zsocket.recv())
+            if mon.calc_id != calc_id:
+                # a new calculation started: release the memory
+                # allocated by the previous one, if any
+                calc_id = mon.calc_id
+                clear_caches()
             fname = os.path.join(executing, str(taskno))
             open(fname, 'w').close()
             parallel.safely_call(cmd, args, taskno, mon)
@@ -208,6 +378,15 @@ class WorkerPool(object):
         self.executing = tempfile.mkdtemp()
         self.pid = os.getpid()
 
+    def _start_worker(self):
+        sock = z.Socket(self.task_server_url, z.zmq.REQ, 'connect')
+        proc = multiprocessing.Process(
+            target=worker, args=(sock, self.executing))
+        proc.start()
+        sock.pid = proc.pid
+        sock.proc = proc
+        return sock
+
     def start(self):
         """
         Start worker processes and a control loop
@@ -215,15 +394,12 @@ class WorkerPool(object):
         title = 'oq-zworkerpool %s' % self.ctrl_url[6:]  # strip tcp://
         print('Starting ' + title, file=sys.stderr)
         setproctitle(title)
+        # import the heavy modules before forking, so that the workers
+        # (even the restarted ones) are warm
+        preload(config.zworkers.get('preload', ''))
         # start workers
-        self.workers = []
-        for _ in range(self.num_workers):
-            sock = z.Socket(self.task_server_url, z.zmq.PULL, 'connect')
-            proc = multiprocessing.Process(
-                target=worker, args=(sock, self.executing))
-            proc.start()
-            sock.pid = proc.pid
-            self.workers.append(sock)
+        self.workers = [self._start_worker()
+                        for _ in range(self.num_workers)]
 
         # start control loop accepting the commands stop and kill
         with z.Socket(self.ctrl_url, z.zmq.REP, 'bind') as ctrlsock:
@@ -236,10 +412,25 @@ class WorkerPool(object):
                     ctrlsock.send(self.pid)
                 elif cmd == 'get_num_workers':
                     ctrlsock.send(self.num_workers)
+                elif cmd == 'check':
+                    ctrlsock.send(self.check())
                 elif cmd == 'get_executing':
                     ctrlsock.send(' '.join(sorted(os.listdir(self.executing))))
         shutil.rmtree(self.executing)
 
+    def check(self):
+        """
+        Restart the dead workers, if any
+
+        :returns: the number of restarted workers
+        """
+        restarted = 0
+        for i, sock in enumerate(self.workers):
+            if not sock.proc.is_alive():
+                self.workers[i] = self._start_worker()
+                restarted += 1
+        return restarted
+
     def stop(self):
         """
         Send a SIGTERM to all worker processes
@@ -27,12 +27,24 @@ SOCKTYPE = {zmq.REQ: 'REQ', zmq.REP: 'REP',
             zmq.ROUTER: 'ROUTER', zmq.DEALER: 'DEALER'}
 
 
-def bind(end_point, socket_type):
+def set_hwm(sock, hwm):
+    """
+    Set the high water mark of a zmq socket, i.e. the maximum number of
+    messages queued in memory for each connection: when the limit is
+    reached the sender blocks. NB: it must be set before bind/connect.
+    """
+    if hwm is not None:
+        sock.setsockopt(zmq.SNDHWM, hwm)
+        sock.setsockopt(zmq.RCVHWM, hwm)
+
+
+def bind(end_point, socket_type, hwm=None):
     """
     Bind to a zmq URL; raise a proper error if the URL is invalid; return
     a zmq socket.
     """
     sock = context.socket(socket_type)
+    set_hwm(sock, hwm)
     try:
         sock.bind(end_point)
     except zmq.error.ZMQError as exc:
@@ -41,12 +53,13 @@ def bind(end_point, socket_type):
     return sock
 
 
-def connect(end_point, socket_type):
+def connect(end_point, socket_type, hwm=None):
     """
     Connect to a zmq URL; raise a proper error if the URL is invalid; return
     a zmq socket.
     """
     sock = context.socket(socket_type)
+    set_hwm(sock, hwm)
     try:
         sock.connect(end_point)
     except zmq.error.ZMQError as exc:
@@ -74,8 +87,12 @@ class Socket(object):
     :param socket_type: zmq socket type (integer)
     :param mode: default 'bind', accepts also 'connect'
     :param timeout: default 5000 ms, used when polling the underlying socket
+    :param hwm: if given, the high water mark of the underlying socket
+    :param send_timeout: if given, the maximum time (in ms) a send can
+                         block before raising zmq.Again, also used as linger
     """
-    def __init__(self, end_point, socket_type, mode, timeout=5000):
+    def __init__(self, end_point, socket_type, mode, timeout=5000,
+                 hwm=None, send_timeout=None):
         assert socket_type in (zmq.REP, zmq.REQ, zmq.PULL, zmq.PUSH)
         assert mode in ('bind', 'connect'), mode
         if mode == 'bind':
@@ -84,6 +101,8 @@ class Socket(object):
         self.socket_type = socket_type
         self.mode = mode
         self.timeout = timeout
+        self.hwm = hwm
+        self.send_timeout = send_timeout
         self.running = False
 
     def __enter__(self):
@@ -95,13 +114,19 @@ class Socket(object):
             p1, p2 = map(int, port_range.groups())
             end_point = self.end_point.rsplit(':', 1)[0]  # strip port range
             self.zsocket = context.socket(self.socket_type)
+            set_hwm(self.zsocket, self.hwm)
             port = self.zsocket.bind_to_random_port(end_point, p1, p2)
             # NB: will raise a ZMQBindError if no port is available
             self.port = port
         elif self.mode == 'bind':
-            self.zsocket = bind(self.end_point, self.socket_type)
+            self.zsocket = bind(self.end_point, self.socket_type, self.hwm)
         else:  # connect
-            self.zsocket = connect(self.end_point, self.socket_type)
+            self.zsocket = connect(
+                self.end_point, self.socket_type, self.hwm)
+        if self.send_timeout is not None:
+            # do not block forever if the receiver has gone away
+            self.zsocket.setsockopt(zmq.SNDTIMEO, self.send_timeout)
+            self.zsocket.setsockopt(zmq.LINGER, self.send_timeout)
         port = re.search(r':(\d+)$', self.end_point)
         if port:
             self.port = int(port.group(1))
@@ -142,6 +167,8 @@ class Socket(object):
         """
         try:
             self.zsocket.send_pyobj(obj)
+        except zmq.Again:  # send_timeout expired
+            raise
         except Exception as exc:
             # usual for objects bigger than 4 GB
             raise exc.__class__('%s: %r' % (exc, obj))
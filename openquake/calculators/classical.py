@@ -42,6 +42,7 @@ F32 = numpy.float32
 F64 = numpy.float64
 MINWEIGHT = 1000
 weight = operator.attrgetter('weight')
+by_typology = operator.attrgetter('__class__.__name__')
 grp_extreme_dt = numpy.dtype([('grp_id', U16), ('grp_name', hdf5.vstr),
                              ('extreme_poe', F32)])
 
@@ -77,8 +78,10 @@ def get_extreme_poe(array, imtls):
 def classical_split_filter(srcs, srcfilter, gsims, params, monitor):
     """
     Split the given sources, filter the subsources and the compute the
-    PoEs. Yield back subtasks if the split sources contain more than
-    maxweight ruptures.
+    PoEs. Yield back subtasks of the duration suggested by the master,
+    estimated with the cost model of each source typology; before the
+    master has an estimate, yield back subtasks if the split sources
+    contain more than maxweight ruptures.
     """
     # first check if we are sampling the sources
     ss = int(os.environ.get('OQ_SAMPLE_SOURCES', 0))
@@ -95,6 +98,12 @@ def classical_split_filter(srcs, srcfilter, gsims, params, monitor):
     if not sources:
         yield {'pmap': {}}
         return
+    duration = getattr(monitor, 'task_duration', None)
+    if duration:  # the master has a cost model
+        yield from parallel.split_task(
+            classical, sources, srcfilter, gsims, params, monitor,
+            duration=duration, key=by_typology)
+        return
     maxw = min(sum(src.weight for src in sources)/5, params['max_weight'])
     if maxw < MINWEIGHT*5:  # task too small to be resubmitted
         yield classical(sources, srcfilter, gsims, params, monitor)
@@ -213,8 +222,7 @@ class ClassicalCalculator(base.HazardCalculator):
                     if vlen:
                         self.datastore.hdf5.save_vlen('rup/' + k, v)
                     else:
-                        dset = self.datastore['rup/' + k]
-                        hdf5.extend(dset, v)
+                        self.datastore.appender('rup/' + k).append(v)
         return acc
 
     def acc0(self):
@@ -277,9 +285,11 @@ class ClassicalCalculator(base.HazardCalculator):
             mags = self.datastore['source_mags'][()]
             self.datastore['effect_by_mag_dst_trt'] = calc.get_effect(
                 mags, self.sitecol, gsims_by_trt, oq)
+        # submit the heaviest blocks first, to reduce the slow tasks
+        # at the end of the computation
         smap = parallel.Starmap(
             self.core_task.__func__, h5=self.datastore.hdf5,
-            num_cores=oq.num_cores)
+            num_cores=oq.num_cores, scheduler='lpt')
         smap.task_queue = list(self.gen_task_queue())  # really fast
         acc0 = self.acc0()  # create the rup/ datasets BEFORE swmr_on()
         self.datastore.swmr_on()
@@ -289,6 +299,7 @@ class ClassicalCalculator(base.HazardCalculator):
             acc = smap.get_results().reduce(self.agg_dicts, acc0)
             self.store_rlz_info(acc.eff_ruptures)
         finally:
+            self.datastore.flush()  # write the buffered rup/ datasets
             with self.monitor('store source_info'):
                 self.store_source_info(self.calc_times)
             if self.by_task:
@@ -311,6 +322,9 @@ class ClassicalCalculator(base.HazardCalculator):
         numsites = sum(arr[1] for arr in self.calc_times.values())
         logging.info('Effective number of ruptures: %d/%d',
                      self.numrups, self.totrups)
+        if oq.rupture_binning and self.numrups:
+            logging.info('Rupture binning compression ratio: %.1f',
+                         self.totrups / self.numrups)
         logging.info('Effective number of sites per rupture: %d',
                      numsites / self.numrups)
         self.calc_times.clear()  # save a bit of memory
@@ -339,7 +353,10 @@ class ClassicalCalculator(base.HazardCalculator):
             maximum_distance=oq.maximum_distance,
             pointsource_distance=oq.pointsource_distance,
             shift_hypo=oq.shift_hypo, max_weight=oq.max_weight,
-            max_sites_disagg=oq.max_sites_disagg)
+            max_sites_disagg=oq.max_sites_disagg,
+            poes_tolerance=oq.poes_tolerance,
+            rupture_binning=oq.rupture_binning,
+            mean_std_cache=oq.mean_std_cache)
         srcfilter = self.src_filter(self.datastore.tempname)
         if oq.calculation_mode == 'preclassical':
             f1 = f2 = preclassical
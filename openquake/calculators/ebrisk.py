@@ -45,6 +45,13 @@ gmf_info_dt = numpy.dtype([('rup_id', U32), ('task_no', U16),
                            ('nsites', U16), ('gmfbytes', F32), ('dt', F32)])
 
 
+def read_assets(dstore):
+    """
+    :returns: a DataFrame with the assets, indexed by ordinal
+    """
+    return dstore.read_df('assetcol/array', 'ordinal')
+
+
 def calc_risk(gmfs, param, monitor):
     """
     :param gmfs: an array of GMFs with fields sid, eid, gmv
@@ -57,11 +64,13 @@ def calc_risk(gmfs, param, monitor):
     eids = numpy.unique(gmfs['eid'])
     dstore = datastore.read(param['hdf5path'])
     with monitor('getting assets'):
-        assets_df = dstore.read_df('assetcol/array', 'ordinal')
+        # a copy of the cached DataFrame, so it can be modified safely
+        assets_df = dstore.cached('assetcol/array', read_assets)
     with monitor('getting crmodel'):
-        crmodel = riskmodels.CompositeRiskModel.read(dstore)
+        crmodel = dstore.cached(
+            'risk_model', riskmodels.CompositeRiskModel.read)
         events = dstore['events'][list(eids)]
-        weights = dstore['weights'][()]
+        weights = dstore.cached('weights')
     E = len(eids)
     L = len(param['lba'].loss_names)
     elt_dt = [('event_id', U32), ('rlzi', U16), ('loss', (F32, (L,)))]
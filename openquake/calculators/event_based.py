@@ -21,7 +21,7 @@ import logging
 import operator
 import numpy
 
-from openquake.baselib import hdf5
+from openquake.baselib import hdf5, datastore
 from openquake.baselib.general import AccumDict, get_indices, block_splitter
 from openquake.hazardlib.probability_map import ProbabilityMap
 from openquake.hazardlib.stats import compute_pmap_stats
@@ -30,12 +30,12 @@ from openquake.hazardlib import InvalidFile
 from openquake.hazardlib.source import rupture
 from openquake.risklib.riskinput import str2rsi
 from openquake.baselib import parallel
-from openquake.commonlib import source, calc, util, logs
+from openquake.commonlib import source, calc, util, logs, readinput
 from openquake.calculators import base, extract
 from openquake.calculators.getters import (
     GmfGetter, RuptureGetter, gen_rgetters, gen_rupture_getters,
     sig_eps_dt, time_dt)
-from openquake.calculators.classical import ClassicalCalculator
+from openquake.calculators.classical import ClassicalCalculator, by_typology
 from openquake.engine import engine
 
 U8 = numpy.uint8
@@ -47,6 +47,21 @@ TWO32 = numpy.float64(2 ** 32)
 by_grp = operator.attrgetter('src_group_id')
 
 
+def sample_ruptures_split(sources, srcfilter, param, monitor):
+    """
+    Sample the ruptures of the given sources, yielding back subtasks of
+    the duration suggested by the master, estimated with the cost model
+    of each source typology. Atomic groups are not split.
+    """
+    duration = getattr(monitor, 'task_duration', None)
+    if duration and not getattr(sources, 'atomic', False):
+        yield from parallel.split_task(
+            sample_ruptures, sources, srcfilter, param, monitor,
+            duration=duration, key=by_typology)
+    else:
+        yield from sample_ruptures(sources, srcfilter, param, monitor)
+
+
 # ######################## GMF calculator ############################ #
 
 def get_mean_curves(dstore):
@@ -79,7 +94,7 @@ class EventBasedCalculator(base.HazardCalculator):
     is_stochastic = True
     accept_precalc = ['event_based', 'ebrisk', 'event_based_risk',
                       'ucerf_hazard']
-    build_ruptures = sample_ruptures
+    build_ruptures = sample_ruptures_split
 
     def init(self):
         if hasattr(self, 'csm'):
@@ -157,10 +172,27 @@ class EventBasedCalculator(base.HazardCalculator):
                                 ses_idx += 1
                         else:
                             allargs.append((block, srcfilter, par))
-        smap = parallel.Starmap(
-            self.build_ruptures.__func__, allargs, h5=self.datastore.hdf5)
+        cache = datastore.get_product_cache()
+        dics = None
+        if cache:
+            # the ruptures depend on the sampling function (different for
+            # UCERF) and on the site collection used to filter the sources
+            key = readinput.get_cache_key(
+                oq, 'ruptures', self.build_ruptures.__func__.__name__,
+                self.sitecol.array.tobytes())
+            dics = cache.get_iter(key)
+            if dics is not None:
+                logging.info('Reading the ruptures from %s', cache.path(key))
+        if dics is None:
+            dics = parallel.Starmap(
+                self.build_ruptures.__func__, allargs, h5=self.datastore.hdf5)
+            if cache:
+                # the task outputs are pickled in the cache as they arrive,
+                # before saving them, since the serializer changes the
+                # geometry indices of the rup_array
+                dics = cache.put_iter(key, dics)
         mon = self.monitor('saving ruptures')
-        for dic in smap:
+        for dic in dics:
             if dic['calc_times']:
                 calc_times += dic['calc_times']
             if dic['eff_ruptures']:
@@ -207,9 +239,11 @@ class EventBasedCalculator(base.HazardCalculator):
                 times = result.pop('times')
                 rupids = list(times['rup_id'])
                 self.datastore['gmf_data/time_by_rup'][rupids] = times
-                hdf5.extend(self.datastore['gmf_data/data'], data)
+                # buffered, written when the buffer is full or at the end
+                self.datastore.appender('gmf_data/data').append(data)
                 sig_eps = result.pop('sig_eps')
-                hdf5.extend(self.datastore['gmf_data/sigma_epsilon'], sig_eps)
+                self.datastore.appender('gmf_data/sigma_epsilon').append(
+                    sig_eps)
                 for sid, start, stop in result['indices']:
                     self.indices[sid, 0].append(start + self.offset)
                     self.indices[sid, 1].append(stop + self.offset)
@@ -223,7 +257,7 @@ class EventBasedCalculator(base.HazardCalculator):
                 r, sid, imt = str2rsi(key)
                 array = acc[r].setdefault(sid, 0).array[imtls(imt), 0]
                 array[:] = 1. - (1. - array) * (1. - poes)
-        self.datastore.flush()
+        self.datastore.hdf5.flush()  # do not flush the appenders
         return acc
 
     def save_events(self, rup_array):
@@ -337,7 +371,9 @@ class EventBasedCalculator(base.HazardCalculator):
         N = len(self.sitecol.complete)
         if oq.ground_motion_fields:
             nrups = len(self.datastore['ruptures'])
-            self.datastore.create_dset('gmf_data/data', oq.gmf_data_dt())
+            gmf_data_dt = oq.gmf_data_dt()
+            self.datastore.create_dset('gmf_data/data', gmf_data_dt,
+                                       chunks=hdf5.get_chunks(gmf_data_dt))
             self.datastore.create_dset('gmf_data/sigma_epsilon',
                                        sig_eps_dt(oq.imtls))
             self.datastore.create_dset(
@@ -358,6 +394,7 @@ class EventBasedCalculator(base.HazardCalculator):
             self.core_task.__func__, iterargs, h5=self.datastore.hdf5,
             num_cores=oq.num_cores
         ).reduce(self.agg_dicts, self.acc0())
+        self.datastore.flush()  # write the buffered gmf_data
 
         if self.indices:
             dset = self.datastore['gmf_data/indices']
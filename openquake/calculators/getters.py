@@ -115,17 +115,12 @@ class PmapGetter(object):
         # populate _pmap_by_grp
         self._pmap_by_grp = {}
         if 'poes' in self.dstore:
-            # build probability maps restricted to the given sids
-            ok_sids = set(self.sids)
+            # read dense probability arrays restricted to the given sids
             for grp, dset in self.dstore['poes'].items():
-                ds = dset['array']
-                L, G = ds.shape[1:]
-                pmap = probability_map.ProbabilityMap(L, G)
-                for idx, sid in enumerate(dset['sids'][()]):
-                    if sid in ok_sids:
-                        pmap[sid] = probability_map.ProbabilityCurve(ds[idx])
-                self._pmap_by_grp[grp] = pmap
-                self.nbytes += pmap.nbytes
+                parray = probability_map.ProbabilityArray.read(
+                    dset, self.sids)
+                self._pmap_by_grp[grp] = parray
+                self.nbytes += parray.nbytes
         return self._pmap_by_grp
 
     # used in risk calculation where there is a single site per getter
@@ -144,15 +139,14 @@ class PmapGetter(object):
         """
         self.init()
         assert self.sids is not None
-        pmap = probability_map.ProbabilityMap(len(self.imtls.array), 1)
         grps = [grp] if grp is not None else sorted(self._pmap_by_grp)
+        pairs = []  # (ProbabilityArray, gsim index)
         for grp in grps:
             for gsim_idx, rlzis in enumerate(self.rlzs_by_grp[grp]):
-                for r in rlzis:
-                    if r == rlzi:
-                        pmap |= self._pmap_by_grp[grp].extract(gsim_idx)
-                        break
-        return pmap
+                if rlzi in rlzis:
+                    pairs.append((self._pmap_by_grp[grp], gsim_idx))
+        return probability_map.compose_arrays(
+            numpy.unique(self.sids), pairs, len(self.imtls.array))
 
     def get_pcurves(self, sid):  # used in classical
         """
@@ -547,6 +541,26 @@ class RuptureGetter(object):
     def num_ruptures(self):
         return len(self.proxies)
 
+    def split(self, n):
+        """
+        :param n: the number of parts
+        :returns: about n RuptureGetters with balanced weight, used to
+                  resubmit the tasks exceeding task_mem_limit
+        """
+        blocks = general.block_splitter(
+            self.proxies, self.weight / n, operator.attrgetter('weight'))
+        return [self.__class__(list(block), self.filename, self.grp_id,
+                               self.trt, self.samples, self.rlzs_by_gsim)
+                for block in blocks]
+
+    @property
+    def locality(self):
+        """
+        The ruptures of the same group are read from the same region of
+        the file, so they are dispatched preferably to the same hosts
+        """
+        return '%s:%d' % (self.filename, self.grp_id)
+
     def get_eid_rlz(self):
         """
         :returns: a composite array with the associations eid->rlz
@@ -87,7 +87,7 @@ def post_ebrisk(dstore, aggkey, monitor):
         idx = tuple(idx - 1 for idx in ast.literal_eval(aggkey))
     else:
         idx = (int(aggkey) - 1,)
-    builder = get_loss_builder(dstore)
+    builder = dstore.cached('loss_builder', get_loss_builder)
     out = {}
     for rlzi, curves, losses in builder.gen_curves_by_rlz(df, oq.ses_ratio):
         out[rlzi] = dict(agg_curves=curves, agg_losses=losses, idx=idx)
@@ -56,7 +56,10 @@ class UcerfClassicalCalculator(ClassicalCalculator):
         param = dict(imtls=oq.imtls, truncation_level=oq.truncation_level,
                      filter_distance=oq.filter_distance,
                      max_weight=oq.max_weight,
-                     max_sites_disagg=oq.max_sites_disagg)
+                     max_sites_disagg=oq.max_sites_disagg,
+                     poes_tolerance=oq.poes_tolerance,
+                     rupture_binning=oq.rupture_binning,
+                     mean_std_cache=oq.mean_std_cache)
         self.calc_times = general.AccumDict(accum=np.zeros(3, np.float32))
         [gsims] = self.csm.info.get_gsims_by_trt().values()
         sample = .001 if os.environ.get('OQ_SAMPLE_SOURCES') else None
@@ -16,6 +16,7 @@
 # You should have received a copy of the GNU Affero General Public License
 # along with OpenQuake. If not, see <http://www.gnu.org/licenses/>.
 import ast
+import json
 import os.path
 import numbers
 import operator
@@ -27,7 +28,7 @@ import numpy
 from openquake.baselib.general import (
     humansize, countby, AccumDict, CallableDict,
     get_array, group_array, fast_agg, fast_agg3)
-from openquake.baselib.performance import perf_dt
+from openquake.baselib.performance import perf_dt, chrome_trace
 from openquake.baselib.python3compat import encode, decode
 from openquake.hazardlib import valid
 from openquake.hazardlib.gsim.base import ContextMaker
@@ -436,22 +437,26 @@ def performance_view(dstore, add_calc_id=True):
     pdata = dstore['performance_data']
     pdata.refresh()
     data = sorted(pdata[()], key=operator.itemgetter(0))
+    has_cpu = 'cpu_sec' in pdata.dtype.names  # not in old datastores
     out = []
     for operation, group in itertools.groupby(data, operator.itemgetter(0)):
         counts = 0
         time = 0
+        cpu = 0
         mem = 0
         for rec in group:
             counts += rec['counts']
             time += rec['time_sec']
+            cpu += rec['cpu_sec'] if has_cpu else numpy.nan
             mem = max(mem, rec['memory_mb'])
-        out.append((operation, time, mem, counts))
+        out.append((operation, time, cpu, mem, counts))
     out.sort(key=operator.itemgetter(1), reverse=True)  # sort by time
     if add_calc_id:
         dtlist = [('calc_%d' % dstore.calc_id, perf_dt['operation'])]
     else:
         dtlist = [('operation', perf_dt['operation'])]
-    dtlist.extend((n, perf_dt[n]) for n in perf_dt.names[1:-1])
+    dtlist.extend((n, perf_dt[n]) for n in
+                  ['time_sec', 'cpu_sec', 'memory_mb', 'counts'])
     return numpy.array(out, dtlist)
 
 
@@ -463,6 +468,19 @@ def view_performance(token, dstore):
     return rst_table(performance_view(dstore))
 
 
+@view.add('trace')
+def view_trace(token, dstore):
+    """
+    Display the timeline of the tasks in the Chrome trace event format:
+    save it with `oq show trace > trace.json` and load it in
+    chrome://tracing or ui.perfetto.dev
+    """
+    task_info = dstore['task_info'][()]
+    if 'start' not in task_info.dtype.names:  # old datastore
+        return 'Not available'
+    return json.dumps(chrome_trace(task_info))
+
+
 def stats(name, array, *extras):
     """
     Returns statistics from an array of numbers.
@@ -550,16 +568,68 @@ def view_task_info(token, dstore):
         data.sort(order='duration')
         return rst_table(data)
 
-    data = ['operation-duration mean stddev min max outputs'.split()]
+    data = ['operation-duration mean stddev min max outputs '
+            'predicted'.split()]
     for task, arr in group_array(task_info[()], 'taskname').items():
         val = arr['duration']
         if len(val):
-            data.append(stats(task, val))
+            # mean duration predicted by the cost model of the Starmap
+            try:
+                pred = arr['predicted'][~numpy.isnan(arr['predicted'])]
+            except ValueError:  # old datastore without predictions
+                pred = []
+            data.append(stats(task, val,
+                              pred.mean() if len(pred) else numpy.nan))
     if len(data) == 1:
         return 'Not available'
     return rst_table(data)
 
 
+@view.add('cost_model')
+def view_cost_model(token, dstore):
+    """
+    Display the time per unit of weight fitted on the tasks, by task
+    name and by kind of element (for the tasks split by split_task)
+    """
+    if 'cost_model' not in dstore:
+        return 'Not available'
+    dic = ast.literal_eval(decode(dstore['cost_model'][()]))
+    data = [(key, weight, time, time / weight if weight else numpy.nan)
+            for key, (weight, time) in sorted(dic.items())]
+    return rst_table(data, ['key', 'weight', 'time', 'time_per_weight'])
+
+
+@view.add('profile')
+def view_profile(token, dstore):
+    """
+    Display the functions where the tasks spent most of their time, as
+    sampled by the profiler (see profile_interval in openquake.cfg), with
+    the percentage of samples spent in the function itself and in the
+    function plus its callees. To get the stacks in the folded format
+    accepted by flamegraph.pl use::
+
+      $ oq show profile:folded
+    """
+    if 'profile' not in dstore:
+        return 'Not available'
+    lines = decode(dstore['profile'][()])
+    if token == 'profile:folded':
+        return '\n'.join(lines)
+    own = collections.Counter()
+    cumulative = collections.Counter()
+    tot = 0
+    for line in lines:
+        stack, count = line.rsplit(' ', 1)
+        funcs = stack.split(';')
+        own[funcs[-1]] += int(count)
+        for func in set(funcs):
+            cumulative[func] += int(count)
+        tot += int(count)
+    data = [(func, n, n / tot * 100, cumulative[func] / tot * 100)
+            for func, n in own.most_common(30)]
+    return rst_table(data, ['function', 'samples', 'own%', 'cumulative%'])
+
+
 @view.add('task_durations')
 def view_task_durations(token, dstore):
     """
@@ -17,6 +17,7 @@
 # along with OpenQuake. If not, see <http://www.gnu.org/licenses/>.
 import os
 import re
+import glob
 import getpass
 from openquake.baselib import sap, datastore
 from openquake.commonlib.logs import dbcmd
@@ -30,8 +31,9 @@ def purge_one(calc_id, user, force):
     """
     dbcmd('del_calc', calc_id, user, force)
     f1 = os.path.join(datadir, 'calc_%s.hdf5' % calc_id)
-    f2 = os.path.join(datadir, 'calc_%s_tmp.hdf5' % calc_id)
-    for f in [f1, f2]:
+    # the temporary file and the sidecars calc_XXX_<name>.hdf5
+    fs = glob.glob(os.path.join(datadir, 'calc_%s_*.hdf5' % calc_id))
+    for f in [f1] + fs:
         if os.path.exists(f):  # not removed yet
             os.remove(f)
             print('Removed %s' % f)
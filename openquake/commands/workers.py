@@ -27,7 +27,7 @@ ro_commands = ('status', 'inspect')
 @sap.script
 def workers(cmd):
     """
-    start/stop/restart the workers, or return their status
+    start/stop/restart/check the workers, or return their status
     """
     if (cmd not in ro_commands and config.dbserver.multi_user and
             getpass.getuser() != 'openquake'):
@@ -38,4 +38,4 @@ def workers(cmd):
 
 
 workers.arg('cmd', 'command',
-            choices='start stop status restart inspect'.split())
+            choices='start stop status restart inspect check'.split())
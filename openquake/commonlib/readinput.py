@@ -20,6 +20,7 @@ import ast
 import csv
 import copy
 import zlib
+import hashlib
 import shutil
 import zipfile
 import logging
@@ -30,7 +31,7 @@ import collections
 import numpy
 import requests
 
-from openquake.baselib import hdf5
+from openquake.baselib import hdf5, datastore, __version__
 from openquake.baselib.general import (
     random_filter, countby, group_array, get_duplicates)
 from openquake.baselib.python3compat import decode, zip
@@ -44,7 +45,7 @@ from openquake.hazardlib.probability_map import ProbabilityMap
 from openquake.risklib import asset, riskmodels
 from openquake.risklib.riskmodels import get_risk_models
 from openquake.commonlib.oqvalidation import OqParam
-from openquake.commonlib.source_reader import get_ltmodels
+from openquake.commonlib.source_reader import get_ltmodels, source_info_dt
 from openquake.commonlib import logictree, source
 
 # the following is quite arbitrary, it gives output weights that I like (MS)
@@ -58,6 +59,21 @@ U64 = numpy.uint64
 Site = collections.namedtuple('Site', 'sid lon lat')
 gsim_lt_cache = {}  # fname, trt1, ..., trtN -> GsimLogicTree instance
 
+# parameters entering in the hazard checksum and in the key of the
+# ProductCache (see get_cache_key): any new parameter affecting the sources
+# or the sampling of the ruptures must be added here or in CSM_PARAMS,
+# otherwise the cache will silently return stale products
+HAZARD_PARAMS = ('rupture_mesh_spacing', 'complex_fault_mesh_spacing',
+                 'width_of_mfd_bin', 'area_source_discretization',
+                 'random_seed', 'ses_seed', 'truncation_level',
+                 'maximum_distance', 'investigation_time',
+                 'number_of_logic_tree_samples', 'imtls',
+                 'pointsource_distance',
+                 'ses_per_logic_tree_path', 'minimum_magnitude',
+                 'sites', 'filter_distance')
+# other parameters changing the composite source model
+CSM_PARAMS = ('disagg_by_src', 'source_id')
+
 
 class DuplicatedPoint(Exception):
     """
@@ -603,12 +619,43 @@ def get_source_model_lt(oqparam, validate=True):
 def get_composite_source_model(oqparam, h5=None):
     """
     Parse the XML and build a complete composite source model in memory.
+    If the ProductCache is enabled, the model and the source info are read
+    from there when the hazard inputs did not change.
 
     :param oqparam:
         an :class:`openquake.commonlib.oqvalidation.OqParam` instance
     :param h5:
          an open hdf5.File where to store the source info
     """
+    cache = datastore.get_product_cache()
+    if cache is None or 'OQ_SAMPLE_SOURCES' in os.environ:
+        return _get_csm(oqparam, h5)
+    # the serials of the ruptures are initialized only in event based
+    kind = 'event_based' if oqparam.is_event_based() else 'classical'
+    if oqparam.calculation_mode.startswith('ucerf'):
+        kind = 'ucerf_' + kind
+    key = get_cache_key(oqparam, 'csm', kind)
+    cached = cache.get(key)
+    if cached is None:
+        csm = _get_csm(oqparam, h5)
+        if h5:
+            mags = h5['source_mags'][()] if 'source_mags' in h5 else None
+            cache.put(key, (csm, h5['source_info'][()], mags))
+        else:
+            cache.put(key, (csm, None, None))
+        return csm
+    logging.info('Reading the composite source model from %s',
+                 cache.path(key))
+    csm, source_info, mags = cached
+    if h5 and source_info is not None:
+        hdf5.extend(hdf5.create(h5, 'source_info', source_info_dt),
+                    source_info)
+        if mags is not None:
+            h5['source_mags'] = mags
+    return csm
+
+
+def _get_csm(oqparam, h5):
     ucerf = oqparam.calculation_mode.startswith('ucerf')
     source_model_lt = get_source_model_lt(oqparam, validate=not ucerf)
     trts = source_model_lt.tectonic_region_types
@@ -930,17 +977,18 @@ def get_input_files(oqparam, hazard=False):
     return sorted(fnames)
 
 
-def _checksum(fname, checksum):
+def _read_bytes(fname):
     if not os.path.exists(fname):
         zpath = os.path.splitext(fname)[0] + '.zip'
         if not os.path.exists(zpath):
             raise OSError('No such file: %s or %s' % (fname, zpath))
-        with open(zpath, 'rb') as f:
-            data = f.read()
-    else:
-        with open(fname, 'rb') as f:
-            data = f.read()
-    return zlib.adler32(data, checksum)
+        fname = zpath
+    with open(fname, 'rb') as f:
+        return f.read()
+
+
+def _checksum(fname, checksum):
+    return zlib.adler32(_read_bytes(fname), checksum)
 
 
 def get_checksum32(oqparam, hazard=False):
@@ -959,15 +1007,32 @@ def get_checksum32(oqparam, hazard=False):
     if hazard:
         hazard_params = []
         for key, val in vars(oqparam).items():
-            if key in ('rupture_mesh_spacing', 'complex_fault_mesh_spacing',
-                       'width_of_mfd_bin', 'area_source_discretization',
-                       'random_seed', 'ses_seed', 'truncation_level',
-                       'maximum_distance', 'investigation_time',
-                       'number_of_logic_tree_samples', 'imtls',
-                       'pointsource_distance',
-                       'ses_per_logic_tree_path', 'minimum_magnitude',
-                       'sites', 'filter_distance'):
+            if key in HAZARD_PARAMS:
                 hazard_params.append('%s = %s' % (key, val))
         data = '\n'.join(hazard_params).encode('utf8')
         checksum = zlib.adler32(data, checksum) & 0xffffffff
     return checksum
+
+
+def get_cache_key(oqparam, *extra):
+    """
+    Build the key of an intermediate product in the ProductCache from the
+    hazard input files, the hazard parameters and the engine version.
+
+    :param oqparam: an OqParam instance
+    :param extra: strings or bytes entering in the key (the product name,
+                  the site collection array...)
+    :returns: a SHA256 hex digest
+    """
+    # NB: only the parameters in HAZARD_PARAMS + CSM_PARAMS enter in the
+    # key; a parameter affecting the sources or the rupture sampling which
+    # is not listed there would make the cache return stale ruptures
+    sha = hashlib.sha256(__version__.encode('utf8'))
+    for fname in get_input_files(oqparam, hazard=True):
+        sha.update(_read_bytes(fname))
+    for key in sorted(HAZARD_PARAMS + CSM_PARAMS):
+        val = getattr(oqparam, key, None)
+        sha.update(('%s = %s\n' % (key, val)).encode('utf8'))
+    for obj in extra:
+        sha.update(obj if isinstance(obj, bytes) else obj.encode('utf8'))
+    return sha.hexdigest()
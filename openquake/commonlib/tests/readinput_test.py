@@ -22,7 +22,7 @@ import unittest.mock as mock
 import unittest
 from io import BytesIO
 
-from openquake.baselib import general, datastore
+from openquake.baselib import general, datastore, config
 from openquake.hazardlib import InvalidFile
 from openquake.risklib import asset
 from openquake.risklib.riskmodels import ValidationError
@@ -465,6 +465,30 @@ class GetCompositeSourceModelTestCase(unittest.TestCase):
             info.call_args[0],
             ('Applied %d changes to the composite source model', 81))
 
+    def test_product_cache(self):
+        oq = readinput.get_oqparam('job.ini', case_2)
+        cache_dir = tempfile.mkdtemp()
+        with mock.patch.dict(config.directory, cache_dir=cache_dir), \
+                mock.patch.dict(os.environ, OQ_DISTRIBUTE='no'):
+            with datastore.hdf5new() as h5:
+                csm = readinput.get_composite_source_model(oq, h5)
+                info = h5['source_info'][()]
+            os.remove(h5.filename)
+            key = readinput.get_cache_key(oq, 'csm', 'classical')
+            self.assertEqual(os.listdir(cache_dir), [key + '.pik'])
+            with mock.patch('openquake.commonlib.readinput._get_csm') as get, \
+                    datastore.hdf5new() as h5:
+                cached = readinput.get_composite_source_model(oq, h5)
+                self.assertEqual(h5['source_info'][()].tolist(), info.tolist())
+            os.remove(h5.filename)
+            self.assertFalse(get.called)
+            self.assertEqual(len(cached.get_sources()),
+                             len(csm.get_sources()))
+            # changing a hazard parameter invalidates the cache
+            oq.width_of_mfd_bin /= 2
+            self.assertNotEqual(
+                readinput.get_cache_key(oq, 'csm', 'classical'), key)
+
     def test_extra_large_source(self):
         raise unittest.SkipTest('Removed check on MAX_EXTENT')
         oq = readinput.get_oqparam('job.ini', case_21)
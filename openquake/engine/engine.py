@@ -336,7 +336,9 @@ def run_calc(job_id, oqparam, exports, hazard_calculation_id=None, **kw):
             logging.warning('Using %d cores on %s',
                             parallel.CT // 2, platform.node())
         if OQ_DISTRIBUTE == 'zmq' and config.zworkers['host_cores']:
-            logs.dbcmd('zmq_start')  # start the zworkers
+            # start the zworkers; in keep_alive mode the running ones are
+            # checked and their dead workers restarted
+            logs.dbcmd('zmq_start')
             logs.dbcmd('zmq_wait')  # wait for them to go up
         set_concurrent_tasks_default(calc)
         t0 = time.time()
@@ -364,7 +366,8 @@ def run_calc(job_id, oqparam, exports, hazard_calculation_id=None, **kw):
         # if there was an error in the calculation, this part may fail;
         # in such a situation, we simply log the cleanup error without
         # taking further action, so that the real error can propagate
-        if OQ_DISTRIBUTE == 'zmq' and config.zworkers['host_cores']:
+        if (OQ_DISTRIBUTE == 'zmq' and config.zworkers['host_cores'] and
+                not config.zworkers.keep_alive):
             logs.dbcmd('zmq_stop')  # stop the zworkers
         try:
             if OQ_DISTRIBUTE.startswith('celery'):
@@ -252,6 +252,14 @@ class SourceFilter(object):
             return dict(filename=None, sitecol=self.sitecol,
                         integration_distance=self.integration_distance)
 
+    @property
+    def locality(self):
+        """
+        The name of the .hdf5 cache file, if any, used to dispatch the
+        tasks preferably to the hosts which already read it
+        """
+        return self.filename
+
     @property
     def sitecol(self):
         """
@@ -167,6 +167,14 @@ def calc_hazard_curves(
         The distance used to filter the ruptures (default rjb)
     :param reqv:
         If not None, an instance of RjbEquivalent
+    :param kwargs:
+        Extra parameters, like ``shift_hypo``, ``poes_tolerance``
+        (if positive, the PoEs are computed with a lookup table with that
+        maximum absolute error), ``rupture_binning`` (a dictionary of
+        bin widths, see :meth:`openquake.hazardlib.contexts.PmapMaker.bin`)
+        and ``mean_std_cache`` (the size in MB of the cache of the means
+        and standard deviations, see
+        :class:`openquake.hazardlib.contexts.MeanStdCache`)
     :returns:
         An array of size N, where N is the number of sites, which elements
         are records with fields given by the intensity measure types; the
@@ -187,7 +195,10 @@ def calc_hazard_curves(
     shift_hypo = kwargs['shift_hypo'] if 'shift_hypo' in kwargs else False
     param = dict(imtls=imtls, truncation_level=truncation_level,
                  filter_distance=filter_distance, reqv=reqv,
-                 cluster=grp.cluster, shift_hypo=shift_hypo)
+                 cluster=grp.cluster, shift_hypo=shift_hypo,
+                 poes_tolerance=kwargs.get('poes_tolerance', 0),
+                 rupture_binning=kwargs.get('rupture_binning', {}),
+                 mean_std_cache=kwargs.get('mean_std_cache', 0))
     pmap = ProbabilityMap(len(imtls.array), 1)
     # Processing groups with homogeneous tectonic region
     gsim = gsim_by_trt[groups[0][0].tectonic_region_type]
@@ -22,20 +22,27 @@ import time
 import warnings
 import operator
 import itertools
+import weakref
+import collections
 import numpy
 from scipy.interpolate import interp1d
 
 
-from openquake.baselib.general import AccumDict, DictArray
+from openquake.baselib.general import AccumDict, DictArray, block_splitter
 from openquake.baselib.performance import Monitor
 from openquake.hazardlib import imt as imt_module
 from openquake.hazardlib.gsim import base
 from openquake.hazardlib.calc.filters import IntegrationDistance, getdefault
 from openquake.hazardlib.probability_map import ProbabilityMap
 from openquake.hazardlib.geo.surface import PlanarSurface
+from openquake.hazardlib.geo.surface.planar import get_distances_planar
+from openquake.hazardlib.geo.geodetic import spherical_to_cartesian
+from openquake.hazardlib.geo.mesh import Mesh
 
 I16 = numpy.int16
+I64 = numpy.int64
 F32 = numpy.float32
+MAX_POES = 10 ** 7  # max size of the PoEs array of a block of contexts
 KNOWN_DISTANCES = frozenset(
     'rrup rx ry0 rjb rhypo repi rcdpp azimuth azimuth_cp rvolc'.split())
 
@@ -130,6 +137,68 @@ class RupData(object):
         self.data['lat_'].append(F32(closest.lats))
 
 
+class MeanStdCache(object):
+    """
+    Least recently used cache of the means and standard deviations computed
+    by the GSIMs of a ContextMaker, with a cap on the total memory. The key
+    of a context is built by quantizing the rupture parameters, the site
+    parameters and the distances required by the GSIMs with the given
+    precision, so it assumes that the GSIMs do not depend on anything else.
+
+    :param maxbytes: maximum size of the cached arrays; 0 disables the cache
+    :param precision: quantization step of the parameters
+    """
+    instances = weakref.WeakSet()  # used by clear_all
+
+    def __init__(self, maxbytes, precision=1E-3):
+        self.maxbytes = maxbytes
+        self.precision = precision
+        self.arrays = collections.OrderedDict()  # key -> array
+        self.nbytes = 0
+        self.instances.add(self)
+
+    @classmethod
+    def clear_all(cls):
+        """
+        Clear all the living caches (called by the persistent workers
+        when a new calculation starts)
+        """
+        for cache in list(cls.instances):
+            cache.clear()
+
+    def clear(self):
+        """
+        Remove all the cached arrays
+        """
+        self.arrays.clear()
+        self.nbytes = 0
+
+    def get(self, key):
+        """
+        :returns: the cached array for the key or None
+        """
+        try:
+            self.arrays.move_to_end(key)
+        except KeyError:
+            return None
+        return self.arrays[key]
+
+    def put(self, key, array):
+        """
+        Store an array, evicting the least recently used ones if needed
+        """
+        if array.nbytes > self.maxbytes or key in self.arrays:
+            return
+        self.arrays[key] = array
+        self.nbytes += array.nbytes
+        while self.nbytes > self.maxbytes:  # evict the oldest
+            _, arr = self.arrays.popitem(last=False)
+            self.nbytes -= arr.nbytes
+
+    def __len__(self):
+        return len(self.arrays)
+
+
 class ContextMaker(object):
     """
     A class to manage the creation of contexts for distances, sites, rupture.
@@ -144,6 +213,10 @@ class ContextMaker(object):
         self.maximum_distance = (
             param.get('maximum_distance') or IntegrationDistance({}))
         self.trunclevel = param.get('truncation_level')
+        # if positive, compute the PoEs with a TruncNormTable
+        self.poes_tolerance = param.get('poes_tolerance', 0)
+        # if not empty, a dictionary name -> bin width used in PmapMaker.bin
+        self.rupture_binning = param.get('rupture_binning', {})
         self.effect = param.get('effect')
         for req in self.REQUIRES:
             reqset = set()
@@ -169,6 +242,12 @@ class ContextMaker(object):
                     self.gsim_by_rlzi[rlzi] = gsim
         self.mon = monitor
         self.ctx_mon = monitor('make_contexts', measuremem=False)
+        # if positive, cache the means and stddevs of the contexts; the
+        # counts of the monitors are the hits and misses of the cache
+        self.cache = MeanStdCache(
+            param.get('mean_std_cache', 0) * 1024 ** 2)
+        self.hit_mon = monitor('mean_std cache hits', measuremem=False)
+        self.miss_mon = monitor('mean_std cache misses', measuremem=False)
         self.loglevels = DictArray(self.imtls)
         self.shift_hypo = param.get('shift_hypo')
         with warnings.catch_warnings():
@@ -248,7 +327,12 @@ class ContextMaker(object):
             distance parameters) is unknown.
         """
         sites, dctx = self.filter(sites, rupture)
-        for param in self.REQUIRES_DISTANCES - set([self.filter_distance]):
+        return self._make_contexts(sites, rupture, dctx)
+
+    def _make_contexts(self, sites, rupture, dctx):
+        # add the distances not already in the DistancesContext and the
+        # rupture parameters for the filtered sites
+        for param in self.REQUIRES_DISTANCES - set(vars(dctx)):
             distances = get_distances(rupture, sites, param)
             setattr(dctx, param, distances)
         reqv_obj = (self.reqv.get(rupture.tectonic_region_type)
@@ -266,6 +350,9 @@ class ContextMaker(object):
         """
         :returns: a list of triples (rctx, sctx, dctx)
         """
+        if len(ruptures) > 1 and all(
+                type(rup.surface) is PlanarSurface for rup in ruptures):
+            return self._make_planar_ctxs(ruptures, sites)
         ctxs = []
         for rup in ruptures:
             try:
@@ -275,6 +362,139 @@ class ContextMaker(object):
             ctxs.append((rup, sctx, dctx))
         return ctxs
 
+    def _make_planar_ctxs(self, ruptures, sites):
+        # same as make_ctxs, but the filtering is performed for all the
+        # ruptures sharing the same hypocenter at once: the distances are
+        # computed as arrays of shape (R, N) for the N sites closer to the
+        # hypocenter than the maximum distance plus the farthest corner of
+        # the ruptures; the ruptures with the same close sites share them
+        params = (self.REQUIRES_DISTANCES & {'rjb', 'rx', 'ry0'}) | {'rrup'}
+        xyz = sites.xyz
+        by_hypo = AccumDict(accum=[])  # hypocenter -> rupture indices
+        for r, rup in enumerate(ruptures):
+            hypo = rup.hypocenter
+            by_hypo[hypo.longitude, hypo.latitude, hypo.depth].append(r)
+        filtered = {}  # mask -> filtered sites
+        ctxs = [None] * len(ruptures)
+        for hypo, idxs in by_hypo.items():
+            rups = [ruptures[r] for r in idxs]
+            mdists = numpy.array([
+                self.maximum_distance(rup.tectonic_region_type, rup.mag)
+                for rup in rups])
+            surfaces = [rup.surface for rup in rups]
+            hxyz = spherical_to_cartesian(*hypo)
+            corners = spherical_to_cartesian(
+                numpy.array([s.corner_lons for s in surfaces]),
+                numpy.array([s.corner_lats for s in surfaces]),
+                numpy.array([s.corner_depths for s in surfaces]))
+            radius = numpy.sqrt(((corners - hxyz) ** 2).sum(axis=-1)).max()
+            close, = (numpy.sqrt(((xyz - hxyz) ** 2).sum(axis=-1)) <=
+                      mdists.max() + radius).nonzero()
+            if len(close) == 0:  # all ruptures are far away
+                continue
+            mesh = Mesh(sites.lons[close], sites.lats[close],
+                        sites.depths[close])
+            dists = get_distances_planar(surfaces, mesh, params)
+            for i, (r, rup) in enumerate(zip(idxs, rups)):
+                ok = dists['rrup'][i] <= mdists[i]
+                if not ok.any():  # far away rupture
+                    continue
+                mask = numpy.zeros(len(sites), bool)
+                mask[close[ok]] = True
+                key = mask.tobytes()
+                try:
+                    r_sites = filtered[key]
+                except KeyError:
+                    r_sites = filtered[key] = sites.filter(mask)
+                dctx = DistancesContext()
+                for param in params:
+                    dist = dists[param][i][ok]
+                    dist.flags.writeable = False
+                    setattr(dctx, param, dist)
+                ctxs[r] = (rup,) + self._make_contexts(r_sites, rup, dctx)
+        return [ctx for ctx in ctxs if ctx]
+
+    def _get_mean_std(self, ctxs):
+        # compute the means and stddevs by stacking the contexts
+        if len(ctxs) == 1:
+            [(rctx, sctx, dctx)] = ctxs
+        else:
+            sctx, rctx, dctx = self.stack(ctxs)
+        return base.get_mean_std(sctx, rctx, dctx, self.imts, self.gsims)
+
+    def _cache_key(self, ctx):
+        # quantize the parameters required by the GSIMs
+        rup, sites, dctx = ctx
+        prec = self.cache.precision
+        key = [_bin(getattr(rup, par), prec)
+               for par in sorted(self.REQUIRES_RUPTURE_PARAMETERS)]
+        for par in sorted(self.REQUIRES_SITES_PARAMETERS):
+            arr = getattr(sites, par)
+            if arr.dtype.kind == 'f':
+                arr = _bin(arr, prec)
+            key.append(arr.tobytes())
+        for name in sorted(self.REQUIRES_DISTANCES):
+            key.append(_bin(getattr(dctx, name), prec).tobytes())
+        return tuple(key)
+
+    def get_mean_std(self, ctxs):
+        """
+        :param ctxs: a list of triples (rup, sites, dctx)
+        :returns: an array of shape (2, N, M, G) for the N rupture-site pairs
+
+        If the cache is enabled, the means and stddevs of the contexts
+        already seen are taken from the cache and only the others are
+        computed.
+        """
+        if self.cache.maxbytes <= 0:
+            return self._get_mean_std(ctxs)
+        keys = [self._cache_key(ctx) for ctx in ctxs]
+        arrays = [self.cache.get(key) for key in keys]
+        missing = [ctx for ctx, arr in zip(ctxs, arrays) if arr is None]
+        self.hit_mon.counts += len(ctxs) - len(missing)
+        self.miss_mon.counts += len(missing)
+        if missing:
+            mean_std = self._get_mean_std(missing)
+            start = 0
+            for i, ctx in enumerate(ctxs):
+                if arrays[i] is None:
+                    stop = start + len(ctx[1])
+                    arrays[i] = mean_std[:, start:stop].copy()
+                    self.cache.put(keys[i], arrays[i])
+                    start = stop
+            if len(missing) == len(ctxs):
+                return mean_std
+        return numpy.concatenate(arrays, axis=1)
+
+    def stack(self, ctxs):
+        """
+        :param ctxs: a list of triples (rup, sites, dctx)
+        :returns: a triple (sctx, rctx, dctx) of stacked contexts
+
+        The stacked contexts have a row for each (rupture, site) pair, i.e.
+        the rupture parameters are repeated for each site of the rupture.
+        The stacked RuptureContext has also the attributes ``.ctxs``
+        (the original contexts) and ``.slices`` (the rows of each rupture).
+        """
+        nsites = [len(sites) for rup, sites, dctx in ctxs]
+        stops = numpy.cumsum(nsites)
+        rctx = RuptureContext()
+        rctx.ctxs = ctxs
+        rctx.slices = [slice(stop - n, stop) for n, stop in zip(nsites, stops)]
+        for par in self.REQUIRES_RUPTURE_PARAMETERS:
+            vals = [getattr(rup, par) for rup, sites, dctx in ctxs]
+            setattr(rctx, par, numpy.repeat(vals, nsites))
+        sctx = SitesContext(self.REQUIRES_SITES_PARAMETERS)
+        sctx.sids = numpy.concatenate([sites.sids for _, sites, _ in ctxs])
+        for par in self.REQUIRES_SITES_PARAMETERS:
+            setattr(sctx, par, numpy.concatenate(
+                [getattr(sites, par) for _, sites, _ in ctxs]))
+        dctx = DistancesContext()
+        for par in vars(ctxs[0][2]):
+            setattr(dctx, par, numpy.concatenate(
+                [getattr(dist, par) for _, _, dist in ctxs]))
+        return sctx, rctx, dctx
+
     def max_intensity(self, onesite, mags, dists):
         """
         :param onesite: a SiteCollection instance with a single site
@@ -319,20 +539,24 @@ class ContextMaker(object):
         pmaker = PmapMaker(self, srcfilter, group)
         totrups = 0
         src_sites = srcfilter(group)
-        while True:
-            t0 = time.time()
-            try:
-                src, sites = next(src_sites)
-                poemap = pmaker.make(src, sites, pmap, rup_data)
-            except StopIteration:
-                break
-            except Exception as err:
-                etype, err, tb = sys.exc_info()
-                msg = '%s (source id=%s)' % (str(err), src.source_id)
-                raise etype(msg).with_traceback(tb)
-            totrups += poemap.totrups
-            calc_times[src.id] += numpy.array(
-                [poemap.numrups, poemap.nsites, time.time() - t0])
+        if pmaker.binning:
+            totrups = pmaker.make_binned(
+                src_sites, pmap, rup_data, calc_times)
+        else:  # compute the PoEs source by source
+            while True:
+                t0 = time.time()
+                try:
+                    src, sites = next(src_sites)
+                    poemap = pmaker.make(src, sites, pmap, rup_data)
+                except StopIteration:
+                    break
+                except Exception as err:
+                    etype, err, tb = sys.exc_info()
+                    msg = '%s (source id=%s)' % (str(err), src.source_id)
+                    raise etype(msg).with_traceback(tb)
+                totrups += poemap.totrups
+                calc_times[src.id] += numpy.array(
+                    [poemap.numrups, poemap.nsites, time.time() - t0])
 
         rdata = {k: numpy.array(v) for k, v in rup_data.items()}
         rdata['grp_id'] = numpy.uint16(rup_data['grp_id'])
@@ -356,6 +580,32 @@ def _collapse_ctxs(ctxs):
     return [(rup, sites, dctx)]
 
 
+def _bin(value, width):
+    # bin index of a value (or an array of values); width 0 means no binning
+    if width == 0:
+        return value
+    return I64(numpy.round(value / width))
+
+
+def _bin_ctxs(ctxs, params):
+    # merge the contexts in a bin into a single context with the total
+    # occurrence rate and rate-weighted averages of the rupture parameters
+    # and of the distances
+    if len(ctxs) == 1:
+        return ctxs[0]
+    rup, sites, dctx = ctxs[0]
+    rates = numpy.array([ctx[0].occurrence_rate for ctx in ctxs])
+    weights = rates / rates.sum()
+    rup = copy.copy(rup)
+    rup.occurrence_rate = rates.sum()
+    for param in params:
+        setattr(rup, param, weights @ [getattr(ctx[0], param) for ctx in ctxs])
+    new = DistancesContext()
+    for name in vars(dctx):
+        setattr(new, name, weights @ [getattr(ctx[2], name) for ctx in ctxs])
+    return rup, sites, new
+
+
 class PmapMaker(object):
     """
     A class to compute the PoEs from a given source
@@ -371,73 +621,120 @@ class PmapMaker(object):
         self.poe_mon = cmaker.mon('get_poes', measuremem=False)
         self.pne_mon = cmaker.mon('composing pnes', measuremem=False)
         self.gmf_mon = cmaker.mon('computing mean_std', measuremem=False)
-
-    def _sids_poes(self, rup, r_sites, dctx, srcid):
-        # return sids and poes of shape (N, L, G)
-        # NB: this must be fast since it is inside an inner loop
-        with self.gmf_mon:
-            mean_std = base.get_mean_std(  # shape (2, N, M, G)
-                r_sites, rup, dctx, self.imts, self.gsims)
-        with self.poe_mon:
-            ll = self.loglevels
-            poes = base.get_poes(mean_std, ll, self.trunclevel, self.gsims)
-            for g, gsim in enumerate(self.gsims):
-                for m, imt in enumerate(ll):
-                    if hasattr(gsim, 'weight') and gsim.weight[imt] == 0:
-                        # set by the engine when parsing the gsim logictree;
-                        # when 0 ignore the gsim: see _build_trts_branches
-                        poes[:, ll(imt), g] = 0
-            return r_sites.sids, poes
+        if self.poes_tolerance and self.trunclevel != 0:
+            self.poes_table = base.TruncNormTable(
+                self.trunclevel, self.poes_tolerance)
+        else:
+            self.poes_table = None
+        self.poes_buf = numpy.zeros(0)  # work array reused across blocks
+        # bin the ruptures of different sources together, see make_binned
+        self.binning = bool(self.rupture_binning and self.rup_indep and
+                            not self.src_mutex and
+                            not getattr(group, 'cluster', None))
+
+    def _get_poes_buf(self, shape):
+        # returns a view of the work array with the given shape, by
+        # growing the work array if needed
+        size = numpy.prod(shape)
+        if len(self.poes_buf) < size:
+            self.poes_buf = numpy.zeros(size)
+        return self.poes_buf[:size].reshape(shape)
+
+    def _gen_poes(self, ctxs):
+        # yield triples (rup, sids, poes) with poes of shape (N, L, G);
+        # the contexts are stacked in blocks, so that the GSIMs and
+        # get_poes are called once per block and not once per rupture
+        # NB: this must be fast since it is inside an inner loop;
+        # the yielded poes are views over self.poes_buf, which is
+        # overwritten by the next block, so they must be consumed at once
+        ll = self.loglevels
+        L, G = len(ll.array), len(self.gsims)
+        maxrows = max(MAX_POES // (L * G), 1)
+        for block in block_splitter(ctxs, maxrows, lambda ctx: len(ctx[1])):
+            with self.gmf_mon:
+                # shape (2, N, M, G)
+                mean_std = self.cmaker.get_mean_std(block)
+            with self.poe_mon:
+                out = self._get_poes_buf((mean_std.shape[1], L, G))
+                poes = base.get_poes(mean_std, ll, self.trunclevel,
+                                     self.gsims, out, self.poes_table)
+                for g, gsim in enumerate(self.gsims):
+                    for m, imt in enumerate(ll):
+                        if hasattr(gsim, 'weight') and gsim.weight[imt] == 0:
+                            # set by the engine when parsing the gsim
+                            # logictree; when 0 ignore the gsim: see
+                            # _build_trts_branches
+                            poes[:, ll(imt), g] = 0
+            start = 0
+            for rup, r_sites, _ in block:
+                stop = start + len(r_sites)
+                yield rup, r_sites.sids, poes[start:stop]
+                start = stop
 
     def _update(self, pmap, pm, src):
-        if self.rup_indep:
-            pm = ~pm
         if not pm:
             return
-        if self.src_mutex:
-            pm *= src.mutex_weight
         for grp_id in src.src_group_ids:
             if self.src_mutex:
                 pmap[grp_id] += pm
             else:
                 pmap[grp_id] |= pm
 
+    def _set_mag_rups(self, src):
+        with self.cmaker.mon('iter_ruptures', measuremem=False):
+            self.mag_rups = [
+                (mag, list(rups)) for mag, rups in itertools.groupby(
+                    src.iter_ruptures(shift_hypo=self.shift_hypo),
+                    key=operator.attrgetter('mag'))]
+
+    def _accumulate(self, ctxs, allsids, order, array, hit):
+        # the probabilities of no exceedance (or of exceedance, for mutex
+        # ruptures) are accumulated in a dense array with a row for each
+        # site in allsids; the rows are found by bisection
+        nsites = 0
+        for rup, sids, poes in self._gen_poes(ctxs):
+            with self.pne_mon:
+                pnes = rup.get_probability_no_exceedance(poes)
+                rows = order[numpy.searchsorted(allsids, sids, sorter=order)]
+                # NB: the sids of a rupture are distinct, so there is
+                # no need for numpy.multiply.at
+                if self.rup_indep:
+                    array[rows] *= pnes
+                else:
+                    array[rows] += (1. - pnes) * rup.weight
+                hit[rows] = True
+            nsites += len(sids)
+        return nsites
+
     def make(self, src, sites, pmap, rup_data):
         """
         :param src: a hazardlib source
         :param sites: the sites affected by it
         :returns: the probability map generated by the source
         """
-        with self.cmaker.mon('iter_ruptures', measuremem=False):
-            self.mag_rups = [
-                (mag, list(rups)) for mag, rups in itertools.groupby(
-                    src.iter_ruptures(shift_hypo=self.shift_hypo),
-                    key=operator.attrgetter('mag'))]
+        self._set_mag_rups(src)
         rupdata = RupData(self.cmaker)
         totrups, numrups, nsites = 0, 0, 0
         L, G = len(self.imtls.array), len(self.gsims)
-        poemap = ProbabilityMap(L, G)
-        for rups, sites in self._gen_rups_sites(src, sites):
+        allsids = sites.sids
+        order = allsids.argsort()
+        array = numpy.full((len(allsids), L, G), float(self.rup_indep))
+        hit = numpy.zeros(len(allsids), bool)
+        for ctxs in self._gen_ctxs(src, sites):
             with self.ctx_mon:
-                ctxs = self.cmaker.make_ctxs(rups, sites)
-                if ctxs:
-                    totrups += len(ctxs)
-                    ctxs = self.collapse(ctxs)
-                    numrups += len(ctxs)
-            for rup, r_sites, dctx in ctxs:
-                if self.fewsites:  # store rupdata
+                totrups += len(ctxs)
+                ctxs = self.collapse(ctxs)
+                numrups += len(ctxs)
+            if self.fewsites:  # store rupdata
+                for rup, r_sites, dctx in ctxs:
                     rupdata.add(rup, r_sites, dctx)
-                sids, poes = self._sids_poes(rup, r_sites, dctx, src.id)
-                with self.pne_mon:
-                    pnes = rup.get_probability_no_exceedance(poes)
-                    if self.rup_indep:
-                        for sid, pne in zip(sids, pnes):
-                            poemap.setdefault(sid, self.rup_indep).array *= pne
-                    else:
-                        for sid, pne in zip(sids, pnes):
-                            poemap.setdefault(sid, self.rup_indep).array += (
-                                1.-pne) * rup.weight
-                nsites += len(sids)
+            nsites += self._accumulate(ctxs, allsids, order, array, hit)
+        array = array[hit]
+        if self.rup_indep:
+            array = 1. - array
+        if self.src_mutex:
+            array *= src.mutex_weight
+        poemap = ProbabilityMap.from_array(array, allsids[hit])
         poemap.totrups = totrups
         poemap.numrups = numrups
         poemap.nsites = nsites
@@ -449,13 +746,91 @@ class PmapMaker(object):
                     rup_data[k].extend(v)
         return poemap
 
+    def make_binned(self, src_sites, pmap, rup_data, calc_times):
+        """
+        Same as :meth:`make`, but the ruptures of different sources with
+        the same src_group_ids are binned together, in blocks of up to
+        MAX_POES // (L * G) rupture-site pairs. The number of binned
+        ruptures and the time spent in the GSIMs are attributed to the
+        sources proportionally to their number of ruptures.
+
+        :param src_sites: an iterator over pairs (source, sites)
+        :param pmap: a dictionary grp_id -> ProbabilityMap to update
+        :param rup_data: a dictionary of lists to update
+        :param calc_times: a dictionary src.id -> (nrups, nsites, time)
+        :returns: the total number of ruptures before binning
+        """
+        maxrows = max(MAX_POES // (len(self.imtls.array) * len(self.gsims)),
+                      1)
+        acc = AccumDict(accum=[])  # src_group_ids -> [(src.id, ctxs), ...]
+        size = AccumDict(accum=0)  # src_group_ids -> rupture-site pairs
+        totrups = 0
+        for src, sites in src_sites:
+            t0 = time.time()
+            try:
+                self._set_mag_rups(src)
+                ctxs = [ctx for ctxs in self._gen_ctxs(src, sites)
+                        for ctx in ctxs]
+            except Exception as err:
+                etype, err, tb = sys.exc_info()
+                msg = '%s (source id=%s)' % (str(err), src.source_id)
+                raise etype(msg).with_traceback(tb)
+            totrups += len(ctxs)
+            nsites = sum(len(ctx[1]) for ctx in ctxs)
+            calc_times[src.id] += numpy.array([0, nsites, time.time() - t0])
+            key = tuple(src.src_group_ids)
+            acc[key].append((src.id, ctxs))
+            size[key] += nsites
+            if size[key] > maxrows:
+                self._make_block(key, acc.pop(key), pmap, rup_data,
+                                 calc_times)
+                del size[key]
+        for key, srcid_ctxs in acc.items():
+            self._make_block(key, srcid_ctxs, pmap, rup_data, calc_times)
+        return totrups
+
+    def _make_block(self, grp_ids, srcid_ctxs, pmap, rup_data, calc_times):
+        # bin the contexts of a block of sources and update pmap
+        t0 = time.time()
+        ctxs = [ctx for srcid, sctxs in srcid_ctxs for ctx in sctxs]
+        if not ctxs:
+            return
+        with self.ctx_mon:
+            binned = self.bin(ctxs)
+        L, G = len(self.imtls.array), len(self.gsims)
+        allsids = numpy.unique(
+            numpy.concatenate([ctx[1].sids for ctx in binned]))
+        order = numpy.arange(len(allsids))
+        array = numpy.ones((len(allsids), L, G))
+        hit = numpy.zeros(len(allsids), bool)
+        self._accumulate(binned, allsids, order, array, hit)
+        poemap = ProbabilityMap.from_array(1. - array[hit], allsids[hit])
+        for grp_id in grp_ids:
+            pmap[grp_id] |= poemap
+        if self.fewsites:  # store rupdata
+            rupdata = RupData(self.cmaker)
+            for rup, r_sites, dctx in binned:
+                rupdata.add(rup, r_sites, dctx)
+            for gid in grp_ids:
+                rup_data['grp_id'].extend([gid] * len(binned))
+                for k, v in rupdata.data.items():
+                    rup_data[k].extend(v)
+        ratio = len(binned) / len(ctxs)
+        dt = (time.time() - t0) / len(ctxs)
+        for srcid, sctxs in srcid_ctxs:
+            n = len(sctxs)
+            calc_times[srcid] += numpy.array([n * ratio, 0, n * dt])
+
     def collapse(self, ctxs, precision=1E-3):
         """
-        Collapse the contexts if the distances are equivalent up to 1/1000
+        Collapse the contexts if the distances are equivalent up to 1/1000,
+        or bin them if .binning is set
         """
         # effect = self.cmaker.effect  # not None for single-site calculations
         if not self.rup_indep or len(ctxs) == 1:  # do not collapse
             return ctxs
+        if self.binning:  # not for mutex sources and clusters
+            return self.bin(ctxs)
         acc = AccumDict(accum=[])
         distmax = max(dctx.rrup.max() for rup, sctx, dctx in ctxs)
         for rup, sctx, dctx in ctxs:
@@ -478,6 +853,57 @@ class PmapMaker(object):
             new_ctxs.extend(_collapse_ctxs(vals))
         return new_ctxs
 
+    def bin(self, ctxs):
+        """
+        Bin the contexts by rupture parameters and by distances of each
+        site, with the bin widths in .rupture_binning (the keys are the
+        names of the rupture parameters, "dist" and "default"; the missing
+        keys have width "default", or 0 if it is missing too, which means
+        no binning). The distances are binned on a logarithmic scale, i.e.
+        the width is relative for distances much larger than 1 km. The
+        contexts in the same bin are replaced by a single context with the
+        total occurrence rate and the parameters averaged with the rates
+        as weights.
+
+        :param ctxs: a list of triples (rup, sites, dctx)
+        :returns: a shorter list of triples
+        """
+        binning = self.rupture_binning
+        default = binning.get('default', 0)
+        params = sorted(self.REQUIRES_RUPTURE_PARAMETERS)
+        widths = [binning.get(par, default) for par in params]
+        dwidth = binning.get('dist', default)
+        acc = AccumDict(accum=[])
+        for rup, sctx, dctx in ctxs:
+            if numpy.isnan(rup.occurrence_rate):  # nonparametric rupture
+                acc[id(rup), ].append((rup, sctx, dctx))  # not binned
+                continue
+            tup = [sctx.sids.tobytes()]
+            for par, width in zip(params, widths):
+                tup.append(_bin(getattr(rup, par), width))
+            for name in sorted(self.REQUIRES_DISTANCES):
+                dists = getattr(dctx, name)
+                # NB: the rx distance can be negative, hence the sign
+                logd = numpy.sign(dists) * numpy.log1p(numpy.abs(dists))
+                tup.append(_bin(logd, dwidth).tobytes())
+            acc[tuple(tup)].append((rup, sctx, dctx))
+        return [_bin_ctxs(vals, params) for vals in acc.values()]
+
+    def _gen_ctxs(self, src, sites):
+        # yield lists of contexts; when binning, all the contexts of the
+        # source are yielded together, so that ruptures with different
+        # magnitudes can end up in the same bin
+        allctxs = []
+        for rups, r_sites in self._gen_rups_sites(src, sites):
+            with self.ctx_mon:
+                ctxs = self.cmaker.make_ctxs(rups, r_sites)
+            if self.binning:
+                allctxs.extend(ctxs)
+            elif ctxs:
+                yield ctxs
+        if allctxs:
+            yield allctxs
+
     def _gen_rups_sites(self, src, sites):
         loc = getattr(src, 'location', None)
         rupsites = ((rups, sites) for mag, rups in self.mag_rups)
@@ -22,6 +22,7 @@ Module :mod:`openquake.hazardlib.geo.surface.planar` contains
 """
 import logging
 import numpy
+from scipy.spatial.distance import cdist
 from openquake.baselib.node import Node
 from openquake.hazardlib.geo import Point
 from openquake.hazardlib.geo.surface.base import BaseSurface
@@ -628,3 +629,73 @@ class PlanarSurface(BaseSurface):
         return (self.corner_lons.take([0, 1, 3, 2, 0]),
                 self.corner_lats.take([0, 1, 3, 2, 0]),
                 self.corner_depths.take([0, 1, 3, 2, 0]))
+
+
+def get_distances_planar(surfaces, mesh, params):
+    """
+    Vectorized version of the methods `get_min_distance`,
+    `get_joyner_boore_distance`, `get_rx_distance` and `get_ry0_distance`
+    of :class:`PlanarSurface`, computing the distances for many surfaces
+    at once with the same operations.
+
+    :param surfaces: a list of R PlanarSurfaces
+    :param mesh: a Mesh (or SiteCollection) of N points
+    :param params: a subset of {'rrup', 'rjb', 'rx', 'ry0'}
+    :returns: a dictionary param -> array of shape (R, N)
+    """
+    dic = {}
+    if 'rrup' in params:
+        xyz = mesh.xyz
+        normal = numpy.array([surf.normal for surf in surfaces])[:, None]
+        d = numpy.array([surf.d for surf in surfaces])[:, None]
+        uv1 = numpy.array([surf.uv1 for surf in surfaces])[:, None]
+        uv2 = numpy.array([surf.uv2 for surf in surfaces])[:, None]
+        zero_zero = numpy.array([surf.zero_zero for surf in surfaces])[:, None]
+        length = numpy.array([surf.length for surf in surfaces])[:, None]
+        width = numpy.array([surf.width for surf in surfaces])[:, None]
+        # _project with an additional leading axis
+        dists = (normal * xyz).sum(axis=-1) + d
+        projs = xyz + normal * (-dists)[..., None]
+        vectors2d = projs - zero_zero
+        xx = (vectors2d * uv1).sum(axis=-1)
+        yy = (vectors2d * uv2).sum(axis=-1)
+        # distances from the sides of the rectangle, as in get_min_distance
+        mxx = xx - xx.clip(0, length)
+        myy = yy - yy.clip(0, width)
+        dic['rrup'] = numpy.sqrt(dists ** 2 + (mxx ** 2 + myy ** 2))
+    if not params & {'rjb', 'rx', 'ry0'}:
+        return dic
+    # the four arcs of get_joyner_boore_distance: the arc 0 is the one
+    # of get_rx_distance, the arcs 2 and 3 are the ones of get_ry0_distance
+    corner_lons = numpy.array([surf.corner_lons for surf in surfaces])
+    corner_lats = numpy.array([surf.corner_lats for surf in surfaces])
+    strikes = numpy.array([surf.strike for surf in surfaces])
+    downdip = (strikes + 90) % 360
+    arcs_azimuths = numpy.array([strikes, strikes, downdip, downdip]).T
+    dists_to_arcs = geodetic.distance_to_arc(
+        corner_lons[:, None, [0, 2, 0, 1]], corner_lats[:, None, [0, 2, 0, 1]],
+        arcs_azimuths[:, None], mesh.lons.reshape(-1, 1),
+        mesh.lats.reshape(-1, 1))  # shape (R, N, 4)
+    if 'rx' in params:
+        dic['rx'] = dists_to_arcs[:, :, 0]
+    if 'ry0' in params:
+        dst1, dst2 = dists_to_arcs[:, :, 2], dists_to_arcs[:, :, 3]
+        idx = numpy.sign(dst1) == numpy.sign(dst2)
+        dst = numpy.zeros_like(dst1)
+        dst[idx] = numpy.fmin(numpy.abs(dst1[idx]), numpy.abs(dst2[idx]))
+        dic['ry0'] = dst
+    if 'rjb' in params:
+        R, N = dists_to_arcs.shape[:2]
+        corners = geodetic.spherical_to_cartesian(
+            corner_lons.flatten(), corner_lats.flatten())
+        dists_to_corners = cdist(corners, mesh.xyz).reshape(R, 4, N).min(
+            axis=1)
+        ds1, ds2, ds3, ds4 = numpy.sign(dists_to_arcs).transpose(2, 0, 1)
+        dists_to_arcs = numpy.abs(dists_to_arcs).reshape(R, N, 2, 2).min(
+            axis=-1)
+        dic['rjb'] = numpy.select(
+            condlist=[(ds1 == ds2) & (ds3 == ds4), ds1 == ds2, ds3 == ds4],
+            choicelist=[dists_to_corners, dists_to_arcs[:, :, 0],
+                        dists_to_arcs[:, :, 1]],
+            default=0)
+    return dic
@@ -23,6 +23,7 @@ Module exports :class:`AkkarEtAlRjb2014`
 """
 import numpy as np
 from openquake.hazardlib.gsim.base import GMPE, CoeffsTable
+from openquake.hazardlib.contexts import DistancesContext
 from openquake.hazardlib import const
 from openquake.hazardlib.imt import PGA, PGV, SA
 
@@ -73,6 +74,10 @@ class AkkarEtAlRjb2014(GMPE):
     #: coefficients in table 4.a, pages 22-23, are used.
     REQUIRES_DISTANCES = set(('rjb', ))
 
+    #: The rupture parameters can be arrays, see
+    #: :func:`openquake.hazardlib.gsim.base.get_mean_std`
+    vectorized = True
+
     def __init__(self, adjustment_factor=1.0):
         super().__init__()
         self.adjustment_factor = np.log(adjustment_factor)
@@ -95,12 +100,35 @@ class AkkarEtAlRjb2014(GMPE):
         # compute full mean value by adding nonlinear site amplification terms
         C = self.COEFFS[imt]
         mean = (self._compute_mean(C, rup.mag, dists, rup.rake) +
-                self._compute_non_linear_term(C, median_pga, sites))
+                self._compute_non_linear_term(C, median_pga, sites.vs30))
 
         stddevs = self._get_stddevs(C, stddev_types, num_sites=sites.vs30.size)
 
         return mean + self.adjustment_factor, stddevs
 
+    def get_mean_std_imts(self, sites, rup, dists, imts):
+        """
+        Compute the means and the total standard deviations for all the
+        IMTs at once, by broadcasting the coefficients of the M IMTs over
+        the N sites.
+
+        :returns: an array of shape (2, N, M)
+        """
+        # reshape the parameters as columns, i.e. with shape (N, 1)
+        mag = np.reshape(rup.mag, (-1, 1))
+        rake = np.reshape(rup.rake, (-1, 1))
+        dists = DistancesContext((name, getattr(dists, name)[:, None])
+                                 for name in self.REQUIRES_DISTANCES)
+        vs30 = sites.vs30[:, None]
+        median_pga = np.exp(
+            self._compute_mean(self.COEFFS[PGA()], mag, dists, rake))
+        C = self.COEFFS.to_array(imts)  # shape (M,)
+        mean = (self._compute_mean(C, mag, dists, rake) +
+                self._compute_non_linear_term(C, median_pga, vs30))
+        std = np.sqrt(C['sigma'] ** 2 + C['tau'] ** 2)
+        return np.array([mean + self.adjustment_factor,
+                         std + np.zeros_like(mean)])
+
     def _get_stddevs(self, C, stddev_types, num_sites):
         """
         Return standard deviations as defined in table 4a, p. 22.
@@ -122,12 +150,9 @@ class AkkarEtAlRjb2014(GMPE):
         Compute and return second term in equations (2a)
         and (2b), page 20.
         """
-        if mag <= self.c1:
-            # this is the second term in eq. (2a), p. 20
-            return C['a2'] * (mag - self.c1)
-        else:
-            # this is the second term in eq. (2b), p. 20
-            return C['a7'] * (mag - self.c1)
+        # the second term in eq. (2a) and in eq. (2b), p. 20
+        return np.where(mag <= self.c1, C['a2'] * (mag - self.c1),
+                        C['a7'] * (mag - self.c1))
 
     def _compute_quadratic_magnitude_term(self, C, mag):
         """
@@ -151,38 +176,31 @@ class AkkarEtAlRjb2014(GMPE):
         Compute and return fifth and sixth terms in equations (2a)
         and (2b), pages 20.
         """
-        Fn = float(rake > -135.0 and rake < -45.0)
-        Fr = float(rake > 45.0 and rake < 135.0)
+        Fn = np.where((rake > -135.0) & (rake < -45.0), 1., 0.)
+        Fr = np.where((rake > 45.0) & (rake < 135.0), 1., 0.)
 
         return C['a8'] * Fn + C['a9'] * Fr
 
-    def _compute_non_linear_term(self, C, pga_only, sites):
+    def _compute_non_linear_term(self, C, pga_only, vs30):
         """
         Compute non-linear term, equation (3a) to (3c), page 20.
         """
         Vref = 750.0
         Vcon = 1000.0
-        lnS = np.zeros_like(sites.vs30)
 
         # equation (3a)
-        idx = sites.vs30 < Vref
-        lnS[idx] = (
-            C['b1'] * np.log(sites.vs30[idx] / Vref) +
+        lnS_3a = (
+            C['b1'] * np.log(vs30 / Vref) +
             C['b2'] * np.log(
-                (pga_only[idx] + C['c'] * (sites.vs30[idx] / Vref) ** C['n']) /
-                ((pga_only[idx] + C['c']) * (sites.vs30[idx] / Vref) ** C['n'])
+                (pga_only + C['c'] * (vs30 / Vref) ** C['n']) /
+                ((pga_only + C['c']) * (vs30 / Vref) ** C['n'])
             )
         )
 
-        # equation (3b)
-        idx = (sites.vs30 >= Vref) & (sites.vs30 <= Vcon)
-        lnS[idx] = C['b1'] * np.log(sites.vs30[idx]/Vref)
-
-        # equation (3c)
-        idx = sites.vs30 > Vcon
-        lnS[idx] = C['b1'] * np.log(Vcon/Vref)
+        # equations (3b) and (3c)
+        lnS_3bc = C['b1'] * np.log(np.minimum(vs30, Vcon) / Vref)
 
-        return lnS
+        return np.where(vs30 < Vref, lnS_3a, lnS_3bc)
 
     def _compute_mean(self, C, mag, dists, rake):
         """
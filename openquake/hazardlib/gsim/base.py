@@ -26,7 +26,7 @@ import math
 import warnings
 import functools
 import numpy
-from scipy.special import ndtr
+from scipy.special import ndtr, ndtri
 
 from openquake.baselib.general import DeprecationWarning
 from openquake.hazardlib import imt as imt_module
@@ -83,30 +83,54 @@ def gsim_imt_dt(sorted_gsims, sorted_imts):
     return numpy.dtype([(str(gsim), imt_dt) for gsim in sorted_gsims])
 
 
+def _set_mean_std(arr, gsim, sctx, rctx, dctx, imts):
+    # populate an array of shape (2, N, M) with means and stddevs
+    num_tables = CoeffsTable.num_instances
+    d = dctx.roundup(gsim.minimum_distance)
+    if gsim.all_imts:  # compute all the IMTs at once
+        arr[:] = gsim.get_mean_std_imts(sctx, rctx, d, imts)
+    else:
+        for m, imt in enumerate(imts):
+            mean, [std] = gsim.get_mean_and_stddevs(sctx, rctx, d, imt,
+                                                    [const.StdDev.TOTAL])
+            arr[0, :, m] = mean
+            arr[1, :, m] = std
+    if CoeffsTable.num_instances > num_tables:
+        raise RuntimeError('Instantiating CoeffsTable inside '
+                           '%s.get_mean_and_stddevs' %
+                           gsim.__class__.__name__)
+
+
 def get_mean_std(sctx, rctx, dctx, imts, gsims):
     """
+    :param sctx: a SitesContext or SiteCollection with N sites
+    :param rctx: a RuptureContext, possibly stacked
+    :param dctx: a DistancesContext
+    :param imts: a list of M intensity measure types
+    :param gsims: a list of G GSIM instances
     :returns: an array of shape (2, N, M, G) with means and stddevs
+
+    The contexts can be the ones returned by
+    :meth:`openquake.hazardlib.contexts.ContextMaker.stack`, with a row
+    for each (rupture, site) pair: in that case the vectorized GSIMs are
+    called once per IMT, while the others are called once per rupture.
     """
     N = len(sctx.sids)
     M = len(imts)
     G = len(gsims)
     arr = numpy.zeros((2, N, M, G))
-    num_tables = CoeffsTable.num_instances
+    ctxs = getattr(rctx, 'ctxs', None)  # not None for stacked contexts
     for g, gsim in enumerate(gsims):
-        d = dctx.roundup(gsim.minimum_distance)
-        for m, imt in enumerate(imts):
-            mean, [std] = gsim.get_mean_and_stddevs(sctx, rctx, d, imt,
-                                                    [const.StdDev.TOTAL])
-            arr[0, :, m, g] = mean
-            arr[1, :, m, g] = std
-            if CoeffsTable.num_instances > num_tables:
-                raise RuntimeError('Instantiating CoeffsTable inside '
-                                   '%s.get_mean_and_stddevs' %
-                                   gsim.__class__.__name__)
+        if ctxs is None or gsim.vectorized:
+            _set_mean_std(arr[:, :, :, g], gsim, sctx, rctx, dctx, imts)
+        else:  # generic adapter, one call per rupture
+            for slc, (rup, sites, dist) in zip(rctx.slices, ctxs):
+                _set_mean_std(arr[:, slc, :, g], gsim, sites, rup, dist, imts)
     return arr
 
 
-def get_poes(mean_std, loglevels, truncation_level, gsims=()):
+def get_poes(mean_std, loglevels, truncation_level, gsims=(), out=None,
+             table=None):
     """
     Calculate and return probabilities of exceedance (PoEs) of one or more
     intensity measure levels (IMLs) of one intensity measure type (IMT)
@@ -136,6 +160,14 @@ def get_poes(mean_std, loglevels, truncation_level, gsims=()):
         value and is defined in units of sigmas. The resulting PoEs
         for that mode are values of complementary cumulative distribution
         function of that truncated Gaussian applied to IMLs.
+    :param gsims:
+        The G GSIM instances used to compute mean_std (optional)
+    :param out:
+        If given, an array of shape (N, L, G) to be filled with the PoEs,
+        useful to avoid an allocation for each call
+    :param table:
+        If given, a :class:`TruncNormTable` to be used instead of the
+        exact survival function
 
     :returns:
         array of PoEs of shape (N, L, G)
@@ -155,7 +187,7 @@ def get_poes(mean_std, loglevels, truncation_level, gsims=()):
         # implement average get_poes for the nshmp_2014 model
         shp = list(mean_std[0].shape)  # (N, M, G)
         shp[1] = len(loglevels.array)  # L
-        arr = numpy.zeros(shp)
+        arr = numpy.zeros(shp) if out is None else out
         for g, gsim in enumerate(gsims):
             if hasattr(gsim, 'weights_signs'):
                 outs = []
@@ -164,33 +196,43 @@ def get_poes(mean_std, loglevels, truncation_level, gsims=()):
                     ms = numpy.array(mean_std[:, :, :, g])  # make a copy
                     for m in range(len(loglevels)):
                         ms[0, :, m] += s * gsim.adjustment
-                    outs.append(_get_poes(ms, loglevels, tl, squeeze=1))
+                    outs.append(_get_poes(ms, loglevels, tl, squeeze=1,
+                                          table=table))
                 arr[:, :, g] = numpy.average(outs, weights=weights, axis=0)
             else:
                 ms = mean_std[:, :, :, g]
-                arr[:, :, g] = _get_poes(ms, loglevels, tl, squeeze=1)
+                arr[:, :, g] = _get_poes(ms, loglevels, tl, squeeze=1,
+                                         table=table)
         return arr
     else:
         # regular case
-        return _get_poes(mean_std, loglevels, truncation_level)
+        return _get_poes(mean_std, loglevels, truncation_level,
+                         out=out, table=table)
 
 
 # this is the critical function for the performance of the classical calculator
 # it is dominated by memory allocations (i.e. _truncnorm_sf is ultra-fast)
 # the only way to speedup is to reduce the maximum_distance, then the array
-# will become shorted in the N dimension (number of affected sites)
-def _get_poes(mean_std, loglevels, truncation_level, squeeze=False):
+# will become shorted in the N dimension (number of affected sites);
+# passing a preallocated `out` array and a TruncNormTable removes the
+# allocations and replaces the calls to ndtr with table lookups
+def _get_poes(mean_std, loglevels, truncation_level, squeeze=False,
+              out=None, table=None):
     mean, stddev = mean_std  # shape (N, M, G) each
     N, L, G = len(mean), len(loglevels.array), mean.shape[-1]
-    out = numpy.zeros((N, L) if squeeze else (N, L, G))
-    lvl = 0
+    if out is None:
+        out = numpy.zeros((N, L) if squeeze else (N, L, G))
     for m, imt in enumerate(loglevels):
-        for iml in loglevels[imt]:
-            if truncation_level == 0:  # just compare imls to mean
-                out[:, lvl] = iml <= mean[:, m]
-            else:
-                out[:, lvl] = (iml - mean[:, m]) / stddev[:, m]
-            lvl += 1
+        # fill the levels of the IMT with a single broadcasted operation
+        imls = loglevels[imt] if squeeze else loglevels[imt][:, None]
+        arr = out[:, loglevels(imt)]
+        if truncation_level == 0:  # just compare imls to mean
+            arr[:] = imls <= mean[:, m][:, None]
+        else:
+            numpy.subtract(imls, mean[:, m][:, None], out=arr)
+            arr /= stddev[:, m][:, None]
+    if table is not None and truncation_level != 0:
+        return table(out)
     return _truncnorm_sf(truncation_level, out)
 
 
@@ -310,10 +352,25 @@ class GroundShakingIntensityModel(metaclass=MetaGSIM):
     non_verified = False
     experimental = False
     adapted = False
+    #: True if the GSIM accepts arrays of rupture parameters, with a value
+    #: for each site, i.e. the stacked contexts used in :func:`get_mean_std`
+    vectorized = False
+    #: True if the GSIM defines a method get_mean_std_imts computing the
+    #: means and total stddevs for all the IMTs at once; it is set
+    #: automatically and it is False if a subclass overrides
+    #: get_mean_and_stddevs
+    all_imts = False
     get_poes = staticmethod(get_poes)
 
     @classmethod
     def __init_subclass__(cls):
+        for klass in cls.__mro__:
+            if 'get_mean_std_imts' in vars(klass):
+                cls.all_imts = True
+                break
+            elif 'get_mean_and_stddevs' in vars(klass):
+                cls.all_imts = False
+                break
         stddevtypes = cls.DEFINED_FOR_STANDARD_DEVIATION_TYPES
         if not isinstance(stddevtypes, abc.abstractproperty):  # concrete class
             if const.StdDev.TOTAL not in stddevtypes:
@@ -492,6 +549,89 @@ def _truncnorm_sf(truncation_level, values):
     return ((phi_b - ndtr(values)) / z).clip(0.0, 1.0)
 
 
+class TruncNormTable(object):
+    """
+    Lookup table for the survival function of the standard normal
+    distribution, possibly truncated symmetrically, to be used as a faster
+    replacement of :func:`_truncnorm_sf`. The function is tabulated on a
+    uniform grid and linearly interpolated; the spacing of the grid is
+    chosen so that the absolute error is below the given tolerance.
+
+    :param truncation_level: a positive number or None
+    :param tolerance: the maximum absolute error, for instance 1E-6
+
+    >>> from scipy.stats import truncnorm
+    >>> values = numpy.array([-4., -1., 0.12345, 2.9])
+    >>> table = TruncNormTable(3, 1E-6)
+    >>> err = abs(table(values.copy()) - truncnorm(-3, 3).sf(values))
+    >>> bool(err.max() < 1E-6)
+    True
+    """
+    # the second derivative of the survival function is x * phi(x) / z,
+    # which has a maximum absolute value of phi(1) / z at x = 1
+    PHI1 = math.exp(-.5) / math.sqrt(2 * math.pi)
+    SF_MIN = 1E-16  # negligible probability for the untruncated case
+
+    def __init__(self, truncation_level, tolerance):
+        if truncation_level is not None and truncation_level <= 0:
+            raise ValueError('Invalid truncation_level=%s' % truncation_level)
+        if not 0 < tolerance < 1:
+            raise ValueError('Invalid tolerance=%s' % tolerance)
+        self.truncation_level = truncation_level
+        self.tolerance = tolerance
+        if truncation_level is None:
+            # outside [-xmax, xmax] the survival function differs from the
+            # values at the borders of the table by less than SF_MIN; a
+            # larger difference would bias the tails of the hazard curves
+            xmax = -ndtri(self.SF_MIN)
+            z = 1.
+        else:
+            xmax = truncation_level
+            z = ndtr(truncation_level) * 2 - 1
+        # the error of the linear interpolation is below h**2 / 8 * max|f''|;
+        # use half of the tolerance to be safe against rounding errors
+        h = math.sqrt(4 * tolerance * z / self.PHI1)
+        npoints = int(math.ceil(2 * xmax / h)) + 1
+        xs = numpy.linspace(-xmax, xmax, npoints)
+        self.x0 = -xmax
+        self.scale = (npoints - 1) / (2 * xmax)  # inverse of the spacing
+        self.ys = _truncnorm_sf(truncation_level, xs)
+        self.dys = numpy.append(numpy.diff(self.ys), 0.)
+        # work arrays, reused across calls
+        self._idx = numpy.zeros(0, numpy.intp)
+        self._tmp = numpy.zeros(0)
+
+    def __call__(self, values):
+        """
+        :param values: an array of floats, overwritten if contiguous
+        :returns: the survival function computed on the values
+        """
+        x = values.reshape(-1)
+        n = len(x)
+        if len(self._idx) < n:  # grow the work arrays
+            self._idx = numpy.zeros(n, numpy.intp)
+            self._tmp = numpy.zeros(n)
+        idx = self._idx[:n]
+        tmp = self._tmp[:n]
+        x -= self.x0
+        x *= self.scale
+        numpy.minimum(x, len(self.ys) - 1, out=x)
+        numpy.maximum(x, 0., out=x)
+        idx[:] = x  # index of the grid point on the left
+        x -= idx  # fractional part
+        x *= numpy.take(self.dys, idx, out=tmp, mode='clip')
+        x += numpy.take(self.ys, idx, out=tmp, mode='clip')
+        return x.reshape(values.shape)
+
+    def __len__(self):
+        return len(self.ys)
+
+    def __repr__(self):
+        return '<%s truncation_level=%s, tolerance=%s, %d points>' % (
+            self.__class__.__name__, self.truncation_level, self.tolerance,
+            len(self))
+
+
 def to_distribution_values(vals, imt):
     """
     :returns: the logarithm of the values unless the IMT is MMI
@@ -650,6 +790,14 @@ class CoeffsTable(object):
     ...           imt.PGA(): {"a": 0.1, "b": 1.0},
     ...           imt.PGV(): {"a": 0.5, "b": 10.0}}
     >>> ct = CoeffsTable(sa_damping=5, table=coeffs)
+
+    The coefficients for several IMTs can be extracted at once as a
+    structured array with a row per IMT, so that the GSIMs can compute
+    all the IMTs with a single vectorized expression:
+
+    >>> arr = ct.to_array([imt.PGA(), imt.SA(0.1), imt.SA(0.5)])
+    >>> arr['a']
+    array([0.1       , 1.        , 2.39794001])
     """
     num_instances = 0
 
@@ -657,6 +805,7 @@ class CoeffsTable(object):
         if 'table' not in kwargs:
             raise TypeError('CoeffsTable requires "table" kwarg')
         self._coeffs = {}  # cache
+        self._arrays = {}  # cache
         table = kwargs.pop('table')
         self.sa_coeffs = {}
         self.non_sa_coeffs = {}
@@ -755,3 +904,27 @@ class CoeffsTable(object):
             co: (min_above[co] - max_below[co]) * ratio + max_below[co]
             for co in max_below}
         return c
+
+    def to_array(self, imts):
+        """
+        Return a structured array with the coefficients for the given
+        IMTs, interpolated if needed, with a field per coefficient and a
+        row per IMT. The array is computed only once for each sequence of
+        IMTs and must not be modified.
+
+        :param imts: a sequence of M intensity measure types
+        :returns: a structured array of shape (M,)
+        :raises KeyError: if some IMT is not available in the table
+        """
+        key = tuple(imts)
+        try:
+            return self._arrays[key]
+        except KeyError:
+            pass
+        rows = [self[imt] for imt in imts]
+        dt = numpy.dtype([(co, numpy.float64) for co in rows[0]])
+        arr = numpy.zeros(len(rows), dt)
+        for co in dt.names:
+            arr[co] = [row[co] for row in rows]
+        self._arrays[key] = arr
+        return arr
@@ -20,7 +20,6 @@
 Module exports :class:`ChiouYoungs2014`.
 """
 import numpy as np
-import math
 
 from openquake.hazardlib.gsim.base import GMPE, CoeffsTable
 from openquake.hazardlib import const
@@ -68,6 +67,10 @@ class ChiouYoungs2014(GMPE):
     #: Required distance measures are RRup, Rjb and Rx.
     REQUIRES_DISTANCES = set(('rrup', 'rjb', 'rx'))
 
+    #: The rupture parameters can be arrays, see
+    #: :func:`openquake.hazardlib.gsim.base.get_mean_std`
+    vectorized = True
+
     def get_mean_and_stddevs(self, sites, rup, dists, imt, stddev_types):
         """
         See :meth:`superclass method
@@ -132,7 +135,7 @@ class ChiouYoungs2014(GMPE):
         Finferred = 1 - sites.vs30measured
 
         # eq. 13 to calculate inter-event standard error
-        mag_test = min(max(rup.mag, 5.0), 6.5) - 5.0
+        mag_test = np.clip(rup.mag, 5.0, 6.5) - 5.0
         tau = C['tau1'] + (C['tau2'] - C['tau1']) / 1.5 * mag_test
 
         # b and c coeffs from eq. 10
@@ -166,9 +169,9 @@ class ChiouYoungs2014(GMPE):
         Implements eq. 13a.
         """
         # reverse faulting flag
-        Frv = 1. if 30 <= rup.rake <= 150 else 0.
+        Frv = np.where((30 <= rup.rake) & (rup.rake <= 150), 1., 0.)
         # normal faulting flag
-        Fnm = 1. if -120 <= rup.rake <= -60 else 0.
+        Fnm = np.where((-120 <= rup.rake) & (rup.rake <= -60), 1., 0.)
         # hanging wall flag
 
         Fhw = np.zeros_like(dists.rx)
@@ -176,7 +179,7 @@ class ChiouYoungs2014(GMPE):
         Fhw[idx] = 1.
 
         # a part in eq. 11
-        mag_test1 = np.cosh(2. * max(rup.mag - 4.5, 0))
+        mag_test1 = np.cosh(2. * np.maximum(rup.mag - 4.5, 0))
 
         # centered DPP
         centered_dpp = self._get_centered_cdpp(dists)
@@ -194,7 +197,7 @@ class ChiouYoungs2014(GMPE):
             + (C['c1b'] + C['c1d'] / mag_test1) * Fnm
             + (C['c7'] + C['c7b'] / mag_test1) * centered_ztor
             + (C['c11'] + C['c11b'] / mag_test1) *
-            np.cos(math.radians(rup.dip)) ** 2
+            np.cos(np.radians(rup.dip)) ** 2
             # second part
             + C['c2'] * (rup.mag - 6)
             + ((C['c2'] - C['c3']) / C['cn'])
@@ -202,18 +205,19 @@ class ChiouYoungs2014(GMPE):
             # third part
             + C['c4']
             * np.log(dists.rrup + C['c5']
-                     * np.cosh(C['c6'] * max(rup.mag - C['chm'], 0)))
+                     * np.cosh(C['c6'] * np.maximum(rup.mag - C['chm'], 0)))
             + (C['c4a'] - C['c4'])
             * np.log(np.sqrt(dists.rrup ** 2 + C['crb'] ** 2))
             # forth part
-            + (C['cg1'] + C['cg2'] / (np.cosh(max(rup.mag - C['cg3'], 0))))
+            + (C['cg1'] + C['cg2'] /
+               (np.cosh(np.maximum(rup.mag - C['cg3'], 0))))
             * dists.rrup
             # fifth part
             + C['c8'] * dist_taper
-            * min(max(rup.mag - 5.5, 0) / 0.8, 1.0)
+            * np.minimum(np.maximum(rup.mag - 5.5, 0) / 0.8, 1.0)
             * np.exp(-1 * C['c8a'] * (rup.mag - C['c8b']) ** 2) * centered_dpp
             # sixth part
-            + C['c9'] * Fhw * np.cos(math.radians(rup.dip)) *
+            + C['c9'] * Fhw * np.cos(np.radians(rup.dip)) *
             (C['c9a'] + (1 - C['c9a']) * np.tanh(dists.rx / C['c9b']))
             * (1 - np.sqrt(dists.rjb ** 2 + rup.ztor ** 2)
                / (dists.rrup + 1.0))
@@ -240,14 +244,12 @@ class ChiouYoungs2014(GMPE):
         Get ztor centered on the M- dependent avarage ztor(km)
         by different fault types.
         """
-        if Frv == 1:
-
-            mean_ztor = max(2.704 - 1.226 * max(rup.mag - 5.849, 0.0), 0.) ** 2
-            centered_ztor = rup.ztor - mean_ztor
-        else:
-
-            mean_ztor = max(2.673 - 1.136 * max(rup.mag - 4.970, 0.0), 0.) ** 2
-            centered_ztor = rup.ztor - mean_ztor
+        mean_ztor = np.where(
+            Frv == 1,
+            np.maximum(2.704 - 1.226 * np.maximum(rup.mag - 5.849, 0.0), 0.),
+            np.maximum(2.673 - 1.136 * np.maximum(rup.mag - 4.970, 0.0), 0.)
+        ) ** 2
+        centered_ztor = rup.ztor - mean_ztor
 
         return centered_ztor
 
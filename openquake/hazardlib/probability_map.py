@@ -16,6 +16,7 @@
 # You should have received a copy of the GNU Affero General Public License
 # along with OpenQuake.  If not, see <http://www.gnu.org/licenses/>.
 from openquake.baselib.python3compat import zip
+from openquake.baselib import hdf5
 import numpy
 
 F32 = numpy.float32
@@ -339,9 +340,10 @@ class ProbabilityMap(dict):
         return dict(array=array, sids=sids), {}
 
     def __fromh5__(self, dic, attrs):
-        # rebuild the map from sids and probs arrays
-        array = dic['array']
-        sids = dic['sids']
+        # rebuild the map from sids and probs arrays, read in a single call
+        # (iterating on a dataset would read one row at the time)
+        array = dic['array'][()]
+        sids = dic['sids'][()]
         self.shape_y = array.shape[1]
         self.shape_z = array.shape[2]
         for sid, prob in zip(sids, array):
@@ -352,6 +354,124 @@ class ProbabilityMap(dict):
                                     self.shape_y, self.shape_z)
 
 
+class ProbabilityArray(object):
+    """
+    Dense representation of a ProbabilityMap, i.e. an ordered array of N
+    site IDs and an array of PoEs of shape (N, L, I), possibly memory-mapped.
+    It supports the read-only part of the mapping interface, building the
+    ProbabilityCurves only when they are requested:
+
+    >>> parray = ProbabilityArray(numpy.array([3, 7]), numpy.ones((2, 4, 2)))
+    >>> parray
+    <ProbabilityArray 2, 4, 2>
+    >>> 7 in parray, 4 in parray
+    (True, False)
+    >>> parray[7].array.shape
+    (4, 2)
+    >>> parray.extract(1).to_pmap()
+    <ProbabilityMap 2, 4, 1>
+    """
+    def __init__(self, sids, array):
+        self.sids = sids
+        self.array = array
+
+    @classmethod
+    def read(cls, group, sids=None):
+        """
+        :param group:
+            an HDF5 group with datasets `sids` and `array`, as written by
+            :meth:`ProbabilityMap.__toh5__`
+        :param sids:
+            if not None, read only the curves of the given sites
+        :returns:
+            a ProbabilityArray memory-mapping the datasets, if possible
+        """
+        all_sids = group['sids'][()]
+        dset = group['array']
+        if sids is not None:
+            idxs, = numpy.where(numpy.isin(all_sids, sids))
+            if len(idxs) < len(all_sids):
+                return cls(all_sids[idxs],
+                           hdf5.extract(dset, idxs, slice(None), slice(None)))
+        array = hdf5.memmap(dset)
+        return cls(all_sids, dset[()] if array is None else array)
+
+    @property
+    def shape_y(self):
+        return self.array.shape[1]
+
+    @property
+    def shape_z(self):
+        return self.array.shape[2]
+
+    @property
+    def nbytes(self):
+        """The size of the underlying array"""
+        return self.array.nbytes
+
+    def __len__(self):
+        return len(self.sids)
+
+    def __iter__(self):
+        return iter(self.sids)
+
+    def __getitem__(self, sid):
+        idx = self.sids.searchsorted(sid)
+        if idx < len(self.sids) and self.sids[idx] == sid:
+            return ProbabilityCurve(self.array[idx])
+        raise KeyError(sid)
+
+    def __contains__(self, sid):
+        idx = self.sids.searchsorted(sid)
+        return idx < len(self.sids) and self.sids[idx] == sid
+
+    def get(self, sid, default=None):
+        try:
+            return self[sid]
+        except KeyError:
+            return default
+
+    def extract(self, inner_idx):
+        """
+        Extracts the component of the PoEs specified by `inner_idx`.
+        """
+        return self.__class__(self.sids, self.array[:, :, [inner_idx]])
+
+    def to_pmap(self):
+        """
+        :returns: a ProbabilityMap with curves which are views of the array
+        """
+        return ProbabilityMap.from_array(self.array, self.sids)
+
+    def __repr__(self):
+        return '<%s %d, %d, %d>' % ((self.__class__.__name__,) +
+                                    self.array.shape)
+
+
+def compose_arrays(sids, pairs, shape_y):
+    """
+    Compose the PoEs of a set of ProbabilityArrays without building
+    the ProbabilityCurves, i.e. compute the same as
+    `combine([parray.extract(idx).to_pmap() for parray, idx in pairs])`
+
+    :param sids: an ordered array of site IDs, containing the IDs of the pairs
+    :param pairs: a list of pairs (ProbabilityArray, inner index)
+    :param shape_y: the total number of intensity measure levels
+    :returns: a ProbabilityMap with shape_z=1
+    """
+    array = numpy.zeros((len(sids), shape_y, 1))
+    found = numpy.zeros(len(sids), bool)
+    for parray, inner_idx in pairs:
+        idx = sids.searchsorted(parray.sids)
+        poes = parray.array[:, :, [inner_idx]]
+        new = ~found[idx]  # the first PoEs are copied, to be exact
+        array[idx[new]] = poes[new]
+        old = idx[~new]
+        array[old] = 1. - (1. - array[old]) * (1. - poes[~new])
+        found[idx] = True
+    return ProbabilityMap.from_array(array[found], sids[found])
+
+
 def get_shape(pmaps):
     """
     :param pmaps: a set of homogenous ProbabilityMaps
@@ -16,6 +16,7 @@
 
 import os
 import unittest
+import unittest.mock as mock
 import numpy
 import numpy.testing as npt
 
@@ -25,7 +26,7 @@ from openquake.hazardlib.source.rupture import BaseRupture
 from openquake.hazardlib.sourceconverter import SourceConverter
 from openquake.hazardlib.const import TRT
 from openquake.hazardlib.geo.surface import PlanarSurface, SimpleFaultSurface
-from openquake.hazardlib.geo import Point, Line
+from openquake.hazardlib.geo import Point, Line, NodalPlane
 from openquake.hazardlib.geo.geodetic import point_at
 from openquake.hazardlib.calc.filters import SourceFilter
 from openquake.hazardlib.calc.hazard_curve import calc_hazard_curves
@@ -34,9 +35,14 @@ from openquake.hazardlib.gsim.sadigh_1997 import SadighEtAl1997
 from openquake.hazardlib.gsim.si_midorikawa_1999 import SiMidorikawa1999SInter
 from openquake.hazardlib.gsim.campbell_2003 import Campbell2003
 from openquake.hazardlib.site import Site, SiteCollection
+from openquake.hazardlib.source import PointSource
+from openquake.hazardlib.mfd import TruncatedGRMFD
+from openquake.hazardlib.scalerel import WC1994
+from openquake.hazardlib.tom import PoissonTOM
 from openquake.hazardlib.pmf import PMF
 from openquake.hazardlib.sourceconverter import SourceGroup
 from openquake.hazardlib import nrml
+from openquake.hazardlib.contexts import PmapMaker
 
 
 def _create_rupture(distance, magnitude,
@@ -231,3 +237,83 @@ class MultiPointTestCase(unittest.TestCase):
         psources = list(mps1) + list(mps2)
         hcurves = calc_hazard_curves(psources, sitecol, imtls, gsim_by_trt)
         npt.assert_allclose(hcurves['PGA'][0], expected, rtol=1E-4, atol=1E-6)
+
+
+class PoesToleranceTestCase(unittest.TestCase):
+    # the hazard curves computed with the TruncNormTable must be close to
+    # the exact ones, even in the tails
+    def test(self):
+        d = os.path.dirname(os.path.dirname(__file__))
+        source_model = os.path.join(d, 'source_model/multi-point-source.xml')
+        groups = nrml.to_python(source_model, SourceConverter(
+            investigation_time=50., rupture_mesh_spacing=2.))
+        sitecol = SiteCollection([
+            Site(Point(lon, lat), 800, z1pt0=100., z2pt5=1.)
+            for lon in (0., .1, .2) for lat in (0., .1, .2)])
+        imtls = DictArray({'PGA': [0.01, 0.02, 0.04, 0.08, 0.16],
+                           'SA(0.2)': [0.01, 0.05, 0.1]})
+        gsim_by_trt = {'Stable Continental Crust': Campbell2003()}
+        for tl in (None, 3.):
+            exact = calc_hazard_curves(groups, sitecol, imtls, gsim_by_trt,
+                                       truncation_level=tl)
+            approx = calc_hazard_curves(groups, sitecol, imtls, gsim_by_trt,
+                                        truncation_level=tl,
+                                        poes_tolerance=1E-6)
+            for imt in imtls:
+                npt.assert_allclose(approx[imt], exact[imt], rtol=1E-3)
+
+
+class RuptureBinningTestCase(unittest.TestCase):
+    # binning the ruptures of a grid of point sources must reduce the
+    # number of ruptures and give hazard curves close to the ones
+    # without binning
+    def setUp(self):
+        trt = TRT.ACTIVE_SHALLOW_CRUST
+        npd = PMF([(.5, NodalPlane(0., 90., 0.)),
+                   (.5, NodalPlane(45., 50., 90.))])
+        hdd = PMF([(.5, 5.), (.5, 15.)])
+        self.srcs = []
+        for lon in numpy.linspace(-.2, .2, 4):
+            for lat in numpy.linspace(-.2, .2, 4):
+                src = PointSource(
+                    '%s-%s' % (lon, lat), 'point', trt,
+                    TruncatedGRMFD(5., 6.5, .1, 4., 1.), 1., WC1994(), 1.,
+                    PoissonTOM(50.), 0., 30., Point(lon, lat), npd, hdd)
+                src.src_group_id = 0
+                self.srcs.append(src)
+        site = Site(Point(0., 0.), 800, z1pt0=100., z2pt5=1.)
+        self.srcfilter = SourceFilter(SiteCollection([site]), {})
+        imtls = DictArray({'PGA': [0.01, 0.02, 0.04, 0.08, 0.16]})
+        self.param = dict(imtls=imtls, truncation_level=3.)
+
+    def classical(self, group, **param):
+        return classical(group, self.srcfilter, [SadighEtAl1997()],
+                         dict(self.param, **param))
+
+    def test(self):
+        group = SourceGroup(TRT.ACTIVE_SHALLOW_CRUST, self.srcs, 'test',
+                            'indep', 'indep')
+        exact = self.classical(group)
+        for binning in ({'mag': .2, 'dist': .05, 'default': 1.},
+                        {'mag': .2, 'dist': .05}):  # no default, no KeyError
+            binned = self.classical(group, rupture_binning=binning)
+            numrups = sum(arr[0] for arr in binned['calc_times'].values())
+            totrups = binned['extra']['totrups']
+            self.assertEqual(totrups, exact['extra']['totrups'])
+            self.assertLess(numrups, totrups)
+            npt.assert_allclose(binned['pmap'][0].array,
+                                exact['pmap'][0].array, rtol=1E-2)
+        self.assertLess(numrups, totrups / 4)
+
+    def test_mutex(self):
+        # the ruptures of mutually exclusive sources are never binned
+        for src in self.srcs:
+            src.mutex_weight = 1. / len(self.srcs)
+        group = SourceGroup(TRT.ACTIVE_SHALLOW_CRUST, self.srcs, 'test',
+                            'mutex', 'indep')
+        exact = self.classical(group)
+        with mock.patch.object(PmapMaker, 'bin') as bin_:
+            binned = self.classical(
+                group, rupture_binning={'mag': .2, 'dist': .05})
+        self.assertEqual(bin_.call_count, 0)
+        npt.assert_allclose(binned['pmap'][0].array, exact['pmap'][0].array)
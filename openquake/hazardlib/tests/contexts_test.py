@@ -16,9 +16,36 @@
 # You should have received a copy of the GNU Affero General Public License
 # along with OpenQuake.  If not, see <http://www.gnu.org/licenses/>.
 
+import copy
 import unittest
 import numpy
-from openquake.hazardlib.contexts import Effect
+from openquake.hazardlib.contexts import (
+    Effect, ContextMaker, FarAwayRupture, MeanStdCache)
+from openquake.baselib.general import DictArray
+from openquake.baselib.performance import Monitor
+from openquake.hazardlib.calc.filters import IntegrationDistance, SourceFilter
+from openquake.hazardlib.calc.hazard_curve import classical
+from openquake.hazardlib.sourceconverter import SourceGroup
+from openquake.hazardlib import const
+from openquake.hazardlib.geo.point import Point
+from openquake.hazardlib.geo.nodalplane import NodalPlane
+from openquake.hazardlib.mfd import TruncatedGRMFD
+from openquake.hazardlib.pmf import PMF
+from openquake.hazardlib.scalerel.wc1994 import WC1994
+from openquake.hazardlib.site import Site, SiteCollection
+from openquake.hazardlib.source.point import PointSource
+from openquake.hazardlib.tom import PoissonTOM
+from openquake.hazardlib.imt import PGA, SA
+from openquake.hazardlib.gsim.base import get_mean_std
+from openquake.hazardlib.gsim.abrahamson_2014 import AbrahamsonEtAl2014
+from openquake.hazardlib.gsim.akkar_2014 import (
+    AkkarEtAlRjb2014, AkkarEtAlRepi2014, AkkarEtAlRhyp2014)
+from openquake.hazardlib.gsim.armenia_2016 import AkkarEtAlRjb2014Armenia
+from openquake.hazardlib.gsim.boore_2014 import BooreEtAl2014
+from openquake.hazardlib.gsim.campbell_bozorgnia_2014 import (
+    CampbellBozorgnia2014)
+from openquake.hazardlib.gsim.chiou_youngs_2014 import ChiouYoungs2014
+from openquake.hazardlib.gsim.sadigh_1997 import SadighEtAl1997
 
 dists = numpy.array([0, 10, 20, 30, 40, 50])
 intensities = {
@@ -39,3 +66,175 @@ class EffectTestCase(unittest.TestCase):
 
         dist = list(effect.dist_by_mag(1.1).values())
         numpy.testing.assert_allclose(dist, [0, 10, 13.225806, 16.666667])
+
+
+class MakeCtxsTestCase(unittest.TestCase):
+    def setUp(self):
+        self.sitecol = SiteCollection([
+            Site(Point(lon, lat), 760., 40., 2., vs30measured=True)
+            for lon in numpy.arange(29., 31.01, .25)
+            for lat in numpy.arange(29., 31.01, .25)])
+        npd = PMF([(.5, NodalPlane(0., 90., 0.)),
+                   (.5, NodalPlane(45., 50., 90.))])
+        hdd = PMF([(.5, 5.), (.5, 15.)])
+        src = PointSource('1', 'point', 'Active Shallow Crust',
+                          TruncatedGRMFD(5., 7., .5, 4., 1.), 1., WC1994(),
+                          1., PoissonTOM(50.), 0., 30., Point(31.6, 30.),
+                          npd, hdd)
+        self.rups = list(src.iter_ruptures())
+        self.maxdist = IntegrationDistance({'Active Shallow Crust': [
+            (5.25, 40), (5.75, 50), (6.25, 70), (6.75, 80)]})
+
+    def test_planar_same_as_loop(self):
+        # the vectorized filtering of the ruptures must give the same
+        # contexts as filtering one rupture at the time
+        sitecol, rups = self.sitecol, self.rups
+        cmaker = ContextMaker('Active Shallow Crust', [AbrahamsonEtAl2014()],
+                              dict(maximum_distance=self.maxdist))
+        ctxs = cmaker.make_ctxs(rups, sitecol)
+        expected = []
+        for rup in rups:
+            try:
+                expected.append((rup,) + cmaker.make_contexts(sitecol, rup))
+            except FarAwayRupture:
+                pass
+        self.assertEqual(len(ctxs), len(expected))
+        self.assertLess(len(ctxs), len(rups))  # some ruptures are far away
+        for (rup, sctx, dctx), (rup_, sctx_, dctx_) in zip(ctxs, expected):
+            self.assertIs(rup, rup_)
+            numpy.testing.assert_equal(sctx.sids, sctx_.sids)
+            for dist in ('rrup', 'rjb', 'rx', 'ry0'):
+                numpy.testing.assert_equal(getattr(dctx, dist),
+                                           getattr(dctx_, dist))
+
+    def test_stack(self):
+        # the stacked contexts must give the same means and stddevs as
+        # the contexts of the single ruptures, both for the vectorized
+        # GSIMs and for the others (SadighEtAl1997)
+        gsims = [AbrahamsonEtAl2014(), AkkarEtAlRjb2014(), BooreEtAl2014(),
+                 CampbellBozorgnia2014(), ChiouYoungs2014(), SadighEtAl1997()]
+        imts = [PGA(), SA(0.1), SA(1.0)]
+        cmaker = ContextMaker('Active Shallow Crust', gsims,
+                              dict(maximum_distance=self.maxdist))
+        sitecol = SiteCollection([  # sites around the point source
+            Site(Point(lon, lat), vs30, 40., 2., vs30measured=True)
+            for lon in numpy.arange(31., 32.01, .25)
+            for lat in numpy.arange(29.5, 30.51, .25)
+            for vs30 in (300., 760.)])
+        ctxs = cmaker.make_ctxs(self.rups, sitecol)
+        sctx, rctx, dctx = cmaker.stack(ctxs)
+        self.assertEqual(len(sctx.sids), sum(len(ctx[1]) for ctx in ctxs))
+        self.assertEqual(len(numpy.unique(rctx.mag)), 4)
+        self.assertEqual(len(numpy.unique(rctx.dip)), 2)
+        mean_std = get_mean_std(sctx, rctx, dctx, imts, gsims)
+        for slc, (rup, sites, dist) in zip(rctx.slices, ctxs):
+            numpy.testing.assert_allclose(
+                mean_std[:, slc],
+                get_mean_std(sites, rup, dist, imts, gsims))
+
+    def test_all_imts(self):
+        # the GSIMs computing all the IMTs at once must give the same
+        # means and stddevs as the calls to get_mean_and_stddevs
+        gsims = [AkkarEtAlRjb2014(), AkkarEtAlRepi2014(),
+                 AkkarEtAlRhyp2014()]
+        for gsim in gsims:
+            self.assertTrue(gsim.all_imts)
+        # get_mean_and_stddevs is overridden in the subclass
+        self.assertFalse(AkkarEtAlRjb2014Armenia.all_imts)
+        self.assertFalse(SadighEtAl1997.all_imts)
+        imts = [PGA(), SA(0.1), SA(0.25), SA(1.0)]  # SA(0.25) interpolated
+        cmaker = ContextMaker('Active Shallow Crust', gsims,
+                              dict(maximum_distance=self.maxdist))
+        sitecol = SiteCollection([
+            Site(Point(lon, lat), vs30, 40., 2., vs30measured=True)
+            for lon in numpy.arange(31., 32.01, .5)
+            for lat in numpy.arange(29.5, 30.51, .5)
+            for vs30 in (300., 760., 1200.)])
+        ctxs = cmaker.make_ctxs(self.rups, sitecol)
+        sctx, rctx, dctx = cmaker.stack(ctxs)
+        mean_std = get_mean_std(sctx, rctx, dctx, imts, gsims)
+        for g, gsim in enumerate(gsims):
+            for m, imt in enumerate(imts):
+                mean, [std] = gsim.get_mean_and_stddevs(
+                    sctx, rctx, dctx, imt, [const.StdDev.TOTAL])
+                numpy.testing.assert_allclose(mean_std[0, :, m, g], mean)
+                numpy.testing.assert_allclose(mean_std[1, :, m, g], std)
+
+    def test_mean_std_cache(self):
+        # the second time the means and stddevs come from the cache
+        gsims = [AbrahamsonEtAl2014(), SadighEtAl1997()]
+        param = dict(maximum_distance=self.maxdist, mean_std_cache=10,
+                     imtls={'PGA': [.1], 'SA(1.0)': [.1]})
+        cmaker = ContextMaker('Active Shallow Crust', gsims, param)
+        ctxs = cmaker.make_ctxs(self.rups, self.sitecol)
+        mean_std = cmaker.get_mean_std(ctxs)
+        self.assertEqual(cmaker.miss_mon.counts, len(ctxs))
+        self.assertEqual(len(cmaker.cache), len(ctxs))
+        # equivalent contexts, built again and in reverse order
+        slices, start = [], 0
+        for ctx in ctxs:
+            slices.append(mean_std[:, start:start + len(ctx[1])])
+            start += len(ctx[1])
+        ctxs2 = cmaker.make_ctxs(self.rups, self.sitecol)[::-1]
+        self.assertIsNot(ctxs2[0][1], ctxs[-1][1])
+        numpy.testing.assert_equal(cmaker.get_mean_std(ctxs2),
+                                   numpy.concatenate(slices[::-1], axis=1))
+        self.assertEqual(cmaker.hit_mon.counts, len(ctxs))
+        self.assertEqual(cmaker.miss_mon.counts, len(ctxs))
+        # changing the vs30 of the sites the contexts are not in the cache
+        sitecol = copy.deepcopy(self.sitecol)
+        sitecol.array['vs30'] = 300.
+        ctxs3 = cmaker.make_ctxs(self.rups, sitecol)
+        self.assertFalse(numpy.allclose(cmaker.get_mean_std(ctxs3), mean_std))
+        self.assertEqual(cmaker.hit_mon.counts, len(ctxs))
+        self.assertEqual(cmaker.miss_mon.counts, len(ctxs) + len(ctxs3))
+        param['mean_std_cache'] = 0  # no cache
+        cmaker0 = ContextMaker('Active Shallow Crust', gsims, param)
+        numpy.testing.assert_equal(cmaker0.get_mean_std(ctxs), mean_std)
+        self.assertEqual(len(cmaker0.cache), 0)
+
+    def test_mean_std_cache_lru(self):
+        cache = MeanStdCache(maxbytes=800)
+        cache.put('a', numpy.zeros(50))  # 400 bytes
+        cache.put('b', numpy.zeros(50))
+        cache.get('a')  # now b is the least recently used
+        cache.put('c', numpy.zeros(50))
+        self.assertEqual(list(cache.arrays), ['a', 'c'])
+        cache.put('d', numpy.zeros(200))  # too big to be cached
+        self.assertEqual(cache.nbytes, 800)
+        self.assertIsNone(cache.get('b'))
+        MeanStdCache.clear_all()  # called by the persistent workers
+        self.assertEqual((len(cache), cache.nbytes), (0, 0))
+
+    def test_sources_differing_by_mfd(self):
+        # sources with the same geometry and magnitudes but different
+        # rates (i.e. different branches of a logic tree) have the same
+        # contexts, so half of them come from the cache
+        npd = PMF([(.5, NodalPlane(0., 90., 0.)),
+                   (.5, NodalPlane(45., 50., 90.))])
+        hdd = PMF([(.5, 5.), (.5, 15.)])
+        srcs = []
+        for i, a_val in enumerate([4., 4.2]):
+            src = PointSource(str(i), 'point', 'Active Shallow Crust',
+                              TruncatedGRMFD(5., 7., .5, a_val, 1.), 1.,
+                              WC1994(), 1., PoissonTOM(50.), 0., 30.,
+                              Point(30., 30.), npd, hdd)
+            src.src_group_id = i
+            srcs.append(src)
+        group = SourceGroup('Active Shallow Crust', srcs, 'test',
+                            'indep', 'indep')
+        srcfilter = SourceFilter(self.sitecol, self.maxdist)
+        param = dict(imtls=DictArray({'PGA': [.01, .1, .2]}),
+                     truncation_level=3.,
+                     mean_std_cache=10)
+        mon = Monitor()
+        res = classical(group, srcfilter, [SadighEtAl1997()], param, mon)
+        counts = {child.operation: child.counts for child in mon.children}
+        hits = counts['mean_std cache hits']
+        self.assertGreater(hits, 0)
+        self.assertEqual(hits, counts['mean_std cache misses'])
+        param['mean_std_cache'] = 0
+        expected = classical(group, srcfilter, [SadighEtAl1997()], param)
+        for grp_id in (0, 1):
+            numpy.testing.assert_allclose(
+                res['pmap'][grp_id].array, expected['pmap'][grp_id].array)
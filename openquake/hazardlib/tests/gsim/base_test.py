@@ -25,8 +25,8 @@ from copy import deepcopy
 
 from openquake.hazardlib import const
 from openquake.hazardlib.gsim.base import (
-    GMPE, CoeffsTable, SitesContext, RuptureContext,
-    NotVerifiedWarning, DeprecationWarning)
+    GMPE, CoeffsTable, SitesContext, RuptureContext, TruncNormTable,
+    NotVerifiedWarning, DeprecationWarning, _truncnorm_sf)
 from openquake.hazardlib.geo.point import Point
 from openquake.hazardlib.imt import PGA, PGV, SA
 from openquake.hazardlib.site import Site, SiteCollection
@@ -277,6 +277,36 @@ class ContextTestCase(unittest.TestCase):
         self.assertTrue(sctx1 != rctx)
 
 
+class TruncNormTableTestCase(unittest.TestCase):
+    def test_accuracy(self):
+        from scipy.stats import truncnorm, norm
+        values = numpy.linspace(-10., 10., 100001)
+        for tl in (None, .5, 2., 3., 6.):
+            if tl is None:
+                expected = norm.sf(values)
+            else:
+                expected = truncnorm(-tl, tl).sf(values)
+            for tol in (1E-3, 1E-6, 1E-9):
+                table = TruncNormTable(tl, tol)
+                got = table(values.copy())
+                self.assertLess(abs(got - expected).max(), tol, table)
+
+    def test_inplace(self):
+        table = TruncNormTable(3, 1E-6)
+        values = numpy.array([[-1., 0., 1.], [2., 3., numpy.nan]])
+        expected = _truncnorm_sf(3, values)
+        got = table(values)
+        self.assertIs(got.base, values)  # no allocation of the output
+        numpy.testing.assert_allclose(got, expected, atol=1E-6)
+        self.assertEqual(len(table), 1479)
+
+    def test_invalid(self):
+        with self.assertRaises(ValueError):
+            TruncNormTable(0, 1E-6)
+        with self.assertRaises(ValueError):
+            TruncNormTable(3, 0)
+
+
 class GsimInstantiationTestCase(unittest.TestCase):
     def test_deprecated(self):
         # check that a deprecation warning is raised when a deprecated
@@ -350,6 +380,19 @@ class CoeffsTableTestCase(unittest.TestCase):
         self.assertDictEqual(table1.sa_coeffs, table2.sa_coeffs)
         self.assertDictEqual(table1.non_sa_coeffs, table2.non_sa_coeffs)
 
+    def test_to_array(self):
+        # the rows are in the order of the IMTs and SA(0.5) is interpolated
+        table = CoeffsTable(sa_damping=5, table=self.coefficient_string)
+        imts = [SA(0.5), PGA(), SA(1.0)]
+        arr = table.to_array(imts)
+        self.assertEqual(arr.dtype.names, ('a', 'b'))
+        for imt, row in zip(imts, arr):
+            self.assertAlmostEqual(row['a'], table[imt]['a'])
+            self.assertAlmostEqual(row['b'], table[imt]['b'])
+        self.assertIs(table.to_array(imts), arr)  # cached
+        with self.assertRaises(KeyError):
+            table.to_array([PGA(), SA(0.01)])  # extrapolation
+
     def test_table_bad_instantiation(self):
         # If instantiated with anything other than string or tuple should
         # raise a TypeError
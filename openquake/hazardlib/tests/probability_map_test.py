@@ -18,7 +18,9 @@
 
 import unittest
 import numpy
-from openquake.hazardlib.probability_map import ProbabilityMap
+from openquake.baselib import hdf5, general
+from openquake.hazardlib.probability_map import (
+    ProbabilityMap, ProbabilityArray, compose_arrays, combine)
 
 
 class ProbabilityMapTestCase(unittest.TestCase):
@@ -40,3 +42,39 @@ class ProbabilityMapTestCase(unittest.TestCase):
         # test pmap power
         pmap = pmap1 ** 2
         numpy.testing.assert_almost_equal(pmap[0].array, [[.16], [0], [0]])
+
+    def test_array(self):
+        pmap = ProbabilityMap.build(3, 2, sids=[5, 1, 8], initvalue=.1)
+        pmap[8].array[2, 1] = .3
+        for chunks in (None, (1, 3, 2)):
+            with hdf5.File(general.gettemp(suffix='.hdf5'), 'w') as h5:
+                h5['pmap'] = pmap
+                if chunks:  # store the array in chunked form
+                    del h5['pmap/array']
+                    h5.getitem('pmap').create_dataset(
+                        'array', data=pmap.array, chunks=chunks)
+                self.assertEqual(repr(h5['pmap']), '<ProbabilityMap 3, 3, 2>')
+                parray = ProbabilityArray.read(h5.getitem('pmap'))
+                self.assertEqual(parray.sids.tolist(), [1, 5, 8])
+                self.assertEqual(isinstance(parray.array, numpy.memmap),
+                                 chunks is None)
+                parray = ProbabilityArray.read(h5.getitem('pmap'), [8, 2, 5])
+                self.assertEqual(parray.sids.tolist(), [5, 8])
+                self.assertNotIn(1, parray)
+                self.assertEqual(parray[8].array[2, 1], .3)
+                with self.assertRaises(KeyError):
+                    parray[1]
+                pm = parray.extract(1).to_pmap()
+                numpy.testing.assert_equal(pm[8].array, [[.1], [.1], [.3]])
+
+    def test_compose_arrays(self):
+        pa1 = ProbabilityArray(numpy.array([1, 3]), numpy.array(
+            [[[.1, .2]], [[.3, .4]]]))
+        pa2 = ProbabilityArray(numpy.array([3, 4]), numpy.array(
+            [[[.5, .6]], [[.7, .8]]]))
+        pmap = compose_arrays(numpy.arange(6), [(pa1, 0), (pa2, 1)], 1)
+        expected = combine([pa1.extract(0).to_pmap(),
+                            pa2.extract(1).to_pmap()])
+        self.assertEqual(sorted(pmap), [1, 3, 4])
+        for sid in expected:
+            numpy.testing.assert_equal(pmap[sid].array, expected[sid].array)
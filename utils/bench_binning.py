@@ -0,0 +1,118 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+#
+# Copyright (C) 2020 GEM Foundation
+#
+# OpenQuake is free software: you can redistribute it and/or modify it
+# under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# OpenQuake is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with OpenQuake.  If not, see <http://www.gnu.org/licenses/>.
+"""
+Measure the compression ratio, the time spent in the GSIMs and the error
+on the hazard curves given by the rupture binning on a reference model,
+i.e. a grid of point sources (a discretized area source) and a few sites,
+for increasing bin widths.
+
+$ python utils/bench_binning.py -n 20 -w "0.01 0.05 0.1"
+"""
+import numpy
+from openquake.baselib import sap
+from openquake.baselib.general import DictArray
+from openquake.baselib.performance import Monitor
+from openquake.hazardlib.calc.filters import SourceFilter
+from openquake.hazardlib.calc.hazard_curve import classical
+from openquake.hazardlib.geo.point import Point
+from openquake.hazardlib.geo.nodalplane import NodalPlane
+from openquake.hazardlib.gsim.base import registry
+from openquake.hazardlib.mfd import TruncatedGRMFD
+from openquake.hazardlib.pmf import PMF
+from openquake.hazardlib.scalerel.wc1994 import WC1994
+from openquake.hazardlib.site import Site, SiteCollection
+from openquake.hazardlib.source.point import PointSource
+from openquake.hazardlib.sourceconverter import SourceGroup
+from openquake.hazardlib.tom import PoissonTOM
+
+TRT = 'Active Shallow Crust'
+# operations performed after the binning
+OPERATIONS = ('computing mean_std', 'get_poes', 'composing pnes')
+
+
+def get_group(num_points):
+    # a group of num_points x num_points point sources
+    npd = PMF([(.5, NodalPlane(0., 90., 0.)),
+               (.5, NodalPlane(45., 50., 90.))])
+    hdd = PMF([(.5, 5.), (.5, 15.)])
+    srcs = []
+    for lon in numpy.linspace(.5, 1.5, num_points):
+        for lat in numpy.linspace(.5, 1.5, num_points):
+            src = PointSource(
+                '%s-%s' % (lon, lat), 'point', TRT,
+                TruncatedGRMFD(5., 7.5, .1, 4., 1.), 1., WC1994(), 1.,
+                PoissonTOM(50.), 0., 30., Point(lon, lat), npd, hdd)
+            src.src_group_id = 0
+            srcs.append(src)
+    return SourceGroup(TRT, srcs, 'test', 'indep', 'indep')
+
+
+def run(group, srcfilter, gsims, param):
+    # returns the time spent in the GSIMs, the compression ratio and
+    # the hazard curves
+    mon = Monitor('classical')
+    dic = classical(group, srcfilter, gsims, dict(param), mon)
+    dt = sum(child.duration for child in mon.children
+             if child.operation in OPERATIONS)
+    numrups = sum(arr[0] for arr in dic['calc_times'].values())
+    [pmap] = dic['pmap'].values()
+    curves = pmap.convert(param['imtls'], len(srcfilter.sitecol))
+    return dt, dic['extra']['totrups'] / numrups, curves
+
+
+@sap.script
+def main(num_points=20, num_sites=3, widths='0.01 0.05 0.1',
+         gsim='BooreEtAl2014', min_poe=1E-5):
+    """
+    Compare the hazard curves with and without rupture binning
+    """
+    group = get_group(num_points)
+    sitecol = SiteCollection([
+        Site(Point(lon, lat), 400., 100., 1., vs30measured=True)
+        for lon in numpy.linspace(.9, 1.1, num_sites)
+        for lat in numpy.linspace(.9, 1.1, num_sites)])
+    srcfilter = SourceFilter(sitecol, {TRT: 200.})
+    imtls = DictArray({'PGA': numpy.logspace(-2, .3, 20),
+                       'SA(1.0)': numpy.logspace(-2, .3, 20)})
+    param = dict(imtls=imtls, truncation_level=3.)
+    gsims = [registry[gsim]()]
+    dt0, _, exact = run(group, srcfilter, gsims, param)
+    print('%d sources, %d sites, time spent in the GSIMs: %.2fs' % (
+        len(group), len(sitecol), dt0))
+    print('%8s %12s %8s %10s' % ('width', 'compression', 'time', 'maxrelerr'))
+    for width in map(float, widths.split()):
+        param['rupture_binning'] = {'default': width}
+        dt, ratio, curves = run(group, srcfilter, gsims, param)
+        errs = []
+        for imt in imtls:
+            ok = exact[imt] > min_poe
+            relerr = numpy.abs(curves[imt][ok] / exact[imt][ok] - 1)
+            errs.append(relerr.max())
+        print('%8s %12.1f %8.2f %10.2E' % (width, ratio, dt, max(errs)))
+
+
+main.opt('num_points', 'number of points per side of the grid', type=int)
+main.opt('num_sites', 'number of sites per side of the grid', type=int)
+main.opt('widths', 'space-separated bin widths')
+main.opt('gsim', 'GSIM name')
+main.opt('min_poe', 'PoEs below this value are ignored in the error',
+         type=float)
+
+if __name__ == '__main__':
+    main.callfunc()
@@ -0,0 +1,100 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+#
+# Copyright (C) 2020 GEM Foundation
+#
+# OpenQuake is free software: you can redistribute it and/or modify it
+# under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# OpenQuake is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with OpenQuake.  If not, see <http://www.gnu.org/licenses/>.
+"""
+Measure the time spent in computing means and standard deviations for the
+ruptures of a grid of point sources (i.e. a discretized area source),
+calling the GSIMs once per rupture or once for the stacked contexts.
+
+$ python utils/bench_gsim.py -n 20
+"""
+import time
+import numpy
+from openquake.baselib import sap
+from openquake.hazardlib.contexts import ContextMaker
+from openquake.hazardlib.calc.filters import IntegrationDistance
+from openquake.hazardlib.geo.point import Point
+from openquake.hazardlib.geo.nodalplane import NodalPlane
+from openquake.hazardlib.gsim.base import get_mean_std, registry
+from openquake.hazardlib.imt import PGA, SA
+from openquake.hazardlib.mfd import TruncatedGRMFD
+from openquake.hazardlib.pmf import PMF
+from openquake.hazardlib.scalerel.wc1994 import WC1994
+from openquake.hazardlib.site import Site, SiteCollection
+from openquake.hazardlib.source.point import PointSource
+from openquake.hazardlib.tom import PoissonTOM
+
+GSIMS = ('AbrahamsonEtAl2014 AkkarEtAlRjb2014 BooreEtAl2014 '
+         'CampbellBozorgnia2014 ChiouYoungs2014')
+TRT = 'Active Shallow Crust'
+
+
+def get_ctxs(cmaker, num_points, num_sites):
+    # contexts for a grid of num_points x num_points point sources
+    # and a grid of num_sites x num_sites sites covering the same region
+    lons = lats = numpy.linspace(0., 2., num_sites)
+    sitecol = SiteCollection([
+        Site(Point(lon, lat), 400., 100., 1., vs30measured=True)
+        for lon in lons for lat in lats])
+    npd = PMF([(.5, NodalPlane(0., 90., 0.)),
+               (.5, NodalPlane(45., 50., 90.))])
+    hdd = PMF([(.5, 5.), (.5, 15.)])
+    ctxs = []
+    for lon in numpy.linspace(.5, 1.5, num_points):
+        for lat in numpy.linspace(.5, 1.5, num_points):
+            src = PointSource(
+                '%s-%s' % (lon, lat), 'point', TRT,
+                TruncatedGRMFD(5., 7., .5, 4., 1.), 1., WC1994(), 1.,
+                PoissonTOM(50.), 0., 30., Point(lon, lat), npd, hdd)
+            ctxs.extend(cmaker.make_ctxs(list(src.iter_ruptures()), sitecol))
+    return ctxs
+
+
+@sap.script
+def main(num_points=10, num_sites=20, gsims=GSIMS):
+    """
+    Compare get_mean_std on single and stacked contexts
+    """
+    gsims = [registry[name]() for name in gsims.split()]
+    imts = [PGA(), SA(0.1), SA(0.3), SA(1.0)]
+    maxdist = IntegrationDistance({TRT: 100.})
+    cmaker = ContextMaker(TRT, gsims, dict(maximum_distance=maxdist))
+    ctxs = get_ctxs(cmaker, num_points, num_sites)
+    nrows = sum(len(sites) for rup, sites, dctx in ctxs)
+    print('%d ruptures, %d rupture-site pairs' % (len(ctxs), nrows))
+    print('%-24s %8s %8s' % ('gsim', 'loop', 'stacked'))
+    for gsim in gsims:
+        t0 = time.time()
+        expected = [get_mean_std(sites, rup, dctx, imts, [gsim])
+                    for rup, sites, dctx in ctxs]
+        t1 = time.time()
+        sctx, rctx, dctx = cmaker.stack(ctxs)
+        mean_std = get_mean_std(sctx, rctx, dctx, imts, [gsim])
+        t2 = time.time()
+        numpy.testing.assert_allclose(
+            mean_std, numpy.concatenate(expected, axis=1))
+        print('%-24s %8.2f %8.2f' % (gsim.__class__.__name__,
+                                     t1 - t0, t2 - t1))
+
+
+main.opt('num_points', 'number of points per side of the grid', type=int)
+main.opt('num_sites', 'number of sites per side of the grid', type=int)
+main.opt('gsims', 'space-separated GSIM names')
+
+if __name__ == '__main__':
+    main.callfunc()
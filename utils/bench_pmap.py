@@ -0,0 +1,103 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+#
+# Copyright (C) 2020 GEM Foundation
+#
+# OpenQuake is free software: you can redistribute it and/or modify it
+# under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# OpenQuake is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with OpenQuake.  If not, see <http://www.gnu.org/licenses/>.
+"""
+Measure the time to read the PoEs stored in `poes/grp-XX` and to compose
+them for a realization, as done by the PmapGetter, comparing the
+ProbabilityMaps (one ProbabilityCurve per site) with the dense
+ProbabilityArrays.
+
+$ python utils/bench_pmap.py -n 100000
+"""
+import time
+import numpy
+from openquake.baselib import sap, hdf5, general
+from openquake.hazardlib.probability_map import (
+    ProbabilityMap, ProbabilityCurve, ProbabilityArray, compose_arrays)
+
+
+def read_pmaps(h5, sids):
+    # the loop used by the PmapGetter before the ProbabilityArrays
+    pmaps = []
+    ok_sids = set(sids)
+    for grp, dset in h5['poes'].items():
+        ds = dset['array']
+        L, G = ds.shape[1:]
+        pmap = ProbabilityMap(L, G)
+        for idx, sid in enumerate(dset['sids'][()]):
+            if sid in ok_sids:
+                pmap[sid] = ProbabilityCurve(ds[idx])
+        pmaps.append(pmap)
+    return pmaps
+
+
+def read_parrays(h5, sids):
+    return [ProbabilityArray.read(dset, sids)
+            for grp, dset in h5['poes'].items()]
+
+
+def compose_pmaps(pmaps, L):
+    pmap = ProbabilityMap(L, 1)
+    for pm in pmaps:
+        pmap |= pm.extract(0)
+    return pmap
+
+
+@sap.script
+def main(num_sites=100000, num_levels=50, num_gsims=4, num_groups=4,
+         seed=42):
+    """
+    Compare reading and composing ProbabilityMaps and ProbabilityArrays
+    """
+    numpy.random.seed(seed)
+    fname = general.gettemp(suffix='.hdf5')
+    with hdf5.File(fname, 'w') as h5:
+        for g in range(num_groups):  # each group affects 90% of the sites
+            sids = numpy.sort(numpy.random.choice(
+                num_sites, num_sites * 9 // 10, replace=False))
+            array = numpy.random.random(
+                (len(sids), num_levels, num_gsims)) * .1
+            h5['poes/grp-%02d' % g] = ProbabilityMap.from_array(array, sids)
+    sids = numpy.arange(num_sites)
+    rows = []
+    with hdf5.File(fname, 'r') as h5:
+        t0 = time.time()
+        pmaps = read_pmaps(h5, sids)
+        t1 = time.time()
+        pmap = compose_pmaps(pmaps, num_levels)
+        t2 = time.time()
+        rows.append(('ProbabilityMap', t1 - t0, t2 - t1))
+        parrays = read_parrays(h5, sids)
+        t3 = time.time()
+        pm = compose_arrays(sids, [(pa, 0) for pa in parrays], num_levels)
+        t4 = time.time()
+        rows.append(('ProbabilityArray', t3 - t2, t4 - t3))
+    numpy.testing.assert_allclose(pm.array, pmap.array)
+    print('%-16s %8s %8s' % ('storage', 'read', 'compose'))
+    for row in rows:
+        print('%-16s %8.2f %8.2f' % row)
+
+
+main.opt('num_sites', 'number of sites', type=int)
+main.opt('num_levels', 'number of intensity measure levels', type=int)
+main.opt('num_gsims', 'number of GSIMs per group', type=int)
+main.opt('num_groups', 'number of source groups', type=int)
+main.opt('seed', 'random seed', type=int)
+
+if __name__ == '__main__':
+    main.callfunc()
@@ -0,0 +1,76 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+#
+# Copyright (C) 2020 GEM Foundation
+#
+# OpenQuake is free software: you can redistribute it and/or modify it
+# under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# OpenQuake is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with OpenQuake.  If not, see <http://www.gnu.org/licenses/>.
+"""
+Measure the time spent in get_poes for blocks of N rupture-site pairs,
+with the exact survival function and with a TruncNormTable, both with
+a new output array per block and with a preallocated one.
+
+$ python utils/bench_poes.py -n 100000 -t 3
+"""
+import time
+import numpy
+from openquake.baselib import sap
+from openquake.baselib.general import DictArray
+from openquake.hazardlib.gsim.base import get_poes, TruncNormTable
+
+
+def bench(mean_std, loglevels, tl, table, num_blocks, preallocate):
+    N, M, G = mean_std.shape[1:]
+    out = numpy.zeros((N, len(loglevels.array), G)) if preallocate else None
+    t0 = time.time()
+    for _ in range(num_blocks):
+        poes = get_poes(mean_std, loglevels, tl, out=out, table=table)
+    return time.time() - t0, poes
+
+
+@sap.script
+def main(num_pairs=100000, num_blocks=10, truncation_level=3.,
+         tolerance=1E-6, num_gsims=4):
+    """
+    Compare get_poes with and without a TruncNormTable
+    """
+    tl = truncation_level if truncation_level > 0 else None
+    imtls = DictArray({imt: numpy.logspace(-3, 0, 20)
+                       for imt in ('PGA', 'SA(0.1)', 'SA(0.3)', 'SA(1.0)')})
+    M, L = len(imtls), len(imtls.array)
+    shp = (num_pairs, M, num_gsims)
+    mean_std = numpy.array([numpy.random.uniform(-5, -1, shp),
+                            numpy.random.uniform(.5, .8, shp)])
+    table = TruncNormTable(tl, tolerance)
+    print('%d x %d x %d PoEs per block, %s' % (num_pairs, L, num_gsims, table))
+    print('%-8s %-12s %8s %10s' % ('table', 'preallocate', 'time', 'maxerr'))
+    expected = None
+    for tab in (None, table):
+        for preallocate in (False, True):
+            dt, poes = bench(mean_std, imtls, tl, tab, num_blocks, preallocate)
+            if expected is None:
+                expected = poes.copy()
+            maxerr = numpy.abs(poes - expected).max()
+            print('%-8s %-12s %8.2f %10.2E' % (
+                tab is not None, preallocate, dt, maxerr))
+
+
+main.opt('num_pairs', 'number of rupture-site pairs per block', type=int)
+main.opt('num_blocks', 'number of blocks', type=int)
+main.opt('truncation_level', 'truncation level (0 means None)', type=float)
+main.opt('tolerance', 'tolerance of the TruncNormTable', type=float)
+main.opt('num_gsims', 'number of GSIMs', type=int)
+
+if __name__ == '__main__':
+    main.callfunc()
@@ -0,0 +1,80 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+#
+# Copyright (C) 2020 GEM Foundation
+#
+# OpenQuake is free software: you can redistribute it and/or modify it
+# under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# OpenQuake is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with OpenQuake.  If not, see <http://www.gnu.org/licenses/>.
+"""
+Measure the throughput of the master, in outputs per second, with and
+without the prefetching thread. The tasks produce many outputs of the
+given size and the aggregation function writes them on an HDF5 file,
+as it happens in the event based calculators.
+
+$ python utils/bench_receiver.py -n 4 --num-outputs 200 -s 100000
+"""
+import time
+import unittest.mock as mock
+import numpy
+from openquake.baselib import sap, parallel, hdf5, config, general
+
+dt = numpy.dtype([('eid', numpy.uint32), ('sid', numpy.uint32),
+                  ('gmv', numpy.float32)])
+
+
+def produce(num_outputs, size, monitor):
+    # each output is a list of rows, which are (relatively) slow to unpickle
+    for i in range(num_outputs):
+        yield {'rows': [(i, sid, .1) for sid in range(size // 12)]}
+
+
+def bench(prefetch, args, h5):
+    dset = h5['gmf_data']
+    with mock.patch.dict(config.distribution, prefetch_outputs=str(prefetch)):
+        smap = parallel.Starmap(produce, args)
+        n = 0
+        t0 = time.time()
+        for res in smap:
+            hdf5.extend(dset, numpy.array(res['rows'], dt))
+            h5.flush()
+            n += 1
+        wall = time.time() - t0
+    return prefetch, wall, n / wall
+
+
+@sap.script
+def main(num_tasks=4, num_outputs=200, size=100000, prefetch=10):
+    """
+    Compare the master throughput with and without prefetching
+    """
+    args = [(num_outputs, size)] * num_tasks
+    parallel.Starmap.init()
+    try:
+        with hdf5.File(general.gettemp(suffix='.hdf5'), 'w') as h5:
+            hdf5.create(h5, 'gmf_data', dt)
+            rows = [bench(pre, args, h5) for pre in (0, prefetch)]
+    finally:
+        parallel.Starmap.shutdown()
+    print('prefetch  wall_time  outputs/s')
+    for row in rows:
+        print('%8d %10.2f %10.1f' % row)
+
+
+main.opt('num_tasks', 'number of tasks to generate', type=int)
+main.opt('num_outputs', 'number of outputs per task', type=int)
+main.opt('size', 'approximate size of each output in bytes', type=int)
+main.opt('prefetch', 'number of outputs unpickled in advance', type=int)
+
+if __name__ == '__main__':
+    main.callfunc()
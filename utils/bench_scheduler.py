@@ -0,0 +1,76 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+#
+# Copyright (C) 2020 GEM Foundation
+#
+# OpenQuake is free software: you can redistribute it and/or modify it
+# under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# OpenQuake is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with OpenQuake.  If not, see <http://www.gnu.org/licenses/>.
+"""
+Compare the scheduling policies of the Starmap on a synthetic workload
+mimicking a classical calculation, i.e. many light blocks of sources
+followed by a few heavy blocks submitted last. For each policy print
+the wall clock time and the idle core-seconds, i.e.
+num_cores * wall_time - sum(task durations).
+
+$ python utils/bench_scheduler.py -n 8
+"""
+import time
+import numpy
+from openquake.baselib import sap, parallel, general
+
+
+def busy(block, unit, monitor):
+    # simulate a task with a duration proportional to its weight
+    time.sleep(block.weight * unit)
+    return {'n': len(block)}
+
+
+def bench(policy, blocks, unit, num_cores):
+    smap = parallel.Starmap(busy, [(blk, unit) for blk in blocks],
+                            num_cores=num_cores, scheduler=policy)
+    t0 = time.time()
+    smap.reduce()
+    wall = time.time() - t0
+    busy_time = smap.h5['task_info']['duration'].sum()
+    return policy, wall, num_cores * wall - busy_time
+
+
+@sap.script
+def main(num_cores=4, num_blocks=100, unit=.01, seed=42):
+    """
+    Compare the FIFO and LPT scheduling policies
+    """
+    numpy.random.seed(seed)
+    weights = numpy.random.uniform(1, 5, num_blocks)
+    weights[-num_cores // 2:] *= 20  # the heavy blocks come last
+    blocks = [general.WeightedSequence([(i, w)])
+              for i, w in enumerate(weights)]
+    parallel.Starmap.init(poolsize=num_cores)
+    try:
+        rows = [bench(policy, blocks, unit, num_cores)
+                for policy in parallel.scheduler]
+    finally:
+        parallel.Starmap.shutdown()
+    print('policy  wall_time  idle_core_seconds')
+    for row in rows:
+        print('%-6s %10.2f %18.2f' % row)
+
+
+main.opt('num_cores', 'number of cores to use', type=int)
+main.opt('num_blocks', 'number of tasks to generate', type=int)
+main.opt('unit', 'seconds per unit of weight', type=float)
+main.opt('seed', 'random seed', type=int)
+
+if __name__ == '__main__':
+    main.callfunc()